@@ -0,0 +1 @@
+from synthetic_data import SyntheticCorpus
@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.benchmark_module.synthetic_data import SyntheticCorpus
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a pipeline stage; the yielded dict collects extra numbers (row counts, latencies) of the stage.
+        """
+        print('== %s' % name)
+        record = OrderedDict()
+        start_time = time.time()
+        yield record
+        record['seconds'] = time.time() - start_time
+        self.results[name] = record
+
+
+def latency_stats(fn, repeats):
+    """
+    Utility function to time repeated calls of fn after one warm-up call
+    :return: dict of mean / p50 / p95 / max latency in milliseconds
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start_time = time.time()
+        fn()
+        times.append((time.time() - start_time) * 1000.0)
+    times = np.array(times)
+    return OrderedDict([('repeats', repeats),
+                        ('mean_ms', float(times.mean())),
+                        ('p50_ms', float(np.percentile(times, 50))),
+                        ('p95_ms', float(np.percentile(times, 95))),
+                        ('max_ms', float(times.max()))])
+
+
+def environment():
+    return OrderedDict([('python', platform.python_version()),
+                        ('tensorflow', tf.__version__),
+                        ('numpy', np.__version__),
+                        ('platform', platform.platform()),
+                        ('cpu_count', multiprocessing.cpu_count())])
+
+
+def run_benchmark(args):
+    """
+    Utility function to generate the synthetic dataset and time every pipeline stage on it
+    :return: benchmark report dict
+    """
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='smn_benchmark_')
+    utility_dir = work_dir + '/utility_dir'
+    glove_path = work_dir + '/glove_dict.pkl'
+    # Directory objects created from here on point at the synthetic dataset
+    os.environ['SMN_UTILITY_DIR'] = utility_dir
+    os.environ['SMN_GLOVE_PATH'] = glove_path
+
+    from global_module.implementation_module import SMN, DataReader
+    from global_module.pre_processing_module import BuildWordVocab, GenerateLabel, PreprocessEngine
+    from global_module.settings_module import Dictionary, Directory, get_params
+
+    timer = StageTimer()
+    with timer.stage('synthetic_data') as record:
+        rows = SyntheticCorpus(args.vocab_size, args.mean_utt_len, args.max_utt_len, args.min_turns, args.max_turns,
+                               args.num_negatives, seed=args.seed).write(utility_dir, glove_path, args.dialogs,
+                                                                         max(1, args.dialogs // 5), max(1, args.dialogs // 5))
+        record.update(rows)
+
+    with timer.stage('preprocess') as record:
+        PreprocessEngine().util()
+        record['rows'] = rows['train']
+
+    with timer.stage('vocab_build') as record:
+        record['vocab_size'] = BuildWordVocab().util(generate_vocab=False)
+        GenerateLabel().util()
+
+    dict_obj = Dictionary()
+    params_train, params_valid = [get_params(each_mode).replace(batch_size=args.batch_size,
+                                                                 num_candidates=args.num_negatives + 1)
+                                  for each_mode in ('TR', 'VA')]
+    dir_train, dir_valid = Directory('TR'), Directory('VA')
+    for each_params in (params_train, params_valid):
+        each_params.num_classes = len(dict_obj.label_dict)
+        each_params.vocab_size = len(dict_obj.glove_present_word_csv)
+
+    with timer.stage('reader') as record:
+        batches = list(DataReader(params_train).data_iterator(dir_train.data_filename, dir_train.label_filename,
+                                                              np.arange(rows['train']), dict_obj))
+        record['batches'] = len(batches)
+        record['rows'] = len(batches) * args.batch_size
+    record['rows_per_sec'] = record['rows'] / max(record['seconds'], 1e-9)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        with timer.stage('graph_construction'):
+            initializer = tf.contrib.layers.xavier_initializer(uniform=True, seed=None, dtype=tf.float32)
+            with tf.variable_scope('classifier', reuse=None, initializer=initializer):
+                train_obj = SMN(params_train, dir_train)
+            with tf.variable_scope('classifier', reuse=True, initializer=initializer):
+                valid_obj = SMN(params_valid, dir_valid)
+            session.run(tf.global_variables_initializer())
+            session.run(tf.local_variables_initializer())
+            train_obj.assign_lr(session, params_train.learning_rate)
+
+        train_feed = train_obj.get_feed_dict(batches[0])
+        with timer.stage('train_step') as record:
+            record.update(latency_stats(lambda: session.run(train_obj.train_op, feed_dict=train_feed), args.steps))
+
+        valid_feed = valid_obj.get_feed_dict(batches[0])
+        with timer.stage('valid_step') as record:
+            record.update(latency_stats(lambda: session.run([valid_obj.loss, valid_obj.metric_update_op], feed_dict=valid_feed), args.steps))
+
+        single_feed = valid_obj.get_feed_dict([each_arr[:1] for each_arr in batches[0]])
+        with timer.stage('inference_single') as record:
+            record.update(latency_stats(lambda: session.run(valid_obj.positive_score, feed_dict=single_feed), args.steps))
+
+        with timer.stage('inference_batch') as record:
+            record.update(latency_stats(lambda: session.run(valid_obj.positive_score, feed_dict=valid_feed), args.steps))
+            record['batch_size'] = args.batch_size
+        record['rows_per_sec'] = 1000.0 * args.batch_size / max(record['mean_ms'], 1e-9)
+
+    config = OrderedDict((key, value) for key, value in sorted(vars(args).items()) if key != 'output')
+    return OrderedDict([('config', config), ('environment', environment()), ('stages', timer.results)])
+
+
+def main():
+    """
+    Starting module for the synthetic benchmark: writes a JSON report comparable between runs
+    """
+    parser = argparse.ArgumentParser(description='Time every pipeline stage on synthetic data.')
+    parser.add_argument('--dialogs', type=int, default=200, help='training dialogs, valid and test get a fifth each')
+    parser.add_argument('--vocab-size', type=int, default=2000)
+    parser.add_argument('--mean-utt-len', type=int, default=8)
+    parser.add_argument('--max-utt-len', type=int, default=30)
+    parser.add_argument('--min-turns', type=int, default=4)
+    parser.add_argument('--max-turns', type=int, default=12)
+    parser.add_argument('--num-negatives', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=10, help='timed repetitions of every step')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--work-dir', default=None, help='defaults to a new temporary directory')
+    parser.add_argument('--output', default=None, help='JSON report path, printed to stdout if omitted')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    report_json = json.dumps(report, indent=2)
+    if args.output is not None:
+        output_file = open(args.output, 'w')
+        output_file.write(report_json + '\n')
+        output_file.close()
+    else:
+        sys.stdout.write(report_json + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Synthetic conversations and embeddings for offline benchmarks
+# Writes the files the pipeline expects under <utility_dir>/folder1/data:
+#   raw_tokenized_train.txt / label_train.txt   - input of PreprocessEngine
+#   tokenized_valid.txt / label_valid.txt
+#   tokenized_test.txt / label_test.txt
+# and a glove pickle (word -> 'v1 v2 ...') covering the synthetic vocab.
+# Every context window is followed by its positive response and num_negatives random responses.
+
+import cPickle
+import os
+
+import numpy as np
+
+from global_module.pre_processing_module.gen_4context_seq import ContextWindowGenerator
+from global_module.settings_module import set_params
+
+
+class SyntheticCorpus:
+    def __init__(self, vocab_size=2000, mean_utt_len=8, max_utt_len=30, min_turns=4, max_turns=12,
+                 num_negatives=5, emb_dim=300, zipf_exponent=1.3, seed=1234, config=None):
+        """
+        :param mean_utt_len: utterance lengths are 1 + Poisson(mean_utt_len - 1), clipped to max_utt_len
+        :param zipf_exponent: word ranks are Zipf distributed, as in natural text
+        """
+        self.vocab_size = vocab_size
+        self.mean_utt_len = mean_utt_len
+        self.max_utt_len = max_utt_len
+        self.min_turns = min_turns
+        self.max_turns = max_turns
+        self.num_negatives = num_negatives
+        self.emb_dim = emb_dim
+        self.zipf_exponent = zipf_exponent
+        self.rng = np.random.RandomState(seed)
+        self.window_generator = ContextWindowGenerator(config if config is not None else set_params.get_params('TR'))
+
+    def word(self, rank):
+        return 'w%d' % rank
+
+    def utterance(self):
+        length = min(1 + self.rng.poisson(self.mean_utt_len - 1), self.max_utt_len)
+        ranks = np.minimum(self.rng.zipf(self.zipf_exponent, size=length), self.vocab_size) - 1
+        return ' '.join([self.word(each_rank) for each_rank in ranks])
+
+    def dialog(self):
+        return [self.utterance() for _ in range(self.rng.randint(self.min_turns, self.max_turns + 1))]
+
+    def write_split(self, data_filename, label_filename, num_dialogs):
+        """
+        :return: number of rows written
+        """
+        dialogs = [self.dialog() for _ in range(num_dialogs)]
+        response_pool = [each_utt for each_dialog in dialogs for each_utt in each_dialog]
+
+        data_file = open(data_filename, 'w')
+        label_file = open(label_filename, 'w')
+        num_rows = 0
+        for each_dialog in dialogs:
+            for window in self.window_generator.iter_windows(each_dialog):
+                context = '\t'.join(window[:-1])
+                data_file.write(context + '\t' + window[-1] + '\n')
+                label_file.write('1\n')
+                for each_neg in self.rng.randint(len(response_pool), size=self.num_negatives):
+                    data_file.write(context + '\t' + response_pool[each_neg] + '\n')
+                    label_file.write('0\n')
+                num_rows += 1 + self.num_negatives
+        data_file.close()
+        label_file.close()
+        return num_rows
+
+    def write_glove(self, glove_path):
+        glove_dict = {}
+        for word in [self.word(each_rank) for each_rank in range(self.vocab_size)] + ['the', 'UNK']:
+            glove_dict[word] = ' '.join(['%.6f' % value for value in self.rng.uniform(-0.9, 0.9, size=self.emb_dim)])
+        glove_file = open(glove_path, 'wb')
+        cPickle.dump(glove_dict, glove_file, protocol=cPickle.HIGHEST_PROTOCOL)
+        glove_file.close()
+
+    def write(self, utility_dir, glove_path, train_dialogs=200, valid_dialogs=40, test_dialogs=40):
+        """
+        Writes a complete synthetic dataset; point SMN_UTILITY_DIR and SMN_GLOVE_PATH at the same paths to use it.
+        :return: dict of rows per split
+        """
+        data_path = utility_dir + '/folder1/data'
+        if not os.path.exists(data_path):
+            os.makedirs(data_path)
+
+        self.write_glove(glove_path)
+        return {'train': self.write_split(data_path + '/raw_tokenized_train.txt', data_path + '/label_train.txt', train_dialogs),
+                'valid': self.write_split(data_path + '/tokenized_valid.txt', data_path + '/label_valid.txt', valid_dialogs),
+                'test': self.write_split(data_path + '/tokenized_test.txt', data_path + '/label_test.txt', test_dialogs)}
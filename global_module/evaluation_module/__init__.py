@@ -0,0 +1 @@
+from calculate_accuracy import RankingEvaluator, ranking_metrics
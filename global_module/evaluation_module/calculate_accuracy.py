@@ -1,77 +1,332 @@
+# Ranking evaluation of test scores
+# Rows are (context, candidate response) pairs, label 1 marks the correct responses. Consecutive rows with the same
+# context form a group of any size; metrics are computed per group and averaged over groups with a positive:
+#   R@k - fraction of the positives of a group ranked in its top k (R_N@k for groups of N candidates)
+#   MRR - reciprocal rank of the best ranked positive
+#   MAP - mean over positives of the precision at their rank
+# Ties are broken pessimistically, negatives rank before positives of the same score.
+
+import itertools
+import json
 import sys
-from global_module.settings_module import set_dir
-
-# root_folder =
-
-dir_obj = set_dir.Directory('TE')
-cost_file = open(dir_obj.test_cost_path, 'r')
-output = open(dir_obj.test_pred_path, 'w')
-output_seq = open(dir_obj.test_seq_op_path, 'w')
-
-test_seq_file = open(dir_obj.data_filename, 'r')
-
-count_iter = 1
-min_pos = -1
-step_val = 6
-pred_ans = ''
-pred_goal = ''
-pred_slot = ''
-multiplier = -1.0 # if probability, 1.0 if cost
-
-min_cost = sys.float_info.max
-for costLine, pred_line in zip(cost_file, test_seq_file):
-    costLine = costLine.rstrip()
-    ans = pred_line.rstrip()
-
-    cost = multiplier * float(costLine)
-    if (count_iter < step_val):
-        if (min_cost > cost):
-            min_cost = cost
-            min_pos = count_iter
-            pred_ans = ans
-        count_iter += 1
+import time
+
+import numpy as np
+
+from global_module.implementation_module.score_writer import TOP_K_DTYPE, read_scores
+from global_module.settings_module import set_dir, set_params
+
+
+def iter_score_chunks(score_path, chunk_rows):
+    """
+    Streams scores from a .npy file, a raw float32 file (.f32 / .bin) or a text file with one score per line.
+    """
+    if score_path.endswith('.npy'):
+        scores = np.load(score_path, mmap_mode='r')
+    elif score_path.endswith('.f32') or score_path.endswith('.bin'):
+        scores = np.memmap(score_path, dtype=np.float32, mode='r')
     else:
-        if (min_cost > cost):
-            min_pos = step_val
-            pred_ans = ans
-        #print min_cost
-        output.write(str(min_pos) + '\t' + str(min_cost) + "\n")
-        output_seq.write(pred_ans + "\n")
-        count_iter = 1
-        min_cost = sys.float_info.max
-        min_pos = -1
-
-cost_file.close()
-output.close()
-output_seq.close()
-test_seq_file.close()
-
-
-output_seq = open(dir_obj.test_seq_op_path, 'r')
-test_act_file = open(dir_obj.gold_data, 'r')
-unmatched_file = open(dir_obj.output_path + '/unmatched.file', 'w')
-output_seq_info = open(dir_obj.output_path + '/seq_selected_with_info.txt', 'w')
-correct_incorrect_file = open(dir_obj.output_path + '/correct_incorrect.txt', 'w')
-
-total = 0.0
-correct = 0.0
-
-for l1, l2 in zip(output_seq, test_act_file):
-    total += 1
-    l1 = l1.rstrip()
-    l2 = l2.rstrip()
-    if(l1.lower() == l2.lower()):
-        correct += 1
-        output_seq_info.write(l1 + "\t" + "CORRECT" + "\n")
-        correct_incorrect_file.write("correct\n")
+        score_file = open(score_path, 'r')
+        while True:
+            lines = list(itertools.islice(score_file, chunk_rows))
+            if not lines:
+                break
+            yield np.array(lines, dtype=np.float64)
+        score_file.close()
+        return
+
+    for start in range(0, len(scores), chunk_rows):
+        yield np.asarray(scores[start:start + chunk_rows], dtype=np.float64)
+
+
+def iter_label_chunks(label_path, chunk_rows):
+    label_file = open(label_path, 'r')
+    while True:
+        lines = list(itertools.islice(label_file, chunk_rows))
+        if not lines:
+            break
+        yield np.array(lines, dtype=np.int64)
+    label_file.close()
+
+
+def iter_group_starts_by_context(data_path, chunk_rows):
+    """
+    A row starts a group when its context (all fields but the response) differs from the previous row.
+    """
+    data_file = open(data_path, 'r')
+    prev_context = None
+    while True:
+        lines = list(itertools.islice(data_file, chunk_rows))
+        if not lines:
+            break
+        starts = np.zeros(len(lines), dtype=bool)
+        for idx, each_line in enumerate(lines):
+            curr_context = hash(each_line.rstrip('\n').rsplit('\t', 1)[0])
+            starts[idx] = curr_context != prev_context
+            prev_context = curr_context
+        yield starts
+    data_file.close()
+
+
+def iter_group_starts_by_size(group_size, chunk_rows):
+    row_num = 0
+    while True:
+        yield (np.arange(row_num, row_num + chunk_rows) % group_size) == 0
+        row_num += chunk_rows
+
+
+def iter_aligned_chunks(named_chunks, unbounded=()):
+    """
+    Zips chunk streams that must cover the same rows with chunks of the same length.
+    :param named_chunks: list of (name, chunk iterator)
+    :param unbounded: names of endless streams (groups by size), cut to the length of the others
+    :return: generator of chunk tuples; raises ValueError when the streams disagree in length
+    """
+    iterators = [(name, iter(chunks)) for name, chunks in named_chunks]
+    num_bounded = len([name for name, _ in iterators if name not in unbounded])
+    row_num = 0
+    while True:
+        chunks = [(name, next(each_iter, None)) for name, each_iter in iterators]
+        ended = [name for name, chunk in chunks if chunk is None]
+        if ended:
+            if len(ended) < num_bounded:
+                raise ValueError('%s ended after %d rows, before %s' % (', '.join(ended), row_num,
+                                 ', '.join(name for name, chunk in chunks if chunk is not None)))
+            return
+        num_rows = len([chunk for name, chunk in chunks if name not in unbounded][0])
+        chunks = [(name, chunk[:num_rows] if name in unbounded else chunk) for name, chunk in chunks]
+        lengths = ['%s %d' % (name, len(chunk)) for name, chunk in chunks]
+        if any(len(chunk) != num_rows for _, chunk in chunks):
+            raise ValueError('Streams are not aligned at row %d: %s rows' % (row_num, ', '.join(lengths)))
+        row_num += num_rows
+        yield tuple(chunk for _, chunk in chunks)
+
+
+def group_metric_sums(scores, labels, offsets, recall_k):
+    """
+    :param offsets: start row of every group followed by the number of rows, group i spans offsets[i]:offsets[i + 1]
+    :return: dict of metric sums over the groups with a positive (key 'groups' counts them), and the per-group
+             (1-based position of the best scored row, its score) arrays
+    """
+    num_groups = len(offsets) - 1
+    sizes = np.diff(offsets)
+    group_ids = np.repeat(np.arange(num_groups), sizes)
+    is_positive = (labels == 1).astype(np.float64)
+
+    order = np.lexsort((is_positive, -scores, group_ids))
+    sorted_groups = group_ids[order]
+    sorted_positive = is_positive[order]
+    rank = np.arange(len(order)) - offsets[sorted_groups] + 1
+
+    num_positive = np.bincount(group_ids, weights=is_positive, minlength=num_groups)
+    has_positive = num_positive > 0
+    safe_num_positive = np.maximum(num_positive, 1.0)
+
+    cum_positive = np.cumsum(sorted_positive)
+    cum_positive -= np.repeat(cum_positive[offsets[:-1]] - sorted_positive[offsets[:-1]], sizes)
+
+    positive_rows = np.flatnonzero(sorted_positive)
+    first_groups, first_idx = np.unique(sorted_groups[positive_rows], return_index=True)
+    reciprocal_rank = np.zeros(num_groups)
+    reciprocal_rank[first_groups] = 1.0 / rank[positive_rows[first_idx]]
+
+    average_precision = np.bincount(sorted_groups[positive_rows],
+                                    weights=cum_positive[positive_rows] / rank[positive_rows],
+                                    minlength=num_groups) / safe_num_positive
+
+    sums = {'groups': float(has_positive.sum()),
+            'candidates': float(sizes[has_positive].sum()),
+            'mrr': float(reciprocal_rank[has_positive].sum()),
+            'map': float(average_precision[has_positive].sum())}
+    for k in recall_k:
+        hits = np.bincount(sorted_groups, weights=sorted_positive * (rank <= k), minlength=num_groups)
+        sums['r%d' % k] = float((hits / safe_num_positive)[has_positive].sum())
+
+    best_rows = order[offsets[:-1]]
+    return sums, best_rows - offsets[:-1] + 1, scores[best_rows]
+
+
+def ranking_metrics(scores, labels, offsets, recall_k=(1, 2, 5)):
+    """
+    In-memory evaluation of scores grouped by offsets.
+    :return: dict with mrr, map, r<k> averaged over the groups with a positive
+    """
+    sums, _, _ = group_metric_sums(np.asarray(scores, dtype=np.float64), np.asarray(labels),
+                                   np.asarray(offsets, dtype=np.int64), recall_k)
+    return dict((key, value / max(sums['groups'], 1.0)) for key, value in sums.iteritems() if key not in ('groups', 'candidates'))
+
+
+class RankingEvaluator:
+    def __init__(self, recall_k=None, chunk_rows=1000000):
+        self.recall_k = recall_k if recall_k is not None else set_params.get_params('TE').recall_k
+        self.chunk_rows = chunk_rows
+
+    def evaluate(self, score_path, label_path, data_path=None, group_size=None, pred_path=None):
+        """
+        Streams scores and labels in chunks of complete groups.
+        :param data_path: data file whose contexts delimit the groups, used when group_size is None
+        :param pred_path: optional output with (position of the best scored candidate, its score, correct) per group
+        :return: dict of averaged metrics with 'groups' and 'candidates' counts
+        """
+        start_time = time.time()
+        if group_size is not None:
+            start_chunks = iter_group_starts_by_size(group_size, self.chunk_rows)
+        else:
+            start_chunks = iter_group_starts_by_context(data_path, self.chunk_rows)
+
+        pred_file = open(pred_path, 'w') if pred_path is not None else None
+        totals = {}
+        carry = (np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
+
+        streams = [('scores', iter_score_chunks(score_path, self.chunk_rows)),
+                   ('labels', iter_label_chunks(label_path, self.chunk_rows)),
+                   ('groups', start_chunks)]
+        for chunks in iter_aligned_chunks(streams, unbounded=('groups',) if group_size is not None else ()):
+            scores, labels, starts = [np.concatenate([carried, chunk]) for carried, chunk in zip(carry, chunks)]
+            group_starts = np.flatnonzero(starts)
+            # the last group may continue in the next chunk
+            complete_rows = group_starts[-1] if len(group_starts) > 0 else 0
+            self.accumulate(totals, pred_file, scores[:complete_rows], labels[:complete_rows], starts[:complete_rows])
+            carry = (scores[complete_rows:], labels[complete_rows:], starts[complete_rows:])
+
+        self.accumulate(totals, pred_file, *carry)
+        if pred_file is not None:
+            pred_file.close()
+
+        num_groups = totals.get('groups', 0.0)
+        metrics = dict((key, value / max(num_groups, 1.0)) for key, value in totals.iteritems() if key not in ('groups', 'candidates'))
+        metrics['groups'] = int(num_groups)
+        metrics['candidates'] = totals.get('candidates', 0.0) / max(num_groups, 1.0)
+        print('Evaluated %d groups (%.1f candidates on average) in %.1f sec' % (metrics['groups'], metrics['candidates'], time.time() - start_time))
+        return metrics
+
+    def evaluate_top_k(self, top_k_path, label_path, data_path=None, group_size=None, pred_path=None):
+        """
+        Evaluates the (group, row, score) records of a ScoreWriter with top_k: the k best candidates per group.
+        A positive ranked below the top k counts as missed, so MRR and MAP are lower bounds and R@k is only
+        reported for k <= top_k. Ties keep the order of the records.
+        :return: dict of averaged metrics with 'groups' and 'candidates' counts
+        """
+        start_time = time.time()
+        records = read_scores(top_k_path)
+        if records.dtype != TOP_K_DTYPE:
+            raise ValueError('%s holds plain scores, not top-k records' % top_k_path)
+        top_k = json.load(open(top_k_path + '.json', 'r'))['top_k']
+        if group_size is not None:
+            start_chunks = iter_group_starts_by_size(group_size, self.chunk_rows)
+        else:
+            start_chunks = iter_group_starts_by_context(data_path, self.chunk_rows)
+
+        # one pass over labels and groups: positives per group and the positive rows
+        num_groups = int(records['group'][-1]) + 1 if len(records) else 0
+        num_positive = np.zeros(num_groups)
+        group_sizes = np.zeros(num_groups)
+        positive_rows = []
+        last_group = -1
+        row_num = 0
+        streams = [('labels', iter_label_chunks(label_path, self.chunk_rows)), ('groups', start_chunks)]
+        for label_chunk, start_chunk in iter_aligned_chunks(streams, unbounded=('groups',) if group_size is not None else ()):
+            group_ids = last_group + np.cumsum(start_chunk)
+            if len(group_ids) and group_ids[-1] >= num_groups:
+                raise ValueError('%s has fewer groups than %s' % (top_k_path, label_path))
+            if len(group_ids):
+                first_group = group_ids[0]
+                curr_sizes = np.bincount(group_ids - first_group)
+                group_sizes[first_group:first_group + len(curr_sizes)] += curr_sizes
+                curr_positive = np.bincount(group_ids - first_group, weights=(label_chunk == 1))
+                num_positive[first_group:first_group + len(curr_positive)] += curr_positive
+            positive_rows.append(np.flatnonzero(label_chunk == 1) + row_num)
+            last_group = group_ids[-1] if len(group_ids) else last_group
+            row_num += len(label_chunk)
+        if last_group + 1 != num_groups:
+            raise ValueError('%s has %d groups, the labels %d' % (top_k_path, num_groups, last_group + 1))
+        positive_rows = np.concatenate(positive_rows) if positive_rows else np.zeros(0, dtype=np.int64)
+
+        group_ids = records['group']
+        is_positive = np.in1d(records['row'], positive_rows).astype(np.float64)
+        group_first = np.searchsorted(group_ids, np.arange(num_groups))
+        rank = np.arange(len(records)) - group_first[group_ids] + 1
+        has_positive = num_positive > 0
+        safe_num_positive = np.maximum(num_positive, 1.0)
+
+        cum_positive = np.cumsum(is_positive)
+        cum_positive -= np.repeat(cum_positive[group_first] - is_positive[group_first], np.bincount(group_ids, minlength=num_groups))
+        positive_idx = np.flatnonzero(is_positive)
+        first_groups, first_idx = np.unique(group_ids[positive_idx], return_index=True)
+        reciprocal_rank = np.zeros(num_groups)
+        reciprocal_rank[first_groups] = 1.0 / rank[positive_idx[first_idx]]
+        average_precision = np.bincount(group_ids[positive_idx], weights=cum_positive[positive_idx] / rank[positive_idx],
+                                        minlength=num_groups) / safe_num_positive
+
+        num_with_positive = max(float(has_positive.sum()), 1.0)
+        metrics = {'mrr': reciprocal_rank[has_positive].sum() / num_with_positive,
+                   'map': average_precision[has_positive].sum() / num_with_positive,
+                   'groups': int(has_positive.sum()),
+                   'candidates': group_sizes[has_positive].sum() / num_with_positive}
+        for k in self.recall_k:
+            if k > top_k:
+                print('R@%d needs more than the top %d candidates kept per group, skipped' % (k, top_k))
+                continue
+            hits = np.bincount(group_ids, weights=is_positive * (rank <= k), minlength=num_groups)
+            metrics['r%d' % k] = (hits / safe_num_positive)[has_positive].sum() / num_with_positive
+
+        if pred_path is not None:
+            pred_file = open(pred_path, 'w')
+            best = records[group_first]
+            group_start_rows = np.concatenate([[0], np.cumsum(group_sizes)[:-1]]).astype(np.int64)
+            pred_file.write(''.join(['%d\t%s\t%s\n' % (row - start_row + 1, repr(float(score)), 'CORRECT' if is_correct else 'INCORRECT')
+                                     for row, start_row, score, is_correct in zip(best['row'], group_start_rows, best['score'],
+                                                                                  is_positive[group_first] == 1)]))
+            pred_file.close()
+
+        print('Evaluated %d groups (%.1f candidates on average, top %d kept) in %.1f sec'
+              % (metrics['groups'], metrics['candidates'], top_k, time.time() - start_time))
+        return metrics
+
+    def accumulate(self, totals, pred_file, scores, labels, starts):
+        if len(scores) == 0:
+            return
+        starts[0] = True
+        offsets = np.append(np.flatnonzero(starts), len(scores))
+        sums, best_position, best_score = group_metric_sums(scores, labels, offsets, self.recall_k)
+        for key, value in sums.iteritems():
+            totals[key] = totals.get(key, 0.0) + value
+
+        if pred_file is not None:
+            correct = labels[offsets[:-1] + best_position - 1] == 1
+            pred_file.write(''.join(['%d\t%s\t%s\n' % (position, repr(score), 'CORRECT' if is_correct else 'INCORRECT')
+                                     for position, score, is_correct in zip(best_position, best_score, correct)]))
+
+    def print_metrics(self, metrics):
+        print('MRR: %.4f, MAP: %.4f, ' % (metrics['mrr'], metrics['map']) +
+              ', '.join(['R@%d: %.4f' % (k, metrics['r%d' % k]) for k in self.recall_k if 'r%d' % k in metrics]))
+
+    def util(self):
+        dir_obj = set_dir.Directory('TE')
+        params = set_params.get_params('TE')
+        if params.score_output != 'text' and params.score_top_k is not None:
+            metrics = self.evaluate_top_k(dir_obj.test_top_k_path, dir_obj.label_filename, data_path=dir_obj.data_filename,
+                                          pred_path=dir_obj.test_pred_path)
+        else:
+            score_path = dir_obj.test_cost_path if params.score_output == 'text' else dir_obj.test_score_path
+            metrics = self.evaluate(score_path, dir_obj.label_filename, data_path=dir_obj.data_filename,
+                                    pred_path=dir_obj.test_pred_path)
+        self.print_metrics(metrics)
+        return metrics
+
+
+def main():
+    """
+    calculate_accuracy.py [score_path label_path (data_path | group_size)], defaults to the test output
+    """
+    evaluator = RankingEvaluator()
+    if len(sys.argv) < 4:
+        evaluator.util()
+    elif sys.argv[3].isdigit():
+        evaluator.print_metrics(evaluator.evaluate(sys.argv[1], sys.argv[2], group_size=int(sys.argv[3])))
     else:
-        output_seq_info.write(l1 + "\t" + "INCORRECT" + "\n")
-        unmatched_file.write(str(int(total)) + "\t" + "==PREDICTED==\t" + l1.split("\t")[-1] + "\t" + "==CORRECT==\t" + l2.split("\t")[-1] + "\n")
-        correct_incorrect_file.write("incorrect\n")
-
-print(correct, total)
-output_seq.close()
-output_seq_info.close()
-test_act_file.close()
-unmatched_file.close()
-correct_incorrect_file.close()
+        evaluator.print_metrics(evaluator.evaluate(sys.argv[1], sys.argv[2], data_path=sys.argv[3]))
+
+
+if __name__ == '__main__':
+    main()
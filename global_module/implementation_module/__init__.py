@@ -1,4 +1,9 @@
 from model import SMN
 from reader import DataReader
+from score_writer import ScoreWriter
+from session_scorer import SessionGraph, SessionScorer, bank_fingerprint, create_session_scorer
+from memory_tracker import MemoryTracker, MemoryBudgetExceeded, peak_bytes_from_run_metadata
+from validation_policy import ValidationPolicy
+from grow_embedding import grow_word_embedding
 from test import Test
-from train import Train
\ No newline at end of file
+from train import Train
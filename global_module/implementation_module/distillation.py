@@ -0,0 +1,91 @@
+import numpy as np
+import tensorflow as tf
+
+from global_module.implementation_module.model import SMN
+from global_module.implementation_module.reader import DataReader
+from global_module.implementation_module.score_writer import ScoreWriter, read_scores
+from global_module.settings_module import Directory, artifact_cache, get_params
+
+
+def student_params(params):
+    """
+    :return: student config: params with the distill_student overrides
+    """
+    return params.replace(**params.distill_student)
+
+
+def project_embedding(word_emb_matrix, emb_dim):
+    """
+    Initial student embedding: the (glove) embedding projected on its emb_dim principal directions.
+    Row 0 (padding) stays zero.
+    """
+    if emb_dim == word_emb_matrix.shape[1]:
+        return word_emb_matrix
+    centered = word_emb_matrix - word_emb_matrix[1:].mean(axis=0)
+    _, _, components = np.linalg.svd(centered[1:], full_matrices=False)
+    projected = centered.dot(components[:emb_dim].T).astype(np.float32)
+    projected[0] = 0.0
+    return projected
+
+
+def iter_split_logits(session, model_obj, dir_obj, dict_obj, num_rows, dataset=None):
+    """
+    Utility function to run a model over every row of a split in file order. The last batch is filled up with
+    leading rows, whose logits are dropped.
+    :return: generator of ([rows, num_classes] logits, batch) per batch
+    """
+    batch_size = model_obj.params.batch_size
+    index_arr = np.concatenate([np.arange(num_rows), np.arange((-num_rows) % batch_size) % num_rows])
+    row = 0
+    for batch in DataReader(model_obj.params).batch_iterator(dir_obj, index_arr, dict_obj, dataset):
+        num_kept = min(batch_size, num_rows - row)
+        logits = session.run(model_obj.logits, feed_dict=model_obj.get_feed_dict(batch))
+        yield logits[:num_kept], [each_arr[:num_kept] for each_arr in batch]
+        row += num_kept
+
+
+def teacher_fingerprint(teacher_params, dir_obj):
+    model_dir = Directory('TE')
+    return artifact_cache.combine(teacher_params.model_fingerprint(), artifact_cache.file_signature(model_dir.test_model + '.index'),
+                                      artifact_cache.file_digest(dir_obj.data_filename))
+
+
+def compute_teacher_scores(teacher_params, dir_obj, dict_obj, num_rows, dataset=None):
+    """
+    Scores every row of the split of dir_obj with the test model (the teacher) and streams its log-odds to
+    dir_obj.teacher_score_path.
+    """
+    model_dir = Directory('TE')
+    print('Computing teacher scores of %s with %s' % (dir_obj.data_filename, model_dir.test_model))
+    with tf.Graph().as_default(), tf.Session() as session:
+        with tf.variable_scope('classifier', reuse=None):
+            teacher_obj = SMN(teacher_params, dir_obj)
+        artifact_cache.check_checkpoint(model_dir.test_model, teacher_params.model_fingerprint())
+        tf.train.Saver().restore(session, model_dir.test_model)
+
+        score_writer = ScoreWriter(dir_obj.teacher_score_path, 'binary', teacher_params.score_flush_rows)
+        for logits, _ in iter_split_logits(session, teacher_obj, dir_obj, dict_obj, num_rows, dataset):
+            score_writer.write(logits[:, 1] - logits[:, 0])
+        score_writer.close()
+
+
+def load_teacher_scores(dir_obj, dict_obj, num_rows, dataset=None):
+    """
+    Teacher log-odds of every row of a split, computed once per teacher checkpoint and data file.
+    :return: memory-mapped float32 scores
+    """
+    teacher_params = get_params('TE').replace(embedding_compression=None)
+    teacher_params.num_classes = len(dict_obj.label_dict)
+    teacher_params.vocab_size = len(dict_obj.glove_present_word_csv)
+    if teacher_params.num_classes != 2:
+        raise ValueError('Distillation expects binary labels, found %d classes' % teacher_params.num_classes)
+
+    fingerprint = teacher_fingerprint(teacher_params, dir_obj)
+    if not artifact_cache.is_fresh(dir_obj.teacher_score_path, fingerprint):
+        compute_teacher_scores(teacher_params, dir_obj, dict_obj, num_rows, dataset)
+        artifact_cache.mark(dir_obj.teacher_score_path, fingerprint)
+
+    teacher_scores = read_scores(dir_obj.teacher_score_path)
+    if len(teacher_scores) != num_rows:
+        raise ValueError('%s holds %d scores for %d rows' % (dir_obj.teacher_score_path, len(teacher_scores), num_rows))
+    return teacher_scores
@@ -0,0 +1,141 @@
+import glob
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.implementation_module.grow_embedding import EMBEDDING_NAME
+from global_module.settings_module import artifact_cache
+
+EMBEDDING_SCOPE = EMBEDDING_NAME.rsplit('/', 1)[0]
+TRAIN_SCOPE = 'classifier/train/'  # learning rate and optimizer slots, only built by the TR graph
+
+
+def fit_product_quantizer(matrix, num_subspaces, num_centroids=256, iterations=20, seed=1234, chunk_rows=65536):
+    """
+    k-means per subspace: every row is split into num_subspaces equal slices, each slice is replaced by the
+    nearest of num_centroids centroids of its subspace.
+    :return: dict with 'codebooks' [subspaces, centroids, sub_dim] float32 and 'codes' [rows, subspaces] uint8
+    """
+    num_rows, emb_dim = matrix.shape
+    if emb_dim % num_subspaces != 0:
+        raise ValueError('EMB_DIM %d is not divisible into %d subspaces' % (emb_dim, num_subspaces))
+    if num_centroids > 256:
+        raise ValueError('Codes are stored as uint8, at most 256 centroids per subspace')
+    if num_centroids > num_rows:
+        raise ValueError('%d centroids for a vocabulary of %d words' % (num_centroids, num_rows))
+    sub_dim = emb_dim // num_subspaces
+    rng = np.random.RandomState(seed)
+
+    codebooks = np.zeros((num_subspaces, num_centroids, sub_dim), dtype=np.float32)
+    codes = np.zeros((num_rows, num_subspaces), dtype=np.uint8)
+    for s in range(num_subspaces):
+        sub_matrix = matrix[:, s * sub_dim:(s + 1) * sub_dim].astype(np.float32)
+        centroids = sub_matrix[rng.choice(num_rows, num_centroids, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = nearest_centroids(sub_matrix, centroids, chunk_rows)
+            counts = np.bincount(assignment, minlength=num_centroids)
+            sums = np.stack([np.bincount(assignment, weights=sub_matrix[:, j], minlength=num_centroids)
+                             for j in range(sub_dim)], axis=1)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # empty clusters restart from random rows
+            centroids[empty] = sub_matrix[rng.choice(num_rows, int(empty.sum()))]
+        codebooks[s] = centroids
+        codes[:, s] = nearest_centroids(sub_matrix, centroids, chunk_rows)
+    return {'codebooks': codebooks, 'codes': codes}
+
+
+def nearest_centroids(rows, centroids, chunk_rows):
+    centroid_norm = (centroids ** 2).sum(axis=1)
+    assignment = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        # |x - c|^2 without the |x|^2 term, which does not change the argmin
+        assignment[start:start + chunk_rows] = np.argmin(centroid_norm[None, :] - 2.0 * chunk.dot(centroids.T), axis=1)
+    return assignment
+
+
+def fit_low_rank(matrix, rank):
+    """
+    Truncated SVD: matrix ~= factor . basis
+    :return: dict with 'factor' [rows, rank] and 'basis' [rank, EMB_DIM] float32
+    """
+    left, singular, right = np.linalg.svd(matrix.astype(np.float32), full_matrices=False)
+    return {'factor': (left[:, :rank] * singular[:rank]).astype(np.float32),
+            'basis': right[:rank].astype(np.float32)}
+
+
+def decode(compressed, ids=None):
+    """
+    numpy counterpart of SMN.lookup_word_embedding
+    :return: decoded rows of ids (all rows if None)
+    """
+    if 'codes' in compressed:
+        codes = compressed['codes'] if ids is None else compressed['codes'][ids]
+        codebooks = compressed['codebooks']
+        num_subspaces = codebooks.shape[0]
+        return np.concatenate([codebooks[s][codes[:, s]] for s in range(num_subspaces)], axis=1)
+    factor = compressed['factor'] if ids is None else compressed['factor'][ids]
+    return factor.dot(compressed['basis'])
+
+
+def compress(matrix, params):
+    """
+    :return: compressed arrays of matrix with the method and sizes of params
+    """
+    if params.embedding_compression == 'pq':
+        return fit_product_quantizer(matrix, params.pq_subspaces, params.pq_centroids, params.pq_iterations)
+    elif params.embedding_compression == 'low_rank':
+        return fit_low_rank(matrix, params.low_rank_dim)
+    raise ValueError('Unknown embedding_compression %r' % params.embedding_compression)
+
+
+def reconstruction_report(matrix, compressed):
+    """
+    :return: dict with relative Frobenius error, mean row cosine similarity and dense / compressed sizes in MB
+    """
+    reconstructed = decode(compressed)
+    row_norm = np.linalg.norm(matrix, axis=1) * np.linalg.norm(reconstructed, axis=1)
+    nonzero = row_norm > 0
+    cosine = (matrix * reconstructed).sum(axis=1)[nonzero] / row_norm[nonzero]
+    return {'relative_error': float(np.linalg.norm(matrix - reconstructed) / max(np.linalg.norm(matrix), 1e-12)),
+            'mean_cosine': float(cosine.mean()) if len(cosine) else 1.0,
+            'dense_mb': matrix.astype(np.float32).nbytes / 2.0 ** 20,
+            'compressed_mb': sum(each_arr.nbytes for each_arr in compressed.values()) / 2.0 ** 20}
+
+
+def checkpoint_mb(checkpoint_path):
+    return sum(os.path.getsize(path) for path in glob.glob(checkpoint_path + '.*')
+               if not path.endswith(artifact_cache.SIDECAR_SUFFIX)) / 2.0 ** 20
+
+
+def write_compressed_checkpoint(checkpoint_path, output_path, compressed, fingerprint=None):
+    """
+    Writes the inference checkpoint: the model variables of checkpoint_path without the dense word embedding and
+    without any training state (optimizer slots would keep vocab_size x EMB_DIM copies of the embedding), plus the
+    compressed arrays as variables of the embedding scope.
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    with tf.Graph().as_default(), tf.Session() as session:
+        var_dict = {}
+        values = {}
+        for name in reader.get_variable_to_shape_map():
+            if EMBEDDING_NAME in name or name.startswith(TRAIN_SCOPE):
+                continue
+            values[name] = reader.get_tensor(name)
+        for key, value in compressed.items():
+            values[EMBEDDING_SCOPE + '/word_emb_' + key] = value
+
+        for name, value in values.items():
+            var_dict[name] = tf.Variable(tf.zeros(value.shape, dtype=tf.as_dtype(value.dtype)), name='compressed_%d' % len(var_dict))
+        session.run(tf.global_variables_initializer())
+        for name, var in var_dict.items():
+            var.load(values[name], session)
+
+        tf.train.Saver(var_dict).save(session, output_path, write_meta_graph=False)
+
+    if fingerprint is not None:
+        artifact_cache.mark(output_path, fingerprint)
+    print('Wrote compressed inference checkpoint %s: %.1f MB (%.1f MB before)'
+          % (output_path, checkpoint_mb(output_path), checkpoint_mb(checkpoint_path)))
@@ -0,0 +1,63 @@
+import numpy as np
+import tensorflow as tf
+
+EMBEDDING_NAME = 'classifier/emb_lookup/word_embedding_matrix'
+# initial slot values of the repo's optimizers (see SMN.train), every other slot starts at zero
+SLOT_INIT = {'adagrad': 0.1}
+
+
+def embedding_slot(name):
+    """
+    Optimizer slots of the embedding are saved as <optimizer scope>/<EMBEDDING_NAME>/<slot>,
+    e.g. classifier/train/optimize/classifier/emb_lookup/word_embedding_matrix/adam_1
+    :return: slot name ('adam_1'), None for any other variable
+    """
+    if (EMBEDDING_NAME + '/') not in name:
+        return None
+    return name.split(EMBEDDING_NAME + '/', 1)[1]
+
+
+def grow_word_embedding(checkpoint_path, new_rows):
+    """
+    Appends rows to the word embedding of an existing checkpoint and rewrites it in place.
+    Optimizer slots of the embedding (e.g. .../word_embedding_matrix/adam) grow with their initial value.
+    :param checkpoint_path: checkpoint prefix, e.g. models/cnn_classifier.ckpt
+    :param new_rows: float array [num_new_words, EMB_DIM]
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    new_rows = np.asarray(new_rows, dtype=np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        var_dict = {}
+        values = {}
+        for name, shape in reader.get_variable_to_shape_map().items():
+            value = reader.get_tensor(name)
+            if name == EMBEDDING_NAME:
+                value = np.concatenate([value, new_rows], axis=0)
+            elif embedding_slot(name) is not None:
+                slot_init = SLOT_INIT.get(embedding_slot(name), 0.0)
+                value = np.concatenate([value, np.full([len(new_rows)] + list(shape[1:]), slot_init, dtype=value.dtype)], axis=0)
+            var_dict[name] = tf.Variable(tf.zeros(value.shape, dtype=tf.as_dtype(value.dtype)), name='grow_%d' % len(var_dict))
+            values[name] = value
+
+        session.run(tf.global_variables_initializer())
+        for name, var in var_dict.items():
+            var.load(values[name], session)
+
+        tf.train.Saver(var_dict).save(session, checkpoint_path, write_meta_graph=False)
+
+    check_embedding_rows(checkpoint_path)
+    print('Grew %s by %d rows in %s' % (EMBEDDING_NAME, len(new_rows), checkpoint_path))
+
+
+def check_embedding_rows(checkpoint_path):
+    """
+    Fails when an optimizer slot of the embedding does not have the rows of the embedding, which would
+    only show up as an Assign shape error when the checkpoint is restored.
+    """
+    shapes = tf.train.NewCheckpointReader(checkpoint_path).get_variable_to_shape_map()
+    num_rows = shapes[EMBEDDING_NAME][0]
+    mismatched = ['%s %s' % (name, shape) for name, shape in shapes.items()
+                  if embedding_slot(name) is not None and shape[0] != num_rows]
+    if mismatched:
+        raise ValueError('Embedding slots of %s do not match its %d rows: %s' % (checkpoint_path, num_rows, ', '.join(mismatched)))
@@ -0,0 +1,166 @@
+import gc
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def peak_bytes_from_run_metadata(run_metadata):
+    """
+    Utility function to extract the allocator peak of a traced session.run
+    :param run_metadata: tf.RunMetadata filled with FULL_TRACE
+    :return: peak allocated bytes over all devices
+    """
+    peak_bytes = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for each_memory in node_stats.memory:
+                peak_bytes = max(peak_bytes, each_memory.peak_bytes, each_memory.allocator_bytes_in_use)
+    return peak_bytes
+
+
+def read_proc_status(field):
+    """
+    :return: value of a /proc/self/status field (VmRSS, VmHWM) in bytes, None where /proc is unavailable
+    """
+    try:
+        status_file = open('/proc/self/status', 'r')
+    except IOError:
+        return None
+    for line in status_file:
+        if line.startswith(field + ':'):
+            status_file.close()
+            return int(line.split()[1]) * 1024
+    status_file.close()
+    return None
+
+
+def max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class MemoryTracker:
+    def __init__(self, enabled=True, budget_mb=None):
+        """
+        Records RSS, peak RSS and heap deltas around pipeline stages, and TF allocator peaks of traced runs.
+        The heap is the tracemalloc total where available (Python 3), else the VmData size of the process
+        (Python 2.7 has no tracemalloc; VmData also counts native allocations such as TF buffers).
+        :param enabled: record stages and write the summary
+        :param budget_mb: raise MemoryBudgetExceeded as soon as RSS is found above this many MB, also when not enabled
+        """
+        self.enabled = enabled
+        self.budget_bytes = budget_mb * 2 ** 20 if budget_mb is not None else None
+        self.records = OrderedDict()
+        self.open_stages = []
+        if enabled and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def rss_bytes(self):
+        rss = read_proc_status('VmRSS')
+        return rss if rss is not None else max_rss_bytes()
+
+    def reset_peak(self):
+        # Linux >= 4.0 resets VmHWM to the current RSS, elsewhere the peak stays process-wide
+        try:
+            clear_refs = open('/proc/self/clear_refs', 'w')
+            clear_refs.write('5')
+            clear_refs.close()
+        except IOError:
+            pass
+
+    def heap_bytes(self):
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return read_proc_status('VmData')
+
+    def begin(self, name):
+        if not self.enabled:
+            # the stage name is still needed for budget errors
+            self.open_stages.append((name, None, None, None))
+            return
+        gc.collect()
+        self.reset_peak()
+        self.open_stages.append((name, time.time(), self.rss_bytes(), self.heap_bytes()))
+
+    def end(self):
+        name, start_time, rss_before, heap_before = self.open_stages.pop()
+        if not self.enabled:
+            self.check(name)
+            return
+        rss_after = self.rss_bytes()
+        heap_after = self.heap_bytes()
+        peak = read_proc_status('VmHWM')
+        record = self.records.setdefault(name, {'tf_peak': None})
+        record.update({'seconds': time.time() - start_time,
+                       'rss_before': rss_before,
+                       'rss_after': rss_after,
+                       'peak': peak if peak is not None else max_rss_bytes(),
+                       'heap_delta': heap_after - heap_before if heap_before is not None and heap_after is not None else None})
+        self.check(name)
+
+    @contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def check(self, name=None):
+        """
+        Fails fast when RSS exceeds the budget.
+        """
+        if self.budget_bytes is None:
+            return
+        rss = self.rss_bytes()
+        if rss > self.budget_bytes:
+            name = name or (self.open_stages[-1][0] if self.open_stages else 'unknown stage')
+            raise MemoryBudgetExceeded('RSS %.1f MB exceeds the memory budget of %.1f MB during %s'
+                                       % (rss / 2.0 ** 20, self.budget_bytes / 2.0 ** 20, name))
+
+    def record_run_metadata(self, run_metadata, name=None):
+        """
+        Keeps the largest TF allocator peak seen in the given (or current) stage.
+        """
+        if not self.enabled:
+            return
+        name = name or (self.open_stages[-1][0] if self.open_stages else 'session_run')
+        record = self.records.setdefault(name, {'tf_peak': None})
+        record['tf_peak'] = max(record['tf_peak'] or 0, peak_bytes_from_run_metadata(run_metadata))
+
+    def summary(self):
+        def to_mb(value, signed=False):
+            if value is None:
+                return '-'
+            return ('%+.1f' if signed else '%.1f') % (value / 2.0 ** 20)
+
+        lines = ['%-28s %9s %10s %10s %10s %10s %10s' % ('stage', 'sec', 'rss MB', 'delta MB', 'peak MB', 'heap MB', 'tf peak MB')]
+        for name, record in self.records.items():
+            if 'seconds' not in record:
+                continue
+            lines.append('%-28s %9.1f %10s %10s %10s %10s %10s' % (name, record['seconds'], to_mb(record['rss_after']),
+                                                                   to_mb(record['rss_after'] - record['rss_before'], True),
+                                                                   to_mb(record['peak']), to_mb(record['heap_delta'], True),
+                                                                   to_mb(record['tf_peak'])))
+        return '\n'.join(lines)
+
+    def write_summary(self, path=None):
+        if not self.enabled or not self.records:
+            return
+        summary = self.summary()
+        print('\n' + summary)
+        if path is not None:
+            summary_file = open(path, 'w')
+            summary_file.write(summary + '\n')
+            summary_file.close()
@@ -1,5 +1,6 @@
 import tensorflow as tf
 
+from global_module.implementation_module.reader import share_context_utterances
 from global_module.settings_module import ParamsClass, Directory
 
 
@@ -7,24 +8,173 @@ class SMN:
     def __init__(self, params, dir_obj):
         self.params = params
         self.dir_obj = dir_obj
+        self.in_batch = (params.mode == 'TR' and params.train_mode == 'in_batch')
+        self.is_distilled = (params.mode == 'TR' and params.distillation)
+        if params.shared_ctx_encoding and params.keep_prob < 1.0:
+            # an utterance encoded once for all of its windows shares one dropout mask between them,
+            # which changes the gradients of per-window encoding
+            raise ValueError('shared_ctx_encoding needs keep_prob 1.0 in mode %s (found %s)' % (params.mode, params.keep_prob))
         self.init_pipeline()
 
     def init_pipeline(self):
         self.create_placeholders()
         self.extract_word_embedding()
         self.get_initial_hidden_state()
-        word_matching_matrix, hidden_emb_matching_matrix = self.compute_matching_matrix()
-        conv_hidden_output, conv_word_output = self.get_cnn_output(hidden_emb_matching_matrix, word_matching_matrix)
+
+        if self.in_batch:
+            ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb, num_ctx = self.pair_in_batch()
+        else:
+            ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb, num_ctx = \
+                self.ctx_word_emb, self.rnn_ctx_output, self.resp_word_emb, self.rnn_resp_output, self.num_ctx_placeholders
+
+        if self.params.ragged_contexts:
+            conv_hidden_output, conv_word_output = self.get_ragged_cnn_output(ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb, num_ctx)
+        elif self.is_recomputed('match_network') and self.is_recomputed('cnn_network'):
+            conv_hidden_output, conv_word_output = self.get_fused_cnn_output(ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb)
+        else:
+            word_matching_matrix, hidden_emb_matching_matrix = self.compute_matching_matrix(ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb)
+            conv_hidden_output, conv_word_output = self.get_cnn_output(hidden_emb_matching_matrix, word_matching_matrix)
         accumulated_word_match, accumulated_hidden_match = self.get_accumulated_match(conv_word_output, conv_hidden_output)
-        final_hidden_state = self.get_final_hidden_state(accumulated_word_match, accumulated_hidden_match)
-        logits = self.convert_to_logits(final_hidden_state)
-        self.loss, _ = self.compute_loss(logits)
+        final_hidden_state = self.get_final_hidden_state(accumulated_word_match, accumulated_hidden_match, num_ctx)
+        self.logits = self.convert_to_logits(final_hidden_state)
+        self.loss, train_objective = self.compute_loss(self.logits)
 
         if (self.params.mode == 'TR'):
-            self.train(self.loss)
+            self.train(train_objective)
+
+    def get_feed_dict(self, batch):
+        """
+        :param batch: (ctx, ctx_len, num_ctx, resp, resp_len, label[, teacher score]) arrays as yielded by DataReader
+        """
+        ctx_arr, ctx_len_arr, num_ctx_arr, resp_arr, resp_len_arr, label_arr = batch[:6]
+        feed_dict = {self.num_ctx_placeholders: num_ctx_arr,
+                     self.resp: resp_arr,
+                     self.resp_len_placeholders: resp_len_arr,
+                     self.label: label_arr}
+        if self.is_distilled:
+            feed_dict[self.teacher_score] = batch[6]
+
+        if self.params.shared_ctx_encoding:
+            utt_table, utt_len_arr, ctx_utt_idx = share_context_utterances(ctx_arr, ctx_len_arr)
+            feed_dict[self.utt_table] = utt_table
+            feed_dict[self.utt_len_placeholders] = utt_len_arr
+            feed_dict[self.ctx_utt_idx] = ctx_utt_idx
+        else:
+            feed_dict[self.ctx] = ctx_arr
+            feed_dict[self.ctx_len_placeholders] = ctx_len_arr
+        return feed_dict
+
+    def is_recomputed(self, scope_name):
+        return self.params.mode == 'TR' and scope_name in self.params.recompute_scopes
+
+    def maybe_recompute(self, scope_name, fn):
+        """
+        Wraps fn so that its intermediate activations are dropped after the forward pass and recomputed during
+        backprop, if scope_name is listed in params.recompute_scopes.
+        fn must take and return tensors; the variables it uses have to be resource variables created inside it.
+        """
+        if self.is_recomputed(scope_name):
+            return tf.contrib.layers.recompute_grad(fn)
+        return fn
+
+    def resource_scope(self, scope_name):
+        # recompute_grad only tracks resource variables
+        return tf.variable_scope(scope_name, use_resource=True if self.is_recomputed(scope_name) else None)
+
+    def match_and_convolve(self, each_ctx_word, each_ctx_hidden, each_resp_word, each_resp_hidden):
+        """
+        :return: pooled outputs of the word matching matrix (one per filter width), followed by those of the hidden one
+        """
+        with self.resource_scope('match_network'):
+            with tf.variable_scope('word_match'):
+                word_matching_matrix = self.match_word(each_ctx_word, each_resp_word)
+            with tf.variable_scope('hidden_match'):
+                hidden_matching_matrix = self.match_hidden(each_ctx_hidden, each_resp_hidden)
+        with self.resource_scope('cnn_network'):
+            with tf.variable_scope('word_conv'):
+                word_pool_output = self.convolve_context(word_matching_matrix)
+            with tf.variable_scope('hidden_conv'):
+                hidden_pool_output = self.convolve_context(hidden_matching_matrix)
+        return word_pool_output + hidden_pool_output
+
+    def get_fused_cnn_output(self, ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb):
+        """
+        Recomputes matching and convolution of one context as a single unit, so that neither the matching
+        matrices nor the conv activations are kept between forward and backward pass; only pooled features are.
+        """
+        num_layers = len(self.params.filter_width)
+        recomputed_fn = self.maybe_recompute('cnn_network', self.match_and_convolve)
+        ctx_word_emb_split = tf.split(ctx_word_emb, self.params.NUM_CONTEXT, axis=1)
+        ctx_hidden_emb_split = tf.split(ctx_hidden_emb, self.params.NUM_CONTEXT, axis=1)
+
+        conv_word_output = []
+        conv_hidden_output = []
+        for each_ctx_word, each_ctx_hidden in zip(ctx_word_emb_split, ctx_hidden_emb_split):
+            pool_output = recomputed_fn(tf.squeeze(each_ctx_word, axis=1), tf.squeeze(each_ctx_hidden, axis=1), resp_word_emb, resp_hidden_emb)
+            conv_word_output.append(list(pool_output[:num_layers]))
+            conv_hidden_output.append(list(pool_output[num_layers:]))
+
+        print('Matching and convolution with recompute on backward: DONE')
+        return conv_hidden_output, conv_word_output
+
+    def real_context_rows(self, num_ctx):
+        """
+        :return: [M, 2] (row, context slot) of the real contexts; contexts are left-aligned, padding follows num_ctx
+        """
+        return tf.cast(tf.where(tf.sequence_mask(num_ctx, self.params.NUM_CONTEXT)), tf.int32)
+
+    def scatter_contexts(self, context_rows, values, num_rows):
+        """
+        Places per-context values [M, ...] at their rows and slots of a [num_rows, NUM_CONTEXT, ...] tensor, zeros elsewhere.
+        """
+        shape = tf.concat([tf.stack([num_rows, self.params.NUM_CONTEXT]), tf.shape(values)[1:]], axis=0)
+        scattered = tf.scatter_nd(context_rows, values, shape)
+        scattered.set_shape([None, self.params.NUM_CONTEXT] + values.shape.as_list()[1:])
+        return scattered
+
+    def get_ragged_cnn_output(self, ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb, num_ctx):
+        """
+        Matches and convolves only the real contexts, all of them in one pass over [M, ...] tensors,
+        and scatters the pooled features back into per-context lists for the accumulation network.
+        Padded slots get zero features, which the final RNN never reads (its length is num_ctx).
+        """
+        num_layers = len(self.params.filter_width)
+        context_rows = self.real_context_rows(num_ctx)
+        real_ctx_word = tf.gather_nd(ctx_word_emb, context_rows)
+        real_ctx_hidden = tf.gather_nd(ctx_hidden_emb, context_rows)
+        real_resp_word = tf.gather(resp_word_emb, context_rows[:, 0])
+        real_resp_hidden = tf.gather(resp_hidden_emb, context_rows[:, 0])
+
+        if self.is_recomputed('match_network') and self.is_recomputed('cnn_network'):
+            pool_output = self.maybe_recompute('cnn_network', self.match_and_convolve)(real_ctx_word, real_ctx_hidden,
+                                                                                         real_resp_word, real_resp_hidden)
+            word_pool_output, hidden_pool_output = list(pool_output[:num_layers]), list(pool_output[num_layers:])
+        else:
+            with self.resource_scope('match_network'):
+                with tf.variable_scope('word_match'):
+                    word_matching_matrix = self.maybe_recompute('match_network', self.match_word)(real_ctx_word, real_resp_word)
+                with tf.variable_scope('hidden_match'):
+                    hidden_matching_matrix = self.maybe_recompute('match_network', self.match_hidden)(real_ctx_hidden, real_resp_hidden)
+            with self.resource_scope('cnn_network'):
+                convolve_context = self.maybe_recompute('cnn_network', self.convolve_context)
+                with tf.variable_scope('word_conv'):
+                    word_pool_output = list(convolve_context(word_matching_matrix))
+                with tf.variable_scope('hidden_conv'):
+                    hidden_pool_output = list(convolve_context(hidden_matching_matrix))
+
+        num_rows = tf.shape(num_ctx)[0]
+
+        def per_context(pool_outputs):
+            # [filter width][M, ...] -> [context][filter width][num_rows, ...]
+            unstacked = [tf.unstack(self.scatter_contexts(context_rows, each_output, num_rows), self.params.NUM_CONTEXT, axis=1)
+                         for each_output in pool_outputs]
+            return [list(each_ctx) for each_ctx in zip(*unstacked)]
+
+        print('Ragged matching and convolution over real contexts: DONE')
+        return per_context(hidden_pool_output), per_context(word_pool_output)
 
     def get_cnn_output(self, hidden_emb_matching_matrix, word_matching_matrix):
-        with tf.variable_scope('cnn_network'):
+        with self.resource_scope('cnn_network'):
             conv_word_output = self.conv_pipeline_init(word_matching_matrix, 'word_conv')
             conv_hidden_output = self.conv_pipeline_init(hidden_emb_matching_matrix, 'hidden_conv')
             return conv_hidden_output, conv_word_output
@@ -36,15 +186,32 @@ class SMN:
 
     def create_placeholders(self):
         with tf.variable_scope('placeholder'):
-            self.ctx = tf.placeholder(dtype=tf.int32,
-                                      shape=[None,
-                                             self.params.NUM_CONTEXT,
-                                             self.params.MAX_CTX_UTT_LENGTH],
-                                      name='ctx_placeholder')
+            if self.params.shared_ctx_encoding:
+                # distinct context utterances of the batch, and per window the row of each of its contexts
+                self.utt_table = tf.placeholder(dtype=tf.int32,
+                                                shape=[None, self.params.MAX_CTX_UTT_LENGTH],
+                                                name='utt_table_placeholder')
+
+                self.utt_len_placeholders = tf.placeholder(dtype=tf.int32,
+                                                           shape=[None],
+                                                           name='utt_len_placeholder')
+
+                self.ctx_utt_idx = tf.placeholder(dtype=tf.int32,
+                                                  shape=[None, self.params.NUM_CONTEXT],
+                                                  name='ctx_utt_idx_placeholder')
+
+                self.ctx = tf.gather(self.utt_table, self.ctx_utt_idx, name='ctx_placeholder')
+                self.ctx_len_placeholders = tf.gather(self.utt_len_placeholders, self.ctx_utt_idx, name='ctx_len_placeholder')
+            else:
+                self.ctx = tf.placeholder(dtype=tf.int32,
+                                          shape=[None,
+                                                 self.params.NUM_CONTEXT,
+                                                 self.params.MAX_CTX_UTT_LENGTH],
+                                          name='ctx_placeholder')
 
-            self.ctx_len_placeholders = tf.placeholder(dtype=tf.int32,
-                                                       shape=[None, self.params.NUM_CONTEXT],
-                                                       name='ctx_len_placeholder')
+                self.ctx_len_placeholders = tf.placeholder(dtype=tf.int32,
+                                                           shape=[None, self.params.NUM_CONTEXT],
+                                                           name='ctx_len_placeholder')
 
             self.num_ctx_placeholders = tf.placeholder(dtype=tf.int32,
                                                        shape=[None],
@@ -62,26 +229,74 @@ class SMN:
                                         shape=[None],
                                         name='response_label')
 
+            if self.is_distilled:
+                # teacher log-odds (logit of class 1 - logit of class 0) of every row
+                self.teacher_score = tf.placeholder(dtype=tf.float32,
+                                                    shape=[None],
+                                                    name='teacher_score')
+
     def extract_word_embedding(self):
         with tf.variable_scope('emb_lookup'):
-            self.word_emb_matrix = tf.get_variable("word_embedding_matrix",
-                                                   shape=[self.params.vocab_size, self.params.EMB_DIM],
-                                                   dtype=tf.float32,
-                                                   regularizer=tf.contrib.layers.l2_regularizer(0.0),
-                                                   trainable=self.params.is_word_trainable)
-
-            self.ctx_word_emb = tf.nn.embedding_lookup(params=self.word_emb_matrix,
-                                                       ids=self.ctx,
-                                                       name='ctx_word_emb',
-                                                       validate_indices=True)
-
-            self.resp_word_emb = tf.nn.embedding_lookup(params=self.word_emb_matrix,
-                                                        ids=self.resp,
-                                                        name='resp_word_emb',
-                                                        validate_indices=True)
+            if self.params.mode == 'TE' and self.params.embedding_compression is not None:
+                self.create_compressed_embedding()
+            else:
+                self.word_emb_matrix = tf.get_variable("word_embedding_matrix",
+                                                       shape=[self.params.vocab_size, self.params.EMB_DIM],
+                                                       dtype=tf.float32,
+                                                       trainable=self.params.is_word_trainable)
+
+            if self.params.shared_ctx_encoding:
+                self.utt_word_emb = self.lookup_word_embedding(self.utt_table, 'utt_word_emb')
+                self.ctx_word_emb = tf.gather(self.utt_word_emb, self.ctx_utt_idx, name='ctx_word_emb')
+            else:
+                self.ctx_word_emb = self.lookup_word_embedding(self.ctx, 'ctx_word_emb')
+
+            self.resp_word_emb = self.lookup_word_embedding(self.resp, 'resp_word_emb')
 
             print 'Extracted word embedding'
 
+    def create_compressed_embedding(self):
+        """
+        Variables of the compressed word embedding (see embedding_compression.py); no dense matrix is built.
+        """
+        self.word_emb_matrix = None
+        vocab_size, emb_dim = self.params.vocab_size, self.params.EMB_DIM
+        if self.params.embedding_compression == 'pq':
+            num_subspaces = self.params.pq_subspaces
+            self.word_emb_codes = tf.get_variable('word_emb_codes', shape=[vocab_size, num_subspaces],
+                                                  dtype=tf.uint8, trainable=False)
+            self.word_emb_codebooks = tf.get_variable('word_emb_codebooks',
+                                                      shape=[num_subspaces, self.params.pq_centroids, emb_dim // num_subspaces],
+                                                      dtype=tf.float32, trainable=False)
+        elif self.params.embedding_compression == 'low_rank':
+            self.word_emb_factor = tf.get_variable('word_emb_factor', shape=[vocab_size, self.params.low_rank_dim],
+                                                   dtype=tf.float32, trainable=False)
+            self.word_emb_basis = tf.get_variable('word_emb_basis', shape=[self.params.low_rank_dim, emb_dim],
+                                                  dtype=tf.float32, trainable=False)
+        else:
+            raise ValueError('Unknown embedding_compression %r' % self.params.embedding_compression)
+
+    def lookup_word_embedding(self, ids, name):
+        """
+        :return: [ids shape, EMB_DIM] word embeddings of ids, decoded from the compressed matrix when there is one
+        """
+        if self.word_emb_matrix is not None:
+            return tf.nn.embedding_lookup(params=self.word_emb_matrix, ids=ids, name=name, validate_indices=True)
+
+        with tf.name_scope(name):
+            if self.params.embedding_compression == 'pq':
+                num_subspaces, num_centroids, sub_dim = self.word_emb_codebooks.get_shape().as_list()
+                codes = tf.cast(tf.gather(self.word_emb_codes, ids), tf.int32)
+                # row s * num_centroids + code of the flattened codebooks is the centroid of subspace s
+                flat_codes = codes + tf.range(num_subspaces) * num_centroids
+                centroids = tf.gather(tf.reshape(self.word_emb_codebooks, [num_subspaces * num_centroids, sub_dim]), flat_codes)
+                word_emb = tf.reshape(centroids, tf.concat([tf.shape(ids), [num_subspaces * sub_dim]], axis=0))
+                word_emb.set_shape(ids.get_shape().concatenate([num_subspaces * sub_dim]))
+            else:
+                word_emb = tf.tensordot(tf.gather(self.word_emb_factor, ids), self.word_emb_basis, axes=1)
+                word_emb.set_shape(ids.get_shape().concatenate([self.params.EMB_DIM]))
+        return tf.identity(word_emb, name=name)
+
     def create_rnn_cell(self, name, option='lstm'):
         if option == 'lstm':
             with tf.variable_scope(name):
@@ -98,23 +313,50 @@ class SMN:
     def extract_ctx_hidden_embedding(self, name):
         with tf.variable_scope('rnn_ctx_layer'):
             self.rnn_ctx_cell = self.create_rnn_cell(name, self.params.rnn)
-            reshaped_input = tf.reshape(self.ctx_word_emb, shape=[-1, self.params.MAX_CTX_UTT_LENGTH, self.params.EMB_DIM])
-            reshaped_length = tf.reshape(self.ctx_len_placeholders, shape=[-1])
-            rnn_output, rnn_state = tf.nn.dynamic_rnn(self.rnn_ctx_cell,
-                                                      reshaped_input,
-                                                      reshaped_length,
-                                                      dtype=tf.float32)
+            if self.params.shared_ctx_encoding:
+                # every distinct utterance is encoded once, windows gather their [NUM_CONTEXT, T, H] slots
+                rnn_output, rnn_state = tf.nn.dynamic_rnn(self.rnn_ctx_cell,
+                                                          self.utt_word_emb,
+                                                          self.utt_len_placeholders,
+                                                          dtype=tf.float32)
+
+                if self.params.rnn == 'lstm':
+                    rnn_state = rnn_state.h
+
+                self.rnn_ctx_output = tf.gather(rnn_output, self.ctx_utt_idx, name='layer1_output')
+                self.rnn_ctx_state = tf.gather(rnn_state, self.ctx_utt_idx, name='layer1_state')
+            elif self.params.ragged_contexts:
+                # only the real contexts are encoded, padded slots keep the zero output and state of an empty sequence
+                context_rows = self.real_context_rows(self.num_ctx_placeholders)
+                rnn_output, rnn_state = tf.nn.dynamic_rnn(self.rnn_ctx_cell,
+                                                          tf.gather_nd(self.ctx_word_emb, context_rows),
+                                                          tf.gather_nd(self.ctx_len_placeholders, context_rows),
+                                                          dtype=tf.float32)
 
-            self.rnn_ctx_output = tf.reshape(rnn_output,
-                                             shape=[-1, self.params.NUM_CONTEXT, self.params.MAX_CTX_UTT_LENGTH, self.params.RNN_HIDDEN_DIM],
-                                             name='layer1_output')
+                if self.params.rnn == 'lstm':
+                    rnn_state = rnn_state.h
 
-            if self.params.rnn == 'lstm':
-                rnn_state = rnn_state.h
+                num_rows = tf.shape(self.num_ctx_placeholders)[0]
+                self.rnn_ctx_output = tf.identity(self.scatter_contexts(context_rows, rnn_output, num_rows), name='layer1_output')
+                self.rnn_ctx_state = tf.identity(self.scatter_contexts(context_rows, rnn_state, num_rows), name='layer1_state')
+            else:
+                reshaped_input = tf.reshape(self.ctx_word_emb, shape=[-1, self.params.MAX_CTX_UTT_LENGTH, self.params.EMB_DIM])
+                reshaped_length = tf.reshape(self.ctx_len_placeholders, shape=[-1])
+                rnn_output, rnn_state = tf.nn.dynamic_rnn(self.rnn_ctx_cell,
+                                                          reshaped_input,
+                                                          reshaped_length,
+                                                          dtype=tf.float32)
+
+                self.rnn_ctx_output = tf.reshape(rnn_output,
+                                                 shape=[-1, self.params.NUM_CONTEXT, self.params.MAX_CTX_UTT_LENGTH, self.params.RNN_HIDDEN_DIM],
+                                                 name='layer1_output')
+
+                if self.params.rnn == 'lstm':
+                    rnn_state = rnn_state.h
 
-            self.rnn_ctx_state = tf.reshape(rnn_state,
-                                            shape=[-1, self.params.NUM_CONTEXT, self.params.RNN_HIDDEN_DIM],
-                                            name='layer1_state')
+                self.rnn_ctx_state = tf.reshape(rnn_state,
+                                                shape=[-1, self.params.NUM_CONTEXT, self.params.RNN_HIDDEN_DIM],
+                                                name='layer1_state')
 
             print 'Extracted rnn hidden states.'
 
@@ -135,35 +377,57 @@ class SMN:
 
             print 'Extracted rnn hidden states.'
 
-    def compute_matching_matrix(self):
-        with tf.variable_scope('match_network'):
+    def pair_in_batch(self):
+        """
+        Pairs every context of a batch of positive (context, response) pairs with every response of the batch.
+        Row i * B + j scores context i against response j; the already encoded tensors are only gathered, not recomputed.
+        """
+        with tf.variable_scope('in_batch_pairs'):
+            batch_size = tf.shape(self.resp)[0]
+            batch_range = tf.range(batch_size)
+            ctx_idx = tf.reshape(tf.tile(tf.expand_dims(batch_range, 1), [1, batch_size]), [-1])
+            resp_idx = tf.tile(batch_range, [batch_size])
+
+            return tf.gather(self.ctx_word_emb, ctx_idx), \
+                tf.gather(self.rnn_ctx_output, ctx_idx), \
+                tf.gather(self.resp_word_emb, resp_idx), \
+                tf.gather(self.rnn_resp_output, resp_idx), \
+                tf.gather(self.num_ctx_placeholders, ctx_idx)
+
+    def compute_matching_matrix(self, ctx_word_emb, ctx_hidden_emb, resp_word_emb, resp_hidden_emb):
+        with self.resource_scope('match_network'):
 
             with tf.variable_scope('word_match'):
-                ctx_word_emb_split = tf.split(self.ctx_word_emb, num_or_size_splits=self.params.NUM_CONTEXT, axis=1)
+                ctx_word_emb_split = tf.split(ctx_word_emb, num_or_size_splits=self.params.NUM_CONTEXT, axis=1)
                 word_matching_matrix = []
+                match_word = self.maybe_recompute('match_network', self.match_word)
                 for each_ctx in ctx_word_emb_split:
-                    word_matching_matrix.append(tf.matmul(tf.squeeze(each_ctx, axis=1),
-                                                          self.resp_word_emb,
-                                                          transpose_b=True,
-                                                          name='ctx_word_transform'))
+                    word_matching_matrix.append(match_word(tf.squeeze(each_ctx, axis=1), resp_word_emb))
 
             with tf.variable_scope('hidden_match'):
-                ctx_hidden_emb_split = tf.split(self.rnn_ctx_output, self.params.NUM_CONTEXT, axis=1)
+                ctx_hidden_emb_split = tf.split(ctx_hidden_emb, self.params.NUM_CONTEXT, axis=1)
                 hidden_matching_matrix = []
-                self.linear_transform = tf.get_variable(name='linear_transform',
-                                                        shape=[self.params.RNN_HIDDEN_DIM, self.params.RNN_HIDDEN_DIM],
-                                                        dtype=tf.float32)
-
+                match_hidden = self.maybe_recompute('match_network', self.match_hidden)
                 for each_ctx in ctx_hidden_emb_split:
-                    each_ctx_reshaped = tf.reshape(tf.squeeze(each_ctx, axis=1), [-1, self.params.RNN_HIDDEN_DIM])
-                    mul1 = tf.matmul(each_ctx_reshaped, self.linear_transform)
-                    mul1_reshaped = tf.reshape(mul1, [-1, self.params.MAX_CTX_UTT_LENGTH, self.params.RNN_HIDDEN_DIM])
-                    mul2 = tf.matmul(mul1_reshaped, self.rnn_resp_output, transpose_b=True, name='ctx_hidden_transform')
-                    hidden_matching_matrix.append(mul2)
+                    hidden_matching_matrix.append(match_hidden(tf.squeeze(each_ctx, axis=1), resp_hidden_emb))
 
             print 'Matching matrix computation done.'
         return word_matching_matrix, hidden_matching_matrix
 
+    def match_word(self, each_ctx_word_emb, resp_word_emb):
+        return tf.matmul(each_ctx_word_emb, resp_word_emb, transpose_b=True, name='ctx_word_transform')
+
+    def match_hidden(self, each_ctx_hidden_emb, resp_hidden_emb):
+        with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+            self.linear_transform = tf.get_variable(name='linear_transform',
+                                                    shape=[self.params.RNN_HIDDEN_DIM, self.params.RNN_HIDDEN_DIM],
+                                                    dtype=tf.float32)
+
+        each_ctx_reshaped = tf.reshape(each_ctx_hidden_emb, [-1, self.params.RNN_HIDDEN_DIM])
+        mul1 = tf.matmul(each_ctx_reshaped, self.linear_transform)
+        mul1_reshaped = tf.reshape(mul1, [-1, self.params.MAX_CTX_UTT_LENGTH, self.params.RNN_HIDDEN_DIM])
+        return tf.matmul(mul1_reshaped, resp_hidden_emb, transpose_b=True, name='ctx_hidden_transform')
+
     def conv_layer(self, conv_input, filter_shape, num_filters, stride, padding, name):
         with tf.variable_scope(name) as scope:
             try:
@@ -191,23 +455,30 @@ class SMN:
         return tf.nn.max_pool(pool_input, ksize, stride, padding, name='pool')
 
     def conv_pipeline_init(self, cnn_input, conv_name):
-        num_filters = self.params.num_filters
-
         all_context_pool_output = []
 
         with tf.variable_scope(conv_name):
+            convolve_context = self.maybe_recompute('cnn_network', self.convolve_context)
             for i in range(len(cnn_input)):
                 # curr_context_utt_view_word_feature = tf.nn.embedding_lookup(self.word_emb_matrix, tf.squeeze(cnn_input[i]), name='utt_context_emb_' + str(i))
-                pool_output = []
-                for layer_num in range(len(self.params.filter_width)):
-                    curr_pool_output = self.conv_layer_pipeline(layer_num, num_filters, tf.expand_dims(cnn_input[i], -1), conv_name)
-                    # scope.reuse_variables()
-                    pool_output.append(curr_pool_output)
+                pool_output = list(convolve_context(cnn_input[i]))
                 print('Context ' + str(i) + ' convolution and max-pool ' + conv_name + ': DONE')
                 all_context_pool_output.append(pool_output)
             return all_context_pool_output
 
-    def conv_layer_pipeline(self, layer_num, num_filters, cnn_input, conv_name):
+    def convolve_context(self, matching_matrix):
+        """
+        Runs every filter width over the matching matrix of one context.
+        :return: list of pooled outputs, one per filter width
+        """
+        pool_output = []
+        for layer_num in range(len(self.params.filter_width)):
+            curr_pool_output = self.conv_layer_pipeline(layer_num, self.params.num_filters, tf.expand_dims(matching_matrix, -1))
+            # scope.reuse_variables()
+            pool_output.append(curr_pool_output)
+        return pool_output
+
+    def conv_layer_pipeline(self, layer_num, num_filters, cnn_input):
 
         filter_width = self.params.filter_width[layer_num]
         # num_filters = self.params.num_filters[layer_num]
@@ -259,14 +530,14 @@ class SMN:
 
             return accumulated_word_match, accumulated_hidden_match
 
-    def get_final_hidden_state(self, word_input, hidden_input):
+    def get_final_hidden_state(self, word_input, hidden_input, num_ctx):
         with tf.variable_scope('final_layer'):
             final_input = tf.concat([word_input, hidden_input], axis=2)
             rnn_cell = self.create_rnn_cell('last_layer', option=self.params.rnn)
 
             final_output, final_state = tf.nn.dynamic_rnn(rnn_cell,
                                                           final_input,
-                                                          self.num_ctx_placeholders,
+                                                          num_ctx,
                                                           dtype=tf.float32)
 
             if self.params.rnn == 'lstm':
@@ -285,35 +556,70 @@ class SMN:
             # tf.contrib.layers.fully_connected(inputs=final_hidden_state, num_outputs=self.params.num_classes)
             return logits
 
+    def get_in_batch_logits(self, logits):
+        """
+        Turns the B x B pair logits into a softmax over the responses of the batch for every context.
+        The positive response of context i is response i; duplicate responses within a batch act as false negatives.
+        :return: (B x B candidate logits, target index per context)
+        """
+        with tf.name_scope('in_batch_logits'):
+            batch_size = tf.shape(self.resp)[0]
+            # log-odds of the positive class as the matching score of every pair
+            pair_score = logits[:, 1] - logits[:, 0]
+            return tf.reshape(pair_score, [batch_size, batch_size]), tf.range(batch_size)
+
     def compute_loss(self, logits):
-        global regularization_penalty, reg_penalty_word_emb
+        target = self.label
+        if self.in_batch:
+            logits, target = self.get_in_batch_logits(logits)
 
         with tf.name_scope('pred_acc'):
             with tf.name_scope('prediction'):
                 self.probabilities = tf.nn.softmax(logits, name='softmax_probability')
                 self.prediction = tf.cast(tf.argmax(input=self.probabilities, axis=1, name='prediction'), dtype=tf.int32)
-                correct_prediction = tf.equal(self.prediction, self.label)
+                correct_prediction = tf.equal(self.prediction, target)
+                if self.in_batch:
+                    self.positive_score = tf.diag_part(self.probabilities)
+                else:
+                    # class 1 is the positive (matching) response
+                    self.positive_score = self.probabilities[:, 1]
             with tf.name_scope('accuracy'):
                 self.accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
 
         with tf.variable_scope('loss'):
             with tf.variable_scope('cross_ent'):
-                cross_entropy_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.label, logits=logits, name='ce_loss')
+                cross_entropy_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=logits, name='ce_loss')
                 total_ce_loss = tf.reduce_sum(cross_entropy_loss, name='total_ce_loss')
 
+            self.create_streaming_metrics(total_ce_loss, correct_prediction)
+
+            training_loss = total_ce_loss
+            if self.is_distilled:
+                training_loss = self.get_distillation_loss(logits, total_ce_loss)
+
             with tf.variable_scope('reg_loss'):
-                if (self.params.mode == 'TR'):
-                    tvars = tf.trainable_variables()
+                if (self.params.mode == 'TR' and self.params.apply_l2_reg):
+                    # the embedding matrix is kept out of the dense L2 term: penalising it as a whole would turn its
+                    # gradient into a dense vocab_size x EMB_DIM tensor on every step
+                    dense_tvars = [var for var in tf.trainable_variables() if var is not self.word_emb_matrix]
                     l2_regularizer = tf.contrib.layers.l2_regularizer(scale=self.params.REG_CONSTANT, scope=None)
-                    regularization_penalty = tf.contrib.layers.apply_regularization(l2_regularizer, tvars)
-                    reg_penalty_word_emb = tf.contrib.layers.apply_regularization(l2_regularizer, [self.word_emb_matrix])
+                    regularization_penalty = tf.contrib.layers.apply_regularization(l2_regularizer, dense_tvars)
+
+                    reg_penalty_word_emb = 0.0
+                    if self.params.is_word_trainable and self.params.REG_EMB_CONSTANT > 0.0:
+                        # penalise only the rows looked up by this batch, the gradient stays IndexedSlices
+                        batch_word_ids, _ = tf.unique(tf.concat([tf.reshape(self.ctx, [-1]), tf.reshape(self.resp, [-1])], axis=0))
+                        reg_penalty_word_emb = self.params.REG_EMB_CONSTANT * tf.nn.l2_loss(tf.gather(self.word_emb_matrix, batch_word_ids))
 
             if self.params.mode == 'TR':
-                combined_loss = cross_entropy_loss + regularization_penalty - reg_penalty_word_emb
+                if self.params.apply_l2_reg:
+                    combined_loss = training_loss + regularization_penalty + reg_penalty_word_emb
+                else:
+                    combined_loss = training_loss
                 if self.params.log:
                     self.train_loss = tf.summary.scalar('loss_train', combined_loss)
                     self.train_accuracy = tf.summary.scalar('acc_train', self.accuracy)
-                return total_ce_loss, total_ce_loss
+                return total_ce_loss, combined_loss
             else:
                 if self.params.log:
                     valid_loss = tf.summary.scalar('loss_train', total_ce_loss)
@@ -323,30 +629,126 @@ class SMN:
                     self.merged_else = []
                 return total_ce_loss, total_ce_loss
 
+    def get_distillation_loss(self, logits, total_ce_loss):
+        """
+        Blends the hard-label loss with the cross entropy against the temperature-softened teacher distribution
+        (equal to the KL divergence up to the constant teacher entropy), scaled by T^2 to keep its gradients on the
+        scale of the hard loss.
+        """
+        with tf.variable_scope('distillation'):
+            temperature = self.params.distill_temperature
+            teacher_positive = tf.sigmoid(self.teacher_score / temperature)
+            soft_target = tf.stack([1.0 - teacher_positive, teacher_positive], axis=1)
+            soft_ce_loss = tf.nn.softmax_cross_entropy_with_logits(labels=soft_target, logits=logits / temperature, name='soft_ce_loss')
+            total_soft_loss = temperature ** 2 * tf.reduce_sum(soft_ce_loss, name='total_soft_loss')
+            return (1.0 - self.params.distill_alpha) * total_ce_loss + self.params.distill_alpha * total_soft_loss
+
+    def metric_variable(self, name):
+        # local variables stay out of checkpoints and are re-initialised at the start of every epoch
+        return tf.Variable(0.0, trainable=False, name=name, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    def create_streaming_metrics(self, total_ce_loss, correct_prediction):
+        """
+        Accumulates epoch metrics inside the graph, so a step only needs to run metric_update_op.
+        Ranking metrics assume unshuffled groups of params.num_candidates rows (one context with its candidates)
+        and are only built when a batch holds whole groups.
+        """
+        with tf.variable_scope('streaming_metrics'):
+            self.metric_vars = {'loss': self.metric_variable('loss_sum'),
+                                'correct': self.metric_variable('correct'),
+                                'count': self.metric_variable('count')}
+
+            update_ops = [tf.assign_add(self.metric_vars['loss'], total_ce_loss),
+                          tf.assign_add(self.metric_vars['correct'], tf.reduce_sum(tf.cast(correct_prediction, tf.float32))),
+                          tf.assign_add(self.metric_vars['count'], tf.cast(tf.size(self.label), tf.float32))]
+
+            num_candidates = self.params.num_candidates
+            self.has_ranking_metrics = not self.in_batch \
+                and num_candidates is not None and self.params.batch_size % num_candidates == 0
+            if self.has_ranking_metrics:
+                group_scores = tf.reshape(self.positive_score, [-1, num_candidates])
+                group_is_pos = tf.equal(tf.reshape(self.label, [-1, num_candidates]), 1)
+                pos_score = tf.reduce_max(tf.where(group_is_pos, group_scores, tf.fill(tf.shape(group_scores), -1.0)), axis=1)
+                rank = tf.reduce_sum(tf.cast(tf.greater(group_scores, tf.expand_dims(pos_score, 1)), tf.float32), axis=1)
+                has_pos = tf.cast(tf.reduce_any(group_is_pos, axis=1), tf.float32)
+
+                self.metric_vars['groups'] = self.metric_variable('groups')
+                self.metric_vars['rr'] = self.metric_variable('reciprocal_rank_sum')
+                update_ops.append(tf.assign_add(self.metric_vars['groups'], tf.reduce_sum(has_pos)))
+                update_ops.append(tf.assign_add(self.metric_vars['rr'], tf.reduce_sum(has_pos / (rank + 1.0))))
+                for k in self.params.recall_k:
+                    if k < num_candidates:
+                        name = 'r%d' % k
+                        self.metric_vars[name] = self.metric_variable('recall_at_%d' % k)
+                        update_ops.append(tf.assign_add(self.metric_vars[name], tf.reduce_sum(has_pos * tf.cast(tf.less(rank, k), tf.float32))))
+
+            self.metric_update_op = tf.group(*update_ops, name='metric_update')
+            self.metric_reset_op = tf.variables_initializer(self.metric_vars.values(), name='metric_reset')
+
+    def read_metrics(self, session):
+        """
+        :return: dict with the summed loss, accuracy and, if available, R@k / MRR over candidate groups
+        """
+        values = session.run(self.metric_vars)
+        metrics = {'loss': values['loss'], 'accuracy': values['correct'] / max(values['count'], 1.0)}
+        if self.has_ranking_metrics:
+            num_groups = max(values['groups'], 1.0)
+            metrics['mrr'] = values['rr'] / num_groups
+            for k in self.params.recall_k:
+                if 'r%d' % k in values:
+                    metrics['r%d' % k] = values['r%d' % k] / num_groups
+        return metrics
+
     def train(self, combined_loss):
         global optimizer
         with tf.variable_scope('train'):
             self._lr = tf.Variable(0.0, trainable=False, name='learning_rate')
+            # counts optimizer updates (not micro-batches); kept local so checkpoints stay unchanged
+            self.global_step = tf.Variable(0, trainable=False, name='apply_step', collections=[tf.GraphKeys.LOCAL_VARIABLES])
 
             with tf.variable_scope('optimize'):
 
+                learning_rate = self.lr
+                if self.params.lr_warmup_steps > 0:
+                    warmup_factor = tf.minimum(1.0, tf.cast(self.global_step + 1, tf.float32) / self.params.lr_warmup_steps)
+                    learning_rate = self.lr * warmup_factor
+
+                if self.params.train_op == 'sgd':
+                    optimizer = tf.train.GradientDescentOptimizer(learning_rate, name='sgd')
+                elif self.params.train_op == 'adam':
+                    # note: Adam decays its full moment slots on every step, use lazy_adam for row-sparse updates
+                    optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate, name='adam')
+                elif self.params.train_op == 'lazy_adam':
+                    optimizer = tf.contrib.opt.LazyAdamOptimizer(learning_rate=learning_rate, name='lazy_adam')
+                elif self.params.train_op == 'adagrad':
+                    optimizer = tf.train.AdagradOptimizer(learning_rate=learning_rate, name='adagrad')
+                elif self.params.train_op == 'adadelta':
+                    optimizer = tf.train.AdadeltaOptimizer(learning_rate=learning_rate, epsilon=1e-6, name='adadelta')
+
                 tvars = tf.trainable_variables()
+                # the embedding gradient arrives as IndexedSlices (batch rows only); clip_by_global_norm keeps it sparse
                 grads = tf.gradients(combined_loss, tvars)
+
+                if self.params.grad_accum_steps > 1:
+                    grads = self.accumulate_gradients(grads, tvars)
+
                 grads, _ = tf.clip_by_global_norm(grads, clip_norm=self.params.max_grad_norm)
                 grad_var_pairs = zip(grads, tvars)
+                apply_op = optimizer.apply_gradients(grad_var_pairs, global_step=self.global_step, name='apply_grad')
 
-                if self.params.train_op == 'sgd':
-                    optimizer = tf.train.GradientDescentOptimizer(self.lr, name='sgd')
-                elif self.params.train_op == 'adam':
-                    optimizer = tf.train.AdamOptimizer(learning_rate=self.lr, name='adam')
-                elif self.params.train_op == 'adadelta':
-                    optimizer = tf.train.AdadeltaOptimizer(learning_rate=self.lr, epsilon=1e-6, name='adadelta')
-                self._train_op = optimizer.apply_gradients(grad_var_pairs, name='apply_grad')
+                if self.params.grad_accum_steps > 1:
+                    with tf.control_dependencies([apply_op]):
+                        self.apply_accum_op = tf.group(*self.reset_accumulators(), name='apply_accumulated')
+                    self._train_op = self.accum_op
+                else:
+                    self._train_op = apply_op
 
                 if self.params.log:
                     grad_summaries = []
                     for grad, var in grad_var_pairs:
                         if grad is not None:
+                            if isinstance(grad, tf.IndexedSlices):
+                                grad = grad.values
                             grad_hist_summary = tf.summary.histogram("{}/grad/hist".format(var.name), grad)
                             sparsity_summary = tf.summary.scalar("{}/grad/sparsity".format(var.name), tf.nn.zero_fraction(grad))
                             grad_summaries.append(grad_hist_summary)
@@ -357,6 +759,65 @@ class SMN:
                 else:
                     self.merged_train = []
 
+    def accumulate_gradients(self, grads, tvars):
+        """
+        Sums the raw gradients of grad_accum_steps micro-batches in local buffers.
+        The loss is a sum over examples, so the summed gradient equals the gradient of the large batch and is
+        clipped by max_grad_norm once, as a whole, before it is applied.
+        Sparse (embedding) gradients are scattered into their buffer and only the touched rows are handed to the
+        optimizer and cleared again, so the update itself stays row-sparse.
+        Sets accum_op, run on every micro-batch.
+        :return: gradients to apply, read from the buffers
+        """
+        accum_ops = []
+        self.accum_buffers = []
+        accumulated_grads = []
+
+        with tf.variable_scope('grad_accumulation'):
+            for grad, var in zip(grads, tvars):
+                if grad is None:
+                    accumulated_grads.append(None)
+                    continue
+
+                var_name = var.op.name.replace('/', '_')
+                buffer_var = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                         name=var_name + '_accum', collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+                if isinstance(grad, tf.IndexedSlices):
+                    num_rows = var.get_shape()[0].value
+                    touched_var = tf.Variable(tf.zeros([num_rows]), trainable=False,
+                                              name=var_name + '_touched', collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                    accum_ops.append(tf.scatter_add(buffer_var, grad.indices, grad.values))
+                    accum_ops.append(tf.scatter_update(touched_var, grad.indices, tf.ones_like(grad.indices, dtype=tf.float32)))
+
+                    touched_rows = tf.cast(tf.reshape(tf.where(touched_var > 0.0), [-1]), tf.int32)
+                    row_values = tf.gather(buffer_var, touched_rows)
+                    accumulated_grads.append(tf.IndexedSlices(row_values, touched_rows, dense_shape=tf.shape(var)))
+                    self.accum_buffers.append((buffer_var, touched_var, touched_rows))
+                else:
+                    accum_ops.append(tf.assign_add(buffer_var, grad))
+                    accumulated_grads.append(buffer_var.read_value())
+                    self.accum_buffers.append((buffer_var, None, None))
+
+            self.accum_op = tf.group(*accum_ops, name='accumulate')
+
+        return accumulated_grads
+
+    def reset_accumulators(self):
+        """
+        Clears the gradient buffers; must be created under a control dependency on the update that reads them.
+        """
+        reset_ops = []
+        for buffer_var, touched_var, touched_rows in self.accum_buffers:
+            if touched_var is None:
+                reset_ops.append(tf.assign(buffer_var, tf.zeros_like(buffer_var)))
+            else:
+                num_touched = tf.size(touched_rows)
+                row_zeros = tf.zeros(tf.stack([num_touched, tf.shape(buffer_var)[1]]), dtype=buffer_var.dtype.base_dtype)
+                reset_ops.append(tf.scatter_update(buffer_var, touched_rows, row_zeros))
+                reset_ops.append(tf.scatter_update(touched_var, touched_rows, tf.zeros([num_touched])))
+        return reset_ops
+
     def assign_lr(self, session, lr_value):
         session.run(tf.assign(self.lr, lr_value))
 
@@ -1,15 +1,21 @@
 import numpy as np
-from global_module.settings_module import ParamsClass, Directory, Dictionary
+from global_module.settings_module import Directory, Dictionary, get_params
 
 
 class DataReader:
-    def __init__(self, params):
+    def __init__(self, params, neg_sampler=None, teacher_scores=None):
+        """
+        :param neg_sampler: NegativeSampler drawing fresh negatives for every positive row, None reads rows as they are
+        :param teacher_scores: teacher log-odds of every row of the split (memmap), appended to each batch for distillation
+        """
         self.params = params
+        self.neg_sampler = neg_sampler
+        self.teacher_scores = teacher_scores
 
     def get_index_string(self, utt, word_dict):
         index_string = ''
         for each_token in utt.split():
-            if (ParamsClass('TR').all_lowercase):
+            if (self.params.all_lowercase):
                 if (word_dict.has_key(each_token.lower())):
                     each_token = each_token.lower()
                 elif (word_dict.has_key(each_token)):
@@ -54,6 +60,42 @@ class DataReader:
             op_string = self.pad_string(inp_string, curr_string_len, max_len)
         return op_string
 
+    def encode_line(self, curr_line, dict_obj):
+        """
+        Converts one tab-separated (contexts..., response) line into padded id strings.
+        :return: (context id strings, context lengths, number of contexts, response id string, response length)
+        """
+        data_line_split = curr_line.split('\t')
+        curr_num_context = len(data_line_split) - 1
+
+        curr_ctx_seq_arr = []
+        curr_ctx_len_arr = [0 for _ in range(self.params.NUM_CONTEXT)]
+
+        for idx in range(len(data_line_split) - 1):
+            each_split = data_line_split[idx]
+            curr_string_len, curr_index_string = self.get_index_string(each_split, dict_obj.word_dict)
+            curr_utt_string = self.format_string(curr_index_string, curr_string_len, self.params.MAX_CTX_UTT_LENGTH)  # format each utt string
+            curr_ctx_seq_arr.append(curr_utt_string)
+            curr_ctx_len_arr[idx] = curr_string_len
+
+        curr_ctx_seq_arr = self.add_dummy_context_string(curr_ctx_seq_arr, curr_num_context, self.params.NUM_CONTEXT, self.params.MAX_CTX_UTT_LENGTH)
+
+        resp_string_len, resp_index_string = self.encode_response(data_line_split[curr_num_context], dict_obj)
+        return curr_ctx_seq_arr, curr_ctx_len_arr, curr_num_context, resp_index_string, resp_string_len
+
+    def encode_response(self, resp_utt, dict_obj):
+        resp_string_len, resp_index_string = self.get_index_string(resp_utt, dict_obj.word_dict)
+        resp_index_string = self.format_string(resp_index_string, resp_string_len, self.params.MAX_RESP_UTT_LENGTH)  # format resp string
+        return resp_string_len, resp_index_string
+
+    def encode_sampled_response(self, response_id, dict_obj):
+        # every unique response is encoded once per run, however often it is drawn
+        encoded = self.neg_sampler.encoded_responses.get(response_id)
+        if encoded is None:
+            encoded = self.encode_response(self.neg_sampler.responses[response_id], dict_obj)
+            self.neg_sampler.encoded_responses[response_id] = encoded
+        return encoded
+
     def generate_id_map(self, data_filename, label_filename, index_arr, dict_obj):
         data_file_arr = open(data_filename, 'r').readlines()
         label_file_arr = open(label_filename, 'r').readlines()
@@ -69,23 +111,11 @@ class DataReader:
             curr_line = data_file_arr[each_idx].strip()
             curr_label = label_file_arr[each_idx].strip()
 
-            data_line_split = curr_line.split('\t')
-            curr_num_context = len(data_line_split) - 1
-
-            curr_ctx_seq_arr = []
-            curr_ctx_len_arr = [0 for _ in range(self.params.NUM_CONTEXT)]
-
-            for idx in range(len(data_line_split) - 1):
-                each_split = data_line_split[idx]
-                curr_string_len, curr_index_string = self.get_index_string(each_split, dict_obj.word_dict)
-                curr_utt_string = self.format_string(curr_index_string, curr_string_len, self.params.MAX_CTX_UTT_LENGTH)  # format each utt string
-                curr_ctx_seq_arr.append(curr_utt_string)
-                curr_ctx_len_arr[idx] = curr_string_len
-
-            curr_ctx_seq_arr = self.add_dummy_context_string(curr_ctx_seq_arr, curr_num_context, self.params.NUM_CONTEXT, self.params.MAX_CTX_UTT_LENGTH)
+            if self.neg_sampler is not None and curr_label != '1':
+                # negatives are drawn below, materialised ones are ignored
+                continue
 
-            resp_string_len, resp_index_string = self.get_index_string(data_line_split[curr_num_context], dict_obj.word_dict)
-            resp_index_string = self.format_string(resp_index_string, resp_string_len, self.params.MAX_RESP_UTT_LENGTH)  # format resp string
+            curr_ctx_seq_arr, curr_ctx_len_arr, curr_num_context, resp_index_string, resp_string_len = self.encode_line(curr_line, dict_obj)
 
             global_ctx_arr.append(curr_ctx_seq_arr)
             global_ctx_len_arr.append(curr_ctx_len_arr)
@@ -94,6 +124,17 @@ class DataReader:
             global_resp_len_arr.append(resp_string_len)
             global_label_arr.append(curr_label)
 
+            if self.neg_sampler is not None:
+                positive_id = self.neg_sampler.response_to_id.get(curr_line.split('\t')[-1].strip(), -1)
+                for each_neg in self.neg_sampler.sample_for_row(each_idx, positive_id, self.params.num_negatives):
+                    neg_len, neg_index_string = self.encode_sampled_response(each_neg, dict_obj)
+                    global_ctx_arr.append(curr_ctx_seq_arr)
+                    global_ctx_len_arr.append(curr_ctx_len_arr)
+                    global_num_ctx_arr.append(curr_num_context)
+                    global_resp_arr.append(neg_index_string)
+                    global_resp_len_arr.append(neg_len)
+                    global_label_arr.append('0')
+
         print('Reading: DONE')
         return global_ctx_arr, global_ctx_len_arr, global_num_ctx_arr, global_resp_arr, global_resp_len_arr, global_label_arr
 
@@ -101,7 +142,7 @@ class DataReader:
         ctx_arr, ctx_len_arr, num_ctx_arr, resp_arr, resp_len_arr, label_arr = self.generate_id_map(data_filename, label_filename, index_arr, dict_obj)
 
         batch_size = self.params.batch_size
-        num_batches = len(index_arr) / self.params.batch_size
+        num_batches = len(ctx_arr) / self.params.batch_size
 
         for i in range(num_batches):
             curr_ctx_arr = ctx_arr[i * batch_size: (i + 1) * batch_size]
@@ -127,6 +168,118 @@ class DataReader:
             yield (curr_ctx_arr, curr_ctx_len_arr, curr_num_ctx_arr, curr_resp_arr, curr_resp_len_arr, curr_label_arr)
             # print("A")
 
+    def encode_batch(self, lines, dict_obj):
+        """
+        Encodes unlabelled (contexts..., response) lines of any count into one batch; labels are zeros.
+        """
+        ctx_arr, ctx_len_arr, num_ctx_arr, resp_arr, resp_len_arr = [], [], [], [], []
+        for each_line in lines:
+            curr_ctx_seq_arr, curr_ctx_len_arr, curr_num_context, resp_index_string, resp_string_len = self.encode_line(each_line.strip(), dict_obj)
+            ctx_arr.append([map(int, each_ctx.split('\t')) for each_ctx in curr_ctx_seq_arr])
+            ctx_len_arr.append(curr_ctx_len_arr)
+            num_ctx_arr.append(curr_num_context)
+            resp_arr.append(map(int, resp_index_string.split('\t')))
+            resp_len_arr.append(resp_string_len)
+
+        return (np.array(ctx_arr, dtype=np.int32), np.array(ctx_len_arr, dtype=np.int32), np.array(num_ctx_arr, dtype=np.int32),
+                np.array(resp_arr, dtype=np.int32), np.array(resp_len_arr, dtype=np.int32), np.zeros(len(lines), dtype=np.int32))
+
+    def encode_utterances(self, utterances, dict_obj, max_len):
+        """
+        :return: ([N, max_len] zero-padded token ids, [N] lengths clipped to max_len)
+        """
+        id_arr = np.zeros((len(utterances), max_len), dtype=np.int32)
+        len_arr = np.zeros(len(utterances), dtype=np.int32)
+        for i, each_utt in enumerate(utterances):
+            _, index_string = self.get_index_string(each_utt.strip(), dict_obj.word_dict)
+            token_ids = [int(each_id) for each_id in index_string.split()][:max_len]
+            id_arr[i, :len(token_ids)] = token_ids
+            len_arr[i] = len(token_ids)
+        return id_arr, len_arr
+
+    def generate_ref_map(self, dataset, index_arr):
+        """
+        Row selection on an InternedDataset; with a sampler, negatives are drawn as response utterance ids.
+        :return: (context refs, number of contexts, response refs, labels) arrays
+        """
+        index_arr = np.asarray(index_arr, dtype=np.int64)
+        if self.neg_sampler is None:
+            return dataset.ctx_refs[index_arr], dataset.num_ctx[index_arr], dataset.resp_refs[index_arr], dataset.labels[index_arr]
+
+        row_arr = []
+        resp_ref_arr = []
+        label_arr = []
+        for each_idx in index_arr:
+            if dataset.labels[each_idx] != 1:
+                continue
+            resp_ref = int(dataset.resp_refs[each_idx])
+            row_arr.append(each_idx)
+            resp_ref_arr.append(resp_ref)
+            label_arr.append(1)
+
+            positive_id = self.neg_sampler.response_to_id.get(resp_ref, -1)
+            for each_neg in self.neg_sampler.sample_for_row(each_idx, positive_id, self.params.num_negatives):
+                row_arr.append(each_idx)
+                resp_ref_arr.append(self.neg_sampler.responses[each_neg])
+                label_arr.append(0)
+
+        row_arr = np.array(row_arr, dtype=np.int64)
+        return (dataset.ctx_refs[row_arr], dataset.num_ctx[row_arr],
+                np.array(resp_ref_arr, dtype=np.int32), np.array(label_arr, dtype=np.int32))
+
+    def interned_iterator(self, dataset, index_arr):
+        """
+        Same batches as data_iterator, gathered from the padded utterance tables of an InternedDataset.
+        Lengths are clipped to MAX_CTX_UTT_LENGTH / MAX_RESP_UTT_LENGTH.
+        """
+        ctx_refs, num_ctx_arr, resp_refs, label_arr = self.generate_ref_map(dataset, index_arr)
+        ctx_table, ctx_len_table = dataset.padded_table(self.params.MAX_CTX_UTT_LENGTH)
+        resp_table, resp_len_table = dataset.padded_table(self.params.MAX_RESP_UTT_LENGTH)
+
+        batch_size = self.params.batch_size
+        num_batches = len(label_arr) / batch_size
+
+        for i in range(num_batches):
+            batch_slice = slice(i * batch_size, (i + 1) * batch_size)
+            curr_ctx_refs = ctx_refs[batch_slice]
+            curr_resp_refs = resp_refs[batch_slice]
+            yield (ctx_table[curr_ctx_refs], ctx_len_table[curr_ctx_refs], num_ctx_arr[batch_slice],
+                   resp_table[curr_resp_refs], resp_len_table[curr_resp_refs], label_arr[batch_slice])
+
+    def batch_iterator(self, dir_obj, index_arr, dict_obj, dataset=None):
+        """
+        :param dataset: InternedDataset of the split, None reads the text files of dir_obj
+        """
+        if dataset is not None:
+            batches = self.interned_iterator(dataset, index_arr)
+        else:
+            batches = self.data_iterator(dir_obj.data_filename, dir_obj.label_filename, index_arr, dict_obj)
+        if self.teacher_scores is None:
+            return batches
+        return self.add_teacher_scores(batches, index_arr)
+
+    def add_teacher_scores(self, batches, index_arr):
+        """
+        Reads the teacher scores of each batch from the memory-mapped file; rows are batched in index_arr order.
+        """
+        if self.neg_sampler is not None:
+            raise ValueError('Teacher scores exist for the rows of the data file only, not for sampled negatives')
+        index_arr = np.asarray(index_arr, dtype=np.int64)
+        batch_size = self.params.batch_size
+        for i, batch in enumerate(batches):
+            yield batch + (np.asarray(self.teacher_scores[index_arr[i * batch_size: (i + 1) * batch_size]], dtype=np.float32),)
+
+
+def share_context_utterances(ctx_arr, ctx_len_arr):
+    """
+    Deduplicates the context utterances of a batch, so that each distinct utterance is encoded once.
+    :return: ([U, T] distinct utterances, [U] their lengths, [B, NUM_CONTEXT] row of every context in the table)
+    """
+    batch_size, num_context, max_len = ctx_arr.shape
+    rows = np.concatenate([ctx_arr.reshape(-1, max_len), ctx_len_arr.reshape(-1, 1)], axis=1)
+    unique_rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+    return unique_rows[:, :max_len], unique_rows[:, max_len], inverse.reshape(batch_size, num_context).astype(np.int32)
+
 
 def getLength(fileName):
     print('Reading :', fileName)
@@ -139,26 +292,15 @@ def getLength(fileName):
 
 
 def main():
-    data_file = '/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/raw_tokenized_train.txt'
-    label_file = '/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/label_train.txt'
-    count, utterance_idx = getLength(data_file)
+    dir_obj = Directory('TR')
+    count, utterance_idx = getLength(dir_obj.data_filename)
     dictObj = Dictionary()
-    config = ParamsClass()
-    flag = 'TR'
-
-    a, b, c, d, e, f = DataReader(config).data_iterator(config, data_file, label_file, utterance_idx, dictObj)
-
-    # for step, (a, b, c, d, e, f, g, h) in enumerate(data_iterator(config, data_file, label_file, utterance_idx, dictObj)):
-    #     print 1
-    # np.savetxt('a.txt', a, fmt='%d')
-    # np.savetxt('b.txt', b, fmt='%d')
-    # np.savetxt('c.txt', c, fmt='%d')
-    # np.savetxt('d.txt', d, fmt='%d')
-    # np.savetxt('e.txt', e, fmt='%d')
-    # np.savetxt('f.txt', f, fmt='%d')
-    # print g
-    # np.savetxt('g.txt', np.squeeze(g), fmt='%d')
-    # np.savetxt('h.txt', h)
+    config = get_params('TR')
+
+    step = -1
+    for step, batch in enumerate(DataReader(config).data_iterator(dir_obj.data_filename, dir_obj.label_filename, utterance_idx, dictObj)):
+        pass
+    print('%d rows, %d batches' % (count, step + 1))
 
 
 if __name__ == '__main__':
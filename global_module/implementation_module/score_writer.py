@@ -0,0 +1,144 @@
+import json
+
+import numpy as np
+
+TOP_K_DTYPE = np.dtype([('group', '<i8'), ('row', '<i8'), ('score', '<f4')])
+
+
+def read_scores(path):
+    """
+    :return: memory-mapped scores (or top-k records) of a file written by ScoreWriter, described by its .json sidecar
+    """
+    sidecar = json.load(open(path + '.json', 'r'))
+    dtype = TOP_K_DTYPE if sidecar['format'] == 'top_k' else np.dtype(sidecar['dtype'])
+    if sidecar['count'] == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(sidecar['count'],))
+
+
+def export_text(path, text_path, chunk_rows=1000000):
+    """
+    Converts a binary score file into the text format, one score (or 'group row score' record) per line.
+    """
+    scores = read_scores(path)
+    text_file = open(text_path, 'w')
+    for start in range(0, len(scores), chunk_rows):
+        chunk = scores[start:start + chunk_rows]
+        if chunk.dtype == TOP_K_DTYPE:
+            text_file.write(''.join(['%d\t%d\t%r\n' % (group, row, float(score)) for group, row, score in chunk]))
+        else:
+            text_file.write(''.join([repr(float(each_score)) + '\n' for each_score in chunk]))
+    text_file.close()
+
+
+class ScoreWriter:
+    def __init__(self, path, output_format='binary', flush_rows=65536, top_k=None):
+        """
+        Streams scores to disk in chunks.
+        :param output_format: 'binary' appends raw float32 and keeps a .json sidecar (dtype, count), 'text' one score per line
+        :param top_k: keep only the k best candidates of every context group, as (group, row, score) records
+        """
+        self.path = path
+        self.output_format = output_format
+        self.flush_rows = flush_rows
+        self.top_k = top_k
+
+        self.output_file = open(path, 'wb' if output_format == 'binary' else 'w')
+        self.buffer = []
+        self.buffered_rows = 0
+        self.count = 0
+
+        self.num_rows = 0
+        self.num_groups = 0
+        self.last_ctx = None
+        self.pending = (np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64))
+
+    def write(self, scores, ctx_arr=None):
+        """
+        :param scores: scores of the next rows
+        :param ctx_arr: context ids of those rows, consecutive rows with equal contexts form a group (top_k only)
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        if self.top_k is None:
+            self.append(scores)
+        else:
+            self.append(self.top_k_records(scores, ctx_arr))
+        self.num_rows += len(scores)
+
+    def top_k_records(self, scores, ctx_arr):
+        ctx_rows = ctx_arr.reshape(len(scores), -1)
+        starts = np.ones(len(scores), dtype=bool)
+        starts[1:] = np.any(ctx_rows[1:] != ctx_rows[:-1], axis=1)
+        if self.last_ctx is not None:
+            starts[0] = np.any(ctx_rows[0] != self.last_ctx)
+        self.last_ctx = ctx_rows[-1].copy()
+
+        pending_scores, pending_rows = self.pending
+        all_scores = np.concatenate([pending_scores, scores])
+        all_rows = np.concatenate([pending_rows, np.arange(self.num_rows, self.num_rows + len(scores))])
+        all_starts = np.concatenate([np.ones(len(pending_scores), dtype=bool), starts])
+        all_starts[1:len(pending_scores)] = False
+        group_starts = np.flatnonzero(all_starts)
+
+        # every group but the last one is complete, the last one may continue in the next batch
+        records = self.group_top_k(all_scores, all_rows, group_starts)
+        self.pending = (all_scores[group_starts[-1]:], all_rows[group_starts[-1]:])
+        return records
+
+    def group_top_k(self, scores, rows, boundaries):
+        """
+        :param boundaries: group i spans rows boundaries[i]:boundaries[i + 1]
+        """
+        records = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            top = np.argsort(-scores[start:end], kind='mergesort')[:self.top_k] + start
+            group_records = np.zeros(len(top), dtype=TOP_K_DTYPE)
+            group_records['group'] = self.num_groups
+            group_records['row'] = rows[top]
+            group_records['score'] = scores[top]
+            records.append(group_records)
+            self.num_groups += 1
+        return np.concatenate(records) if records else np.zeros(0, dtype=TOP_K_DTYPE)
+
+    def append(self, values):
+        self.buffer.append(values)
+        self.buffered_rows += len(values)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        values = np.concatenate(self.buffer)
+        if self.output_format == 'binary':
+            values.tofile(self.output_file)
+        elif values.dtype == TOP_K_DTYPE:
+            self.output_file.write(''.join(['%d\t%d\t%r\n' % (group, row, float(score)) for group, row, score in values]))
+        else:
+            self.output_file.write(''.join([repr(float(each_score)) + '\n' for each_score in values]))
+        self.output_file.flush()
+        self.count += len(values)
+        self.buffer = []
+        self.buffered_rows = 0
+        self.write_sidecar()
+
+    def write_sidecar(self):
+        if self.output_format != 'binary':
+            return
+        sidecar = {'format': 'top_k' if self.top_k is not None else 'scores',
+                   'dtype': '<f4' if self.top_k is None else [list(each_field) for each_field in TOP_K_DTYPE.descr],
+                   'count': self.count,
+                   'rows_scored': self.num_rows,
+                   'top_k': self.top_k}
+        sidecar_file = open(self.path + '.json', 'w')
+        json.dump(sidecar, sidecar_file)
+        sidecar_file.close()
+
+    def close(self):
+        if self.top_k is not None and len(self.pending[0]) > 0:
+            pending_scores, pending_rows = self.pending
+            self.buffer.append(self.group_top_k(pending_scores, pending_rows, np.array([0, len(pending_scores)])))
+            self.pending = (np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64))
+        self.flush()
+        self.write_sidecar()
+        self.output_file.close()
@@ -0,0 +1,247 @@
+from collections import OrderedDict, deque
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.implementation_module.model import SMN
+from global_module.implementation_module.reader import DataReader
+from global_module.settings_module import artifact_cache
+
+
+class SessionGraph(SMN):
+    """
+    Inference graph of SMN cut at its per-context boundary, with the variable names of the training graph:
+    candidate encoding, matching features of new utterances against every candidate, and the accumulation RNN
+    over a window of cached per-turn features.
+    """
+
+    def init_pipeline(self):
+        self.create_placeholders()
+        self.extract_word_embedding()
+
+        with tf.variable_scope('initial_rnn'):
+            with tf.variable_scope('rnn_ctx_layer'):
+                self.rnn_ctx_cell = self.create_rnn_cell('layer1', self.params.rnn)
+                self.rnn_ctx_output, _ = tf.nn.dynamic_rnn(self.rnn_ctx_cell,
+                                                           self.ctx_word_emb,
+                                                           self.ctx_len_placeholders,
+                                                           dtype=tf.float32)
+            # resp_word_emb and rnn_resp_output are fed with the cached candidate bank when scoring turns
+            self.extract_resp_hidden_embedding('layer1')
+
+        self.get_turn_features()
+        self.get_window_scores()
+
+    def create_placeholders(self):
+        with tf.variable_scope('placeholder'):
+            # new utterances of a session, each matched against every candidate
+            self.ctx = tf.placeholder(dtype=tf.int32,
+                                      shape=[None, self.params.MAX_CTX_UTT_LENGTH],
+                                      name='utt_placeholder')
+
+            self.ctx_len_placeholders = tf.placeholder(dtype=tf.int32,
+                                                       shape=[None],
+                                                       name='utt_len_placeholder')
+
+            self.resp = tf.placeholder(dtype=tf.int32,
+                                       shape=[None, self.params.MAX_RESP_UTT_LENGTH],
+                                       name='res_placeholder')
+
+            self.resp_len_placeholders = tf.placeholder(dtype=tf.int32,
+                                                        shape=[None],
+                                                        name='resp_len_placeholder')
+
+            self.num_ctx_placeholders = tf.placeholder(dtype=tf.int32,
+                                                       shape=[None],
+                                                       name='num_ctx_placeholder')
+
+    def get_turn_features(self):
+        """
+        Sets turn_word_features / turn_hidden_features: [utterances, candidates, features] accumulation inputs.
+        """
+        num_utt = tf.shape(self.ctx)[0]
+        num_candidates = tf.shape(self.resp_word_emb)[0]
+        utt_idx = tf.reshape(tf.tile(tf.expand_dims(tf.range(num_utt), 1), [1, num_candidates]), [-1])
+        candidate_idx = tf.tile(tf.range(num_candidates), [num_utt])
+
+        num_layers = len(self.params.filter_width)
+        pool_output = self.match_and_convolve(tf.gather(self.ctx_word_emb, utt_idx),
+                                              tf.gather(self.rnn_ctx_output, utt_idx),
+                                              tf.gather(self.resp_word_emb, candidate_idx),
+                                              tf.gather(self.rnn_resp_output, candidate_idx))
+        word_match, hidden_match = self.get_accumulated_match([list(pool_output[:num_layers])], [list(pool_output[num_layers:])])
+
+        word_dim, hidden_dim = word_match.shape[-1].value, hidden_match.shape[-1].value
+        self.turn_word_features = tf.reshape(word_match, tf.stack([num_utt, num_candidates, word_dim]))
+        self.turn_hidden_features = tf.reshape(hidden_match, tf.stack([num_utt, num_candidates, hidden_dim]))
+
+        with tf.variable_scope('placeholder'):
+            self.word_feature_seq = tf.placeholder(dtype=tf.float32, shape=[None, None, word_dim], name='word_feature_seq')
+            self.hidden_feature_seq = tf.placeholder(dtype=tf.float32, shape=[None, None, hidden_dim], name='hidden_feature_seq')
+
+    def get_window_scores(self):
+        final_hidden_state = self.get_final_hidden_state(self.word_feature_seq, self.hidden_feature_seq, self.num_ctx_placeholders)
+        logits = self.convert_to_logits(final_hidden_state)
+        # class 1 is the positive (matching) response
+        self.positive_score = tf.nn.softmax(logits)[:, 1]
+
+
+class SessionScorer:
+    def __init__(self, session, graph_obj, dict_obj, cache_size=None, cache_mb=None):
+        """
+        Scores a fixed candidate bank as the next response of live conversations.
+        Every turn is encoded and matched against the bank once; its features are cached per conversation for the
+        next NUM_CONTEXT - 1 turns, so a turn costs one utterance plus the accumulation RNN whatever the history.
+        :param graph_obj: SessionGraph with restored variables
+        :param cache_size: optional cap on the conversations kept
+        :param cache_mb: size of the cached features; the least recently active conversation is evicted first
+        """
+        self.session = session
+        self.graph_obj = graph_obj
+        self.dict_obj = dict_obj
+        self.params = graph_obj.params
+        self.reader = DataReader(self.params)
+        self.cache_size = cache_size if cache_size is not None else self.params.session_cache_size
+        self.cache_bytes = (cache_mb if cache_mb is not None else self.params.session_cache_mb) * 2 ** 20
+        self.turn_bytes = 0
+        self.sessions = OrderedDict()
+        self.candidates = []
+        self.bank_word_emb = None
+        self.bank_hidden = None
+
+    def encode_candidates(self, candidates, chunk_size=256):
+        """
+        :return: ([K, MAX_RESP_UTT_LENGTH, EMB_DIM] word embeddings, [K, MAX_RESP_UTT_LENGTH, RNN_HIDDEN_DIM] RNN outputs)
+        """
+        word_emb_chunks, hidden_chunks = [], []
+        for start in range(0, len(candidates), chunk_size):
+            resp_arr, resp_len_arr = self.reader.encode_utterances(candidates[start:start + chunk_size], self.dict_obj,
+                                                                   self.params.MAX_RESP_UTT_LENGTH)
+            word_emb, hidden = self.session.run([self.graph_obj.resp_word_emb, self.graph_obj.rnn_resp_output],
+                                                feed_dict={self.graph_obj.resp: resp_arr, self.graph_obj.resp_len_placeholders: resp_len_arr})
+            word_emb_chunks.append(word_emb)
+            hidden_chunks.append(hidden)
+        return np.concatenate(word_emb_chunks), np.concatenate(hidden_chunks)
+
+    def load_candidates(self, candidates, bank_path=None, fingerprint=None):
+        """
+        Sets the candidate bank and drops every cached conversation (their features belong to the old bank).
+        :param bank_path: .npz cache of the encoded bank, reused while its fingerprint matches
+        :param fingerprint: fingerprint of the model and the candidates, see bank_fingerprint()
+        """
+        self.candidates = list(candidates)
+        if bank_path is not None and artifact_cache.is_fresh(bank_path, fingerprint):
+            arrays = np.load(bank_path)
+            self.bank_word_emb, self.bank_hidden = arrays['word_emb'], arrays['hidden']
+            arrays.close()
+            print('Loaded encoded candidate bank from %s' % bank_path)
+        else:
+            self.bank_word_emb, self.bank_hidden = self.encode_candidates(self.candidates)
+            if bank_path is not None:
+                np.savez(bank_path, word_emb=self.bank_word_emb, hidden=self.bank_hidden)
+                artifact_cache.mark(bank_path, fingerprint)
+        self.sessions.clear()
+
+        self.turn_bytes = len(self.candidates) * (self.graph_obj.word_feature_seq.shape[-1].value +
+                                                  self.graph_obj.hidden_feature_seq.shape[-1].value) * 4
+        conversation_bytes = self.turn_bytes * self.params.NUM_CONTEXT
+        print('Candidate bank: %d responses, up to %.1f MB of cached features per conversation, %d full conversations in %.0f MB'
+              % (len(self.candidates), conversation_bytes / 2.0 ** 20, self.cache_bytes // max(conversation_bytes, 1),
+                 self.cache_bytes / 2.0 ** 20))
+
+    def turn_features(self, utterances):
+        """
+        :return: ([U, K, word features], [U, K, hidden features]) of the utterances against the candidate bank
+        """
+        utt_arr, utt_len_arr = self.reader.encode_utterances(utterances, self.dict_obj, self.params.MAX_CTX_UTT_LENGTH)
+        return self.session.run([self.graph_obj.turn_word_features, self.graph_obj.turn_hidden_features],
+                                feed_dict={self.graph_obj.ctx: utt_arr,
+                                           self.graph_obj.ctx_len_placeholders: utt_len_arr,
+                                           self.graph_obj.resp_word_emb: self.bank_word_emb,
+                                           self.graph_obj.rnn_resp_output: self.bank_hidden})
+
+    def get_window(self, session_id):
+        window = self.sessions.pop(session_id, None)
+        if window is None:
+            window = deque(maxlen=self.params.NUM_CONTEXT)
+        self.sessions[session_id] = window
+        return window
+
+    def cached_bytes(self):
+        return sum(len(each_window) for each_window in self.sessions.values()) * self.turn_bytes
+
+    def evict(self):
+        """
+        Drops the least recently active conversations until the cache fits; the active one is always kept.
+        """
+        while len(self.sessions) > 1 and (self.cached_bytes() > self.cache_bytes or
+                                          (self.cache_size is not None and len(self.sessions) > self.cache_size)):
+            self.sessions.popitem(last=False)
+
+    def start_session(self, session_id, history):
+        """
+        (Re)starts a conversation from its previous turns, e.g. after it was evicted; the last NUM_CONTEXT turns
+        are encoded in one run.
+        :return: candidate scores as the next response
+        """
+        window = self.get_window(session_id)
+        window.clear()
+        history = list(history)[-self.params.NUM_CONTEXT:]
+        word_features, hidden_features = self.turn_features(history)
+        for i in range(len(history)):
+            window.append((word_features[i], hidden_features[i]))
+        self.evict()
+        return self.score_window(window)
+
+    def add_turn(self, session_id, utterance):
+        """
+        Appends a turn to a conversation; an unknown (or evicted) conversation starts with this turn.
+        :return: [K] scores of the candidates as the next response
+        """
+        window = self.get_window(session_id)
+        word_features, hidden_features = self.turn_features([utterance])
+        window.append((word_features[0], hidden_features[0]))
+        self.evict()
+        return self.score_window(window)
+
+    def end_session(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def score_window(self, window):
+        num_candidates = len(self.candidates)
+        return self.session.run(self.graph_obj.positive_score,
+                                feed_dict={self.graph_obj.word_feature_seq: np.stack([each_turn[0] for each_turn in window], axis=1),
+                                           self.graph_obj.hidden_feature_seq: np.stack([each_turn[1] for each_turn in window], axis=1),
+                                           self.graph_obj.num_ctx_placeholders: np.full(num_candidates, len(window), dtype=np.int32)})
+
+    def top_k(self, scores, k):
+        """
+        :return: [(candidate, score)] of the k best candidates
+        """
+        best = np.argsort(-scores)[:k]
+        return [(self.candidates[each_idx], float(scores[each_idx])) for each_idx in best]
+
+
+def bank_fingerprint(params, dir_obj, candidates):
+    """
+    Fingerprint of an encoded candidate bank: model settings, checkpoint version and the candidate texts.
+    """
+    return artifact_cache.combine(params.model_fingerprint(), artifact_cache.file_signature(dir_obj.test_model + '.index'),
+                                  list(candidates))
+
+
+def create_session_scorer(params, dir_obj, dict_obj, cache_size=None, cache_mb=None):
+    """
+    Utility function to build the session graph in its own session and restore the test model into it
+    :param params: test config (num_classes and vocab_size set)
+    :return: SessionScorer
+    """
+    params = params.replace(shared_ctx_encoding=False, ragged_contexts=False)
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.variable_scope('classifier', reuse=None):
+            graph_obj = SessionGraph(params, dir_obj)
+        session = tf.Session(graph=graph)
+        artifact_cache.check_checkpoint(dir_obj.test_model, params.model_fingerprint())
+        tf.train.Saver().restore(session, dir_obj.test_model)
+    return SessionScorer(session, graph_obj, dict_obj, cache_size, cache_mb)
@@ -4,8 +4,10 @@ import time
 import numpy as np
 import tensorflow as tf
 
-from global_module.implementation_module import SMN, DataReader
-from global_module.settings_module import ParamsClass, Directory
+from global_module.implementation_module import SMN, DataReader, ScoreWriter
+from global_module.implementation_module.distillation import student_params
+from global_module.pre_processing_module import InternedDataset
+from global_module.settings_module import Directory, artifact_cache, get_params
 
 iter_train = 0
 iter_valid = 0
@@ -14,45 +16,43 @@ iter_valid = 0
 class Test:
     def run_epoch(self, session, eval_op, model_obj, dict_obj, verbose=False):
         global summary, iter_train, iter_valid
-        epoch_combined_loss = 0.0
-        total_correct = 0.0
-        total_instances = 0.0
         print('\nrun epoch')
 
-        output_file = open(Directory('TE').test_cost_path, 'w')
 
         params = model_obj.params
         dir_obj = model_obj.dir_obj
-        data_filename = dir_obj.data_filename
-        label_filename = dir_obj.label_filename
-
-        for step, (ctx_arr, ctx_len_arr, num_ctx_arr, resp_arr, resp_len_arr, label_arr) \
-                in enumerate(DataReader(params).data_iterator(data_filename, label_filename, model_obj.params.indices, dict_obj)):
-
-            feed_dict = {model_obj.ctx: ctx_arr,
-                         model_obj.ctx_len_placeholders: ctx_len_arr,
-                         model_obj.num_ctx_placeholders: num_ctx_arr,
-                         model_obj.resp: resp_arr,
-                         model_obj.resp_len_placeholders: resp_len_arr,
-                         model_obj.label: label_arr
-                         }
-
-            loss, prediction, probabilities, accuracy, _ = session.run([model_obj.loss,
-                                                                        model_obj.prediction,
-                                                                        model_obj.probabilities,
-                                                                        model_obj.accuracy,
-                                                                        eval_op],
-                                                                       feed_dict=feed_dict)
-
-            total_correct += np.sum(prediction == label_arr)
-            total_instances += params.batch_size
-            epoch_combined_loss += loss
-
-            for idx, each_pred in enumerate(probabilities):
-                # output_file.write(str(each_pred) + '\t'  + str(probabilities[idx]) + '\n')
-                output_file.write(str(each_pred[1]) + '\n')
-        print 'CE loss: %.4f, Accuracy: %.4f' % (epoch_combined_loss, (total_correct / total_instances) * 100)
-        return epoch_combined_loss
+        dataset = InternedDataset.load(dir_obj.interned_data_path) if params.use_interned_data else None
+        score_writer = self.create_score_writer(params, dir_obj)
+
+        session.run(model_obj.metric_reset_op)
+
+        for step, batch in enumerate(DataReader(params).batch_iterator(dir_obj, model_obj.params.indices, dict_obj, dataset)):
+
+            feed_dict = model_obj.get_feed_dict(batch)
+
+            positive_score, _, _ = session.run([model_obj.positive_score,
+                                                model_obj.metric_update_op,
+                                                eval_op],
+                                               feed_dict=feed_dict)
+
+            score_writer.write(positive_score, batch[0])
+
+        score_writer.close()
+        metrics = model_obj.read_metrics(session)
+        print 'CE loss: %.4f, Accuracy: %.4f' % (metrics['loss'], metrics['accuracy'] * 100)
+        if model_obj.has_ranking_metrics:
+            print('Ranking: MRR: %.4f, ' % metrics['mrr'] +
+                  ', '.join(['R@%d: %.4f' % (k, metrics['r%d' % k]) for k in params.recall_k if 'r%d' % k in metrics]))
+        return metrics['loss']
+
+    def create_score_writer(self, params, dir_obj):
+        if params.score_output == 'text':
+            score_path = dir_obj.test_cost_path
+        elif params.score_top_k is not None:
+            score_path = dir_obj.test_top_k_path
+        else:
+            score_path = dir_obj.test_score_path
+        return ScoreWriter(score_path, params.score_output, params.score_flush_rows, params.score_top_k)
 
     def get_length(self, filename):
         print('Reading :', filename)
@@ -66,12 +66,18 @@ class Test:
     def init_test(self, dict_obj):
         mode_train, mode_test = 'TR', 'TE'
 
-        params_train = ParamsClass(mode=mode_train)
+        params_train = get_params(mode=mode_train)
         dir_train = Directory(mode_train)
 
         # test object
-        params_test = ParamsClass(mode=mode_test)
+        params_test = get_params(mode=mode_test)
         dir_test = Directory(mode_test)
+        if params_test.distillation:
+            # evaluate the distilled student, SMN_PARAM_distillation=false evaluates the teacher
+            params_test = student_params(params_test)
+            dir_test.use_student_model()
+        if params_test.embedding_compression is not None:
+            dir_test.use_compressed_model()
         params_test.num_instances, params_test.indices = self.get_length(dir_test.data_filename)
         # params_test.batch_size = 1
 
@@ -80,7 +86,7 @@ class Test:
         min_loss = sys.float_info.max
 
         word_emb_path = dir_train.word_embedding
-        word_emb_matrix = np.float32(np.genfromtxt(word_emb_path, delimiter=' '))
+        word_emb_matrix = artifact_cache.load_word_embedding(word_emb_path)
         params_train.vocab_size = params_test.vocab_size = len(word_emb_matrix)
 
         print('***** INITIALIZING TF GRAPH *****')
@@ -97,7 +103,8 @@ class Test:
 
         model_saver = tf.train.Saver()
         print('Loading model ...')
-        model_saver.restore(session, Directory('TE').test_model)
+        artifact_cache.check_checkpoint(dir_test.test_model, params_test.model_fingerprint())
+        model_saver.restore(session, dir_test.test_model)
 
         print('**** MODEL LOADED ****\n')
 
@@ -1,3 +1,4 @@
+import itertools
 import os
 import random
 import sys
@@ -6,108 +7,128 @@ import time
 import numpy as np
 import tensorflow as tf
 
-from global_module.implementation_module import SMN, DataReader
-from global_module.settings_module import ParamsClass, Dictionary, Directory
+from global_module.implementation_module import SMN, DataReader, MemoryTracker, ValidationPolicy
+from global_module.implementation_module.distillation import load_teacher_scores, project_embedding, student_params
+from global_module.pre_processing_module import HardNegativeSampler, InternedDataset, NegativeSampler
+from global_module.pre_processing_module.hard_negative_sampler import interned_mining_input, text_mining_input
+from global_module.settings_module import Dictionary, Directory, artifact_cache, get_params
 
 iter_train = 0
 iter_valid = 0
 
 
 class Train:
-    def run_epoch(self, session, writer, eval_op, min_cost, model_obj, dict_obj, epoch_num, verbose=False):
+    def __init__(self, memory_tracker=None):
+        """
+        :param memory_tracker: MemoryTracker shared with the stages run before training, None creates one from ParamsClass
+        """
+        self.memory = memory_tracker
+        self.model_saver = None
+        self.epoch_completed = True
+        self.neg_sampler = None
+        self.teacher_scores = None
+        self.datasets = {}
+
+    def run_epoch(self, session, writer, eval_op, min_cost, model_obj, dict_obj, epoch_num, verbose=False,
+                  index_arr=None, deadline=None, save_model=True):
         global summary, iter_train, iter_valid
-        epoch_combined_loss = 0.0
-        total_correct = 0.0
-        total_instances = 0.0
         print('\nrun epoch')
 
         params = model_obj.params
         dir_obj = model_obj.dir_obj
-        data_filename = dir_obj.data_filename
-        label_filename = dir_obj.label_filename
+        if index_arr is None:
+            index_arr = model_obj.params.indices
+        self.epoch_completed = True
 
-        for step, (ctx_arr, ctx_len_arr, num_ctx_arr, resp_arr, resp_len_arr, label_arr) \
-                in enumerate(DataReader(params).data_iterator(data_filename, label_filename, model_obj.params.indices, dict_obj)):
+        session.run(model_obj.metric_reset_op)
 
-            feed_dict = {model_obj.ctx: ctx_arr,
-                         model_obj.ctx_len_placeholders: ctx_len_arr,
-                         model_obj.num_ctx_placeholders: num_ctx_arr,
-                         model_obj.resp: resp_arr,
-                         model_obj.resp_len_placeholders: resp_len_arr,
-                         model_obj.label: label_arr
-                         }
+        neg_sampler = None
+        if params.mode == 'TR' and self.neg_sampler is not None:
+            neg_sampler = self.neg_sampler
+            neg_sampler.reseed(epoch_num)
+
+        stage_name = '%s_epoch_%d' % ('train' if params.mode == 'TR' else 'valid', epoch_num + 1)
+        teacher_scores = self.teacher_scores if params.mode == 'TR' else None
+        batches = DataReader(params, neg_sampler, teacher_scores).batch_iterator(dir_obj, index_arr, dict_obj, self.datasets.get(params.mode))
+        self.memory.begin(stage_name + '_reader')
+        # the reader materialises its rows when the first batch is requested
+        first_batch = next(batches, None)
+        self.memory.end()
+        self.memory.begin(stage_name)
+
+        step = -1
+        for step, batch in enumerate(itertools.chain([first_batch], batches) if first_batch is not None else []):
+            self.memory.check()
+
+            if deadline is not None and step > 0 and time.time() > deadline:
+                print('Validation time budget exhausted after %d batches.' % step)
+                self.epoch_completed = False
+                break
+
+            feed_dict = model_obj.get_feed_dict(batch)
 
             if model_obj.params.mode == 'TR':
 
                 iter_train += 1
-                if iter_train % params.log_step == 0:
+                if params.log and iter_train % params.log_step == 0:
                     # print 'writing'
 
                     run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
                     run_metadata = tf.RunMetadata()
 
-                    summary, loss, prediction, probabilities, accuracy, _ = session.run([model_obj.merged_train,
-                                                                                         model_obj.loss,
-                                                                                         model_obj.prediction,
-                                                                                         model_obj.probabilities,
-                                                                                         model_obj.accuracy,
-                                                                                         eval_op],
-                                                                                        options=run_options,
-                                                                                        run_metadata=run_metadata,
-                                                                                        feed_dict=feed_dict)
-
-                    total_correct += np.sum(prediction == label_arr)
-                    total_instances += params.batch_size
-                    epoch_combined_loss += loss
-
-                    if params.log:
-                        writer.add_run_metadata(run_metadata, 'step%d' % iter_train)
-                        writer.add_summary(summary, iter_train)
-
-                        # print(iter_train, accuracy)
+                    summary, _, _ = session.run([model_obj.merged_train, eval_op, model_obj.metric_update_op],
+                                                options=run_options,
+                                                run_metadata=run_metadata,
+                                                feed_dict=feed_dict)
+
+                    writer.add_run_metadata(run_metadata, 'step%d' % iter_train)
+                    writer.add_summary(summary, iter_train)
+                    self.memory.record_run_metadata(run_metadata)
+                elif params.memory_trace_tf and step == 0:
+                    run_metadata = tf.RunMetadata()
+                    session.run([eval_op, model_obj.metric_update_op], feed_dict=feed_dict,
+                                options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                run_metadata=run_metadata)
+                    self.memory.record_run_metadata(run_metadata)
                 else:
-                    summary, loss, prediction, probabilities, accuracy, _ = session.run([model_obj.merged_train,
-                                                                                         model_obj.loss,
-                                                                                         model_obj.prediction,
-                                                                                         model_obj.probabilities,
-                                                                                         model_obj.accuracy,
-                                                                                         eval_op],
-                                                                                        feed_dict=feed_dict)
-
-                    total_correct += np.sum(prediction == label_arr)
-                    total_instances += params.batch_size
-                    epoch_combined_loss += loss
+                    session.run([eval_op, model_obj.metric_update_op], feed_dict=feed_dict)
 
-            else:
-                summary, loss, prediction, probabilities, accuracy, _ = session.run([model_obj.merged_else,
-                                                                                     model_obj.loss,
-                                                                                     model_obj.prediction,
-                                                                                     model_obj.probabilities,
-                                                                                     model_obj.accuracy,
-                                                                                     eval_op],
-                                                                                    feed_dict=feed_dict)
-
-                total_correct += np.sum(prediction == label_arr)
-                total_instances += params.batch_size
-                epoch_combined_loss += loss
+                if params.grad_accum_steps > 1 and (step + 1) % params.grad_accum_steps == 0:
+                    session.run(model_obj.apply_accum_op)
 
+            else:
                 iter_valid += 1
-                if params.log:
-                    if iter_valid % 5 == 0:
-                        # print 'writing'
-                        writer.add_summary(summary, iter_valid)
+                if params.log and iter_valid % 5 == 0:
+                    # print 'writing'
+                    summary, _, _ = session.run([model_obj.merged_else, eval_op, model_obj.metric_update_op], feed_dict=feed_dict)
+                    writer.add_summary(summary, iter_valid)
+                else:
+                    session.run([eval_op, model_obj.metric_update_op], feed_dict=feed_dict)
+
+        if params.mode == 'TR' and params.grad_accum_steps > 1 and step >= 0 and (step + 1) % params.grad_accum_steps != 0:
+            # flush the partially accumulated gradients of the last micro-batches
+            session.run(model_obj.apply_accum_op)
+        self.memory.end()
+
+        metrics = model_obj.read_metrics(session)
+        epoch_combined_loss = metrics['loss']
 
-        print 'Epoch Num: %d, CE loss: %.4f, Accuracy: %.4f' % (epoch_num, epoch_combined_loss, (total_correct / total_instances) * 100)
+        print 'Epoch Num: %d, CE loss: %.4f, Accuracy: %.4f' % (epoch_num, epoch_combined_loss, metrics['accuracy'] * 100)
+        if model_obj.has_ranking_metrics:
+            print('Ranking: MRR: %.4f, ' % metrics['mrr'] +
+                  ', '.join(['R@%d: %.4f' % (k, metrics['r%d' % k]) for k in params.recall_k if 'r%d' % k in metrics]))
 
-        if params.mode == 'VA':
-            model_saver = tf.train.Saver()
+        if params.mode == 'VA' and save_model and self.epoch_completed:
+            if self.model_saver is None:
+                self.model_saver = tf.train.Saver()
             print('**** Current minimum on valid set: %.4f ****' % min_cost)
 
             if epoch_combined_loss < min_cost:
                 min_cost = epoch_combined_loss
-                model_saver.save(session,
-                                 save_path=dir_obj.model_path + dir_obj.model_name,
-                                 latest_filename=dir_obj.latest_checkpoint)
+                self.model_saver.save(session,
+                                      save_path=dir_obj.model_path + dir_obj.model_name,
+                                      latest_filename=dir_obj.latest_checkpoint)
+                artifact_cache.mark(dir_obj.model_path + dir_obj.model_name, params.model_fingerprint())
                 print('==== Model saved! ====')
 
         return epoch_combined_loss, min_cost
@@ -121,31 +142,128 @@ class Train:
         data_file.close()
         return count, np.arange(count)
 
+    def get_positive_indices(self, label_filename, index_arr):
+        """
+        In-batch training draws its negatives from the other rows of a batch, so only positive rows are kept.
+        """
+        label_file = open(label_filename, 'r')
+        labels = [line.strip() for line in label_file]
+        label_file.close()
+        positive_indices = np.array([each_idx for each_idx in index_arr if labels[each_idx] == '1'])
+        print('In-batch training on %d positive rows out of %d' % (len(positive_indices), len(index_arr)))
+        return positive_indices
+
+    def mine_hard_negatives(self, params, dir_obj, dict_obj):
+        if params.use_interned_data:
+            response_tokens, queries = interned_mining_input(self.neg_sampler, self.datasets[params.mode])
+        else:
+            reader = DataReader(params)
+            encode = lambda utt: [int(each_id) for each_id in reader.get_index_string(utt, dict_obj.word_dict)[1].split()]
+            response_tokens, queries = text_mining_input(self.neg_sampler, dir_obj.data_filename, dir_obj.label_filename, encode)
+        self.neg_sampler.mine(response_tokens, queries, params.hard_negative_candidates, params.num_preprocess_workers,
+                              k1=params.bm25_k1, b=params.bm25_b)
+
+    def rescore_hard_negatives(self, session, model_obj, dict_obj, dir_obj, index_arr):
+        """
+        Re-ranks the mined candidates of every training row by the score of the current model.
+        :param model_obj: model sharing the training variables that runs without dropout, e.g. the validation model
+        """
+        start_time = time.time()
+        scores = []
+        self.neg_sampler.rescoring = True
+        try:
+            for batch in DataReader(model_obj.params, self.neg_sampler).batch_iterator(dir_obj, index_arr, dict_obj, self.datasets.get('TR')):
+                scores.extend(session.run(model_obj.positive_score, feed_dict=model_obj.get_feed_dict(batch)))
+        finally:
+            self.neg_sampler.rescoring = False
+        self.neg_sampler.rerank(index_arr, scores)
+        print('Re-ranked hard negatives: %d pairs scored in %.1f sec' % (len(scores), time.time() - start_time))
+
+    def shuffle_by_dialog(self, data_filename, index_arr):
+        """
+        Shuffles runs of consecutive rows that share a context utterance (the overlapping windows of a dialog and
+        their negatives) instead of single rows, so that shared context encoding still finds its duplicates in a batch.
+        """
+        data_file = open(data_filename, 'r')
+        row_contexts = [set(hash(each_utt) for each_utt in line.rstrip('\n').split('\t')[:-1] if each_utt.strip())
+                        for line in data_file]
+        data_file.close()
+
+        dialogs = []
+        prev_contexts = set()
+        for each_idx in index_arr:
+            curr_contexts = row_contexts[each_idx]
+            if dialogs and curr_contexts & prev_contexts:
+                dialogs[-1].append(each_idx)
+            else:
+                dialogs.append([each_idx])
+            prev_contexts = curr_contexts
+
+        random.shuffle(dialogs)
+        print('Shuffled %d dialogs of %d rows' % (len(dialogs), len(index_arr)))
+        return np.array([each_idx for each_dialog in dialogs for each_idx in each_dialog])
+
     def run_train(self, dict_obj):
         mode_train, mode_valid, mode_all = 'TR', 'VA', 'ALL'
 
         # train object
-        params_train = ParamsClass(mode=mode_train)
+        params_train = get_params(mode=mode_train)
         dir_train = Directory(mode_train)
+        if params_train.distillation:
+            if params_train.negative_sampling or params_train.train_mode == 'in_batch':
+                raise ValueError('Distillation needs the pointwise rows of the data file (no sampled or in-batch negatives)')
+            params_train = student_params(params_train)
+            dir_train.use_student_model()
+        if self.memory is None:
+            self.memory = MemoryTracker(params_train.memory_tracking, params_train.memory_budget_mb)
         params_train.num_instances, params_train.indices = self.get_length(dir_train.data_filename)
+        if params_train.use_interned_data:
+            self.datasets[mode_train] = InternedDataset.load(dir_train.interned_data_path)
+        if params_train.train_mode == 'in_batch':
+            params_train.indices = self.get_positive_indices(dir_train.label_filename, params_train.indices)
+        elif params_train.negative_sampling:
+            if params_train.hard_negative_mining:
+                self.neg_sampler = HardNegativeSampler(params_train.neg_sampling_seed, params_train.neg_sampling_power,
+                                                       params_train.hard_negative_ratio, params_train.hard_negative_pool)
+            else:
+                self.neg_sampler = NegativeSampler(params_train.neg_sampling_seed, params_train.neg_sampling_power)
+            if params_train.use_interned_data:
+                self.neg_sampler.build_from_refs(self.datasets[mode_train].resp_refs, self.datasets[mode_train].labels)
+            else:
+                self.neg_sampler.build(dir_train.data_filename, dir_train.label_filename)
+            if params_train.hard_negative_mining:
+                self.mine_hard_negatives(params_train, dir_train, dict_obj)
 
         # valid object
-        params_valid = ParamsClass(mode=mode_valid)
+        params_valid = get_params(mode=mode_valid)
         dir_valid = Directory(mode_valid)
+        if params_valid.distillation:
+            params_valid = student_params(params_valid)
+            dir_valid.use_student_model()
         params_valid.num_instances, params_valid.indices = self.get_length(dir_valid.data_filename)
+        if params_valid.use_interned_data:
+            self.datasets[mode_valid] = InternedDataset.load(dir_valid.interned_data_path)
 
         params_train.num_classes = params_valid.num_classes = len(dict_obj.label_dict)
 
-        if params_train.enable_shuffle:
+        if params_train.enable_shuffle and params_train.shared_ctx_encoding:
+            params_train.indices = self.shuffle_by_dialog(dir_train.data_filename, params_train.indices)
+            params_valid.indices = self.shuffle_by_dialog(dir_valid.data_filename, params_valid.indices)
+        elif params_train.enable_shuffle:
             random.shuffle(params_train.indices)
             random.shuffle(params_valid.indices)
 
         min_loss = sys.float_info.max
 
         word_emb_path = dir_train.word_embedding
-        word_emb_matrix = np.float32(np.genfromtxt(word_emb_path, delimiter=' '))
+        with self.memory.stage('embedding_load'):
+            word_emb_matrix = artifact_cache.load_word_embedding(word_emb_path)
         params_train.vocab_size = params_valid.vocab_size = len(word_emb_matrix)
 
+        if params_train.distillation:
+            self.teacher_scores = load_teacher_scores(dir_train, dict_obj, params_train.num_instances, self.datasets.get(mode_train))
+            word_emb_matrix = project_embedding(word_emb_matrix, params_train.EMB_DIM)
+
         print('***** INITIALIZING TF GRAPH *****')
 
         timestamp = str(int(time.time()))
@@ -159,12 +277,14 @@ class Train:
             # random_uniform_initializer = tf.random_uniform_initializer(-params_train.init_scale, params_train.init_scale)
             xavier_initializer = tf.contrib.layers.xavier_initializer(uniform=True, seed=None, dtype=tf.float32)
 
-            with tf.variable_scope("classifier", reuse=None, initializer=xavier_initializer):
+            with self.memory.stage('train_graph_build'), \
+                    tf.variable_scope("classifier", reuse=None, initializer=xavier_initializer):
                 train_obj = SMN(params_train, dir_train)
 
             train_writer = tf.summary.FileWriter(train_out_dir, session.graph)
             valid_writer = tf.summary.FileWriter(valid_out_dir)
 
+            self.memory.begin('session_init')
             if not params_train.enable_checkpoint:
                 session.run(tf.global_variables_initializer())
 
@@ -172,15 +292,23 @@ class Train:
                 ckpt = tf.train.get_checkpoint_state(dir_train.model_path)
                 if ckpt and ckpt.model_checkpoint_path:
                     print("Loading model from: %s" % ckpt.model_checkpoint_path)
+                    artifact_cache.check_checkpoint(ckpt.model_checkpoint_path, params_train.model_fingerprint())
                     tf.train.Saver().restore(session, ckpt.model_checkpoint_path)
             elif not params_train.use_random_initializer:
                 session.run(tf.assign(train_obj.word_emb_matrix, word_emb_matrix, name="word_embedding_matrix"))
+            self.memory.end()
 
-            with tf.variable_scope("classifier", reuse=True, initializer=xavier_initializer):
+            with self.memory.stage('valid_graph_build'), \
+                    tf.variable_scope("classifier", reuse=True, initializer=xavier_initializer):
                 valid_obj = SMN(params_valid, dir_valid)
 
+            session.run(tf.local_variables_initializer())
+
             print('**** TF GRAPH INITIALIZED ****')
 
+            valid_policy = ValidationPolicy(params_valid, dir_valid.label_filename)
+            no_op = tf.no_op()
+
             start_time = time.time()
             for i in range(params_train.max_max_epoch):
                 lr_decay = params_train.lr_decay ** max(i - params_train.max_epoch, 0.0)
@@ -190,26 +318,47 @@ class Train:
 
                 print('\n++++++++=========+++++++\n')
 
+                if isinstance(self.neg_sampler, HardNegativeSampler) and params_train.hard_negative_refresh > 0 \
+                        and i > 0 and i % params_train.hard_negative_refresh == 0:
+                    self.neg_sampler.refresh(params_train.num_preprocess_workers)
+                    if params_train.hard_negative_rescore:
+                        self.rescore_hard_negatives(session, valid_obj, dict_obj, dir_train, params_train.indices)
+
                 print("Epoch: %d Learning rate: %.5f" % (i + 1, session.run(train_obj.lr)))
                 train_loss, _ = self.run_epoch(session, train_writer, train_obj.train_op, min_loss, train_obj, dict_obj, i, verbose=True)
                 print("Epoch: %d Train loss: %.3f" % (i + 1, train_loss))
 
-                valid_loss, curr_loss = self.run_epoch(session, valid_writer, tf.no_op(), min_loss, valid_obj, dict_obj, i)
+                last_epoch = (i + 1 == params_train.max_max_epoch)
+                valid_indices, is_full = valid_policy.epoch_indices(i, last_epoch)
+                valid_loss, curr_loss = self.run_epoch(session, valid_writer, no_op, min_loss, valid_obj, dict_obj, i,
+                                                       index_arr=valid_indices,
+                                                       deadline=valid_policy.deadline(is_full),
+                                                       save_model=is_full)
                 if curr_loss < min_loss:
                     min_loss = curr_loss
 
-                print("Epoch: %d Valid loss: %.3f" % (i + 1, valid_loss))
+                print("Epoch: %d Valid loss: %.3f (%s pass)" % (i + 1, valid_loss, 'full' if is_full else 'subsampled'))
 
                 curr_time = time.time()
                 print('1 epoch run takes ' + str(((curr_time - start_time) / (i + 1)) / 60) + ' minutes.')
 
+                if valid_policy.update(valid_loss, is_full, self.epoch_completed):
+                    print('Early stopping after epoch %d.' % (i + 1))
+                    break
+
             train_writer.close()
             valid_writer.close()
 
 
 def main():
-    dict_obj = Dictionary()
-    Train().run_train(dict_obj)
+    params = get_params('TR')
+    memory_tracker = MemoryTracker(params.memory_tracking, params.memory_budget_mb)
+    try:
+        with memory_tracker.stage('dictionary_load'):
+            dict_obj = Dictionary()
+        Train(memory_tracker).run_train(dict_obj)
+    finally:
+        memory_tracker.write_summary(Directory('TR').memory_summary_path)
 
 
 if __name__ == "__main__":
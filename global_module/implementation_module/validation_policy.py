@@ -0,0 +1,90 @@
+import random
+import time
+
+import numpy as np
+
+
+class ValidationPolicy:
+    def __init__(self, params, label_filename):
+        """
+        Decides how much of the validation split is evaluated in each epoch.
+        Subsampled passes are cheap progress checks; only full passes are comparable with each other and
+        therefore drive checkpoint selection and early stopping.
+        :param params: validation ParamsClass object (indices already populated)
+        :param label_filename: label file of the validation split, used for stratification
+        """
+        self.params = params
+        self.full_indices = params.indices
+        self.subsample_indices = None
+        self.full_every = max(1, params.valid_full_every)
+        self.patience = params.early_stop_patience
+        self.time_budget = params.valid_time_budget
+        self.best_loss = None
+        self.bad_passes = 0
+
+        if params.valid_subsample_size is not None and params.valid_subsample_size < len(self.full_indices):
+            self.subsample_indices = self.stratified_subsample(label_filename, params.valid_subsample_size, params.valid_subsample_seed)
+            print('Validation subsample: %d of %d instances, full pass every %d epochs'
+                  % (len(self.subsample_indices), len(self.full_indices), self.full_every))
+
+    def stratified_subsample(self, label_filename, sample_size, seed):
+        """
+        Draws a fixed subsample keeping the label proportions of the full split.
+        :return: sorted index array
+        """
+        label_file = open(label_filename, 'r')
+        labels = [line.strip() for line in label_file]
+        label_file.close()
+
+        label_to_indices = {}
+        for each_idx in self.full_indices:
+            label_to_indices.setdefault(labels[each_idx], []).append(each_idx)
+
+        rng = random.Random(seed)
+        total = float(len(self.full_indices))
+        sampled = []
+        for each_label in sorted(label_to_indices.keys()):
+            curr_indices = label_to_indices[each_label]
+            curr_size = max(1, int(round(sample_size * len(curr_indices) / total)))
+            sampled.extend(rng.sample(curr_indices, min(curr_size, len(curr_indices))))
+
+        return np.array(sorted(sampled))
+
+    def is_full_pass(self, epoch_num, last_epoch=False):
+        if self.subsample_indices is None or last_epoch:
+            return True
+        return (epoch_num + 1) % self.full_every == 0
+
+    def epoch_indices(self, epoch_num, last_epoch=False):
+        """
+        :return: (index array to evaluate, whether the pass covers the full split)
+        """
+        if self.is_full_pass(epoch_num, last_epoch):
+            return self.full_indices, True
+        return self.subsample_indices, False
+
+    def deadline(self, is_full):
+        """
+        :return: time at which a subsampled pass is cut short; full passes always run to the end so that
+                 checkpoint selection and early stopping keep working with any budget
+        """
+        if self.time_budget is None or is_full:
+            return None
+        return time.time() + self.time_budget
+
+    def update(self, valid_loss, is_full, completed):
+        """
+        Records the result of a validation pass.
+        :return: True if training should stop early
+        """
+        if not (is_full and completed) or self.patience is None:
+            return False
+
+        if self.best_loss is None or valid_loss < self.best_loss:
+            self.best_loss = valid_loss
+            self.bad_passes = 0
+            return False
+
+        self.bad_passes += 1
+        print('No improvement on full validation pass (%d / %d)' % (self.bad_passes, self.patience))
+        return self.bad_passes >= self.patience
@@ -1,3 +1,10 @@
 from build_word_vocab import BuildWordVocab
 from build_sampled_training_file import SampleTrainingData
-from generate_label_file import GenerateLabel
\ No newline at end of file
+from generate_label_file import GenerateLabel
+from negative_sampler import NegativeSampler
+from hard_negative_sampler import BM25Index, HardNegativeSampler
+from preprocess_engine import PreprocessEngine
+from update_word_vocab import UpdateWordVocab
+from gen_4context_seq import ContextWindowGenerator
+from intern_dataset import InternedDataset, BuildInternedData
+from stage_runner import Stage, StageRunner
@@ -5,7 +5,7 @@ from global_module.settings_module import set_dir, set_params
 class SampleTrainingData:
     def __init__(self):
         self.glove_dict = cPickle.load(open(set_dir.Directory('TR').glove_path, 'rb'))
-        self.config = set_params.ParamsClass('TR')
+        self.config = set_params.get_params('TR')
 
     def sample_train_file(self, raw_training_file, training_file, threshold):
         raw_training_file_pointer = open(raw_training_file, 'r')
@@ -30,7 +30,7 @@ class SampleTrainingData:
                     if (word_dict.has_key(token) == False):
                         word_dict[token] = 1
                     else:
-                        word_dict[token] += word_dict[token] + 1
+                        word_dict[token] += 1
 
         raw_training_file_pointer.seek(0)
 
@@ -75,7 +75,7 @@ class SampleTrainingData:
     def util(self):
         raw_training_file = set_dir.Directory('TR').raw_train_path
         training_file = set_dir.Directory('TR').data_filename
-        self.sample_train_file(raw_training_file, training_file, set_params.ParamsClass().sampling_threshold)
+        self.sample_train_file(raw_training_file, training_file, set_params.get_params('TR').sampling_threshold)
 
 # def main():
 #     raw_training_file = set_dir.Directory('TR').raw_train_path
@@ -15,7 +15,7 @@ import csv
 import pickle
 import re
 
-from global_module.settings_module import set_dir, set_params
+from global_module.settings_module import artifact_cache, set_dir, set_params
 import random
 import math
 
@@ -26,7 +26,7 @@ class BuildWordVocab:
         self.dataDir = set_dir.Directory('TR').data_path
         self.vocabDir = set_dir.Directory('TR').vocab_path
         self.gloveDict = set_dir.Directory('TR').glove_path
-        self.config = set_params.ParamsClass('TR')
+        self.config = set_params.get_params('TR')
 
     def generate_vocab(self, training_file):
         word_dict = {}
@@ -81,6 +81,40 @@ class BuildWordVocab:
         return word_dict
 
 
+    def normalize_key(self, key, glove_vocab_dict):
+        if (self.config.all_lowercase):
+            if (glove_vocab_dict.has_key(key.lower())):
+                key = key.lower()
+            elif (glove_vocab_dict.has_key(key)):
+                key = key
+            elif (glove_vocab_dict.has_key(key.title())):
+                key = key.title()
+            elif (glove_vocab_dict.has_key(key.upper())):
+                key = key.upper()
+            else:
+                key = key.lower()
+        return key
+
+    def get_word_vector(self, key, glove_vocab_dict, length_word_vector):
+        """
+        :return: initial vector string of a new vocab word, None if the word is mapped to UNK instead
+        """
+        if(self.config.use_unknown_word):
+            if(glove_vocab_dict.has_key(key) and self.config.use_random_initializer == False):
+                if(key != 'UNK'):
+                    return glove_vocab_dict.get(key)
+            else:
+                vec_str = ''
+                for i in range(length_word_vector):
+                    vec_str += str(round(random.uniform(-0.9, 0.9), 6)) + ' '
+                return vec_str.strip()
+        elif (glove_vocab_dict.has_key(key) and self.config.use_random_initializer == False and self.config.use_unknown_word == False):
+            if (key != 'UNK'):
+                return glove_vocab_dict.get(key)
+        elif (self.config.use_random_initializer):
+            return glove_vocab_dict.get('UNK')
+        return None
+
     def extract_glove_vectors(self, word_vocab_file, glove_file):
         glove_vocab_dict = cPickle.load(open(glove_file, 'rb'))
         word_vocab_dict = cPickle.load(open(word_vocab_file, 'rb'))
@@ -99,43 +133,14 @@ class BuildWordVocab:
             length_word_vector = len(glove_vocab_dict.get('the').split(' '))
 
         for key, value in word_vocab_dict.items():
-            if (self.config.all_lowercase):
-                if (glove_vocab_dict.has_key(key.lower())):
-                    key = key.lower()
-                elif (glove_vocab_dict.has_key(key)):
-                    key = key
-                elif (glove_vocab_dict.has_key(key.title())):
-                    key = key.title()
-                elif (glove_vocab_dict.has_key(key.upper())):
-                    key = key.upper()
-                else:
-                    key = key.lower()
+            key = self.normalize_key(key, glove_vocab_dict)
 
             if(not glove_present_training_word_vocab_dict.has_key(key)):
-                if(self.config.use_unknown_word):
-                    if(glove_vocab_dict.has_key(key) and self.config.use_random_initializer == False):
-                        if(key != 'UNK'):
-                            glove_present_training_word_vocab_dict[key] = glove_present_training_word_counter
-                            glove_present_word_vector_dict[glove_present_training_word_counter] = glove_vocab_dict.get(key)
-                            glove_present_training_word_counter += 1
-                    else:
-                        glove_present_training_word_vocab_dict[key] = glove_present_training_word_counter
-                        vec_str = ''
-                        for i in range(length_word_vector):
-                            vec_str += str(round(random.uniform(-0.9, 0.9), 6)) + ' '
-                        glove_present_word_vector_dict[glove_present_training_word_counter] = vec_str.strip()
-                        glove_present_training_word_counter += 1
-                elif (glove_vocab_dict.has_key(key) and self.config.use_random_initializer == False and self.config.use_unknown_word == False):
-                    if (key != 'UNK'):
-                        glove_present_training_word_vocab_dict[key] = glove_present_training_word_counter
-                        glove_present_word_vector_dict[glove_present_training_word_counter] = glove_vocab_dict.get(key)
-                        glove_present_training_word_counter += 1
-                elif (self.config.use_random_initializer):
+                word_vector = self.get_word_vector(key, glove_vocab_dict, length_word_vector)
+                if word_vector is not None:
                     glove_present_training_word_vocab_dict[key] = glove_present_training_word_counter
-                    glove_present_word_vector_dict[glove_present_training_word_counter] = glove_vocab_dict.get('UNK')
+                    glove_present_word_vector_dict[glove_present_training_word_counter] = word_vector
                     glove_present_training_word_counter += 1
-                    # else :
-                    #     print('Error')
 
         word_vector_file = open(set_dir.Directory('TR').word_embedding, 'w')
         writer = csv.writer(word_vector_file)
@@ -165,10 +170,22 @@ class BuildWordVocab:
         # return(len(glove_present_word_vector_dict)+2)
         return (len(glove_present_word_vector_dict) + 1)
 
-    def util(self):
-        training_file = set_dir.Directory('TR').data_filename
-        self.generate_vocab(training_file)
-        vocab_size = self.extract_glove_vectors(set_dir.Directory('TR').word_vocab_dict, self.gloveDict)
+    def util(self, generate_vocab=True):
+        """
+        :param generate_vocab: False when word_vocab.pkl was already written by PreprocessEngine
+        """
+        dir_obj = set_dir.Directory('TR')
+        if generate_vocab:
+            self.generate_vocab(dir_obj.data_filename)
+
+        outputs = [dir_obj.word_embedding, dir_obj.glove_present_training_word_vocab]
+        fingerprint = self.config.fingerprint('vocab', artifact_cache.file_digest(dir_obj.word_vocab_dict),
+                                              artifact_cache.file_signature(self.gloveDict))
+        if artifact_cache.is_fresh(outputs, fingerprint):
+            print('Vocab and word embedding are up to date (%s), skipping' % fingerprint)
+            return len(cPickle.load(open(dir_obj.glove_present_training_word_vocab, 'rb'))) + 1
+        vocab_size = self.extract_glove_vectors(dir_obj.word_vocab_dict, self.gloveDict)
+        artifact_cache.mark(outputs, fingerprint)
         return vocab_size
 
 # def main():
@@ -1,51 +1,41 @@
-import random
-def create_negative_sampled_data(training_filename, input_filename):
-    training_file = open(training_filename, 'r').readlines()
-    neg_examples = 5
+import sys
 
-    op_utt_file = open(input_filename + '_UTT_' + str(neg_examples) + '_NEGATIVE.txt', 'w')
-    op_label_file = open(input_filename + '_LABEL_' + str(neg_examples) + '_NEGATIVE.txt', 'w')
-
-    agent_resp_to_index_map = {}
-    agent_index_to_resp_map = {}
-
-    count = 0
-
-    for each_line in training_file:
-        agent_resp = each_line.strip().split('\t')[-1]
-        if(not agent_resp_to_index_map.has_key(agent_resp)):
-            agent_resp_to_index_map[agent_resp] = count
-            agent_index_to_resp_map[count] = agent_resp
-            count += 1
+from global_module.pre_processing_module.negative_sampler import NegativeSampler
 
-    print len(agent_resp_to_index_map)
 
-    end = len(agent_resp_to_index_map)
+def create_negative_sampled_data(training_filename, input_filename, neg_examples=5, seed=1234):
+    """
+    Materialises fixed negatives for an evaluation file. Training no longer needs this:
+    DataReader samples fresh negatives on the fly when ParamsClass.negative_sampling is set.
+    """
+    sampler = NegativeSampler(seed=seed).build(training_filename)
 
+    op_utt_file = open(input_filename + '_UTT_' + str(neg_examples) + '_NEGATIVE.txt', 'w')
+    op_label_file = open(input_filename + '_LABEL_' + str(neg_examples) + '_NEGATIVE.txt', 'w')
 
     input_file = open(input_filename, 'r')
     for each_line in input_file:
         line_split = each_line.strip().split('\t')
-        agent_index = agent_resp_to_index_map[line_split[-1]]
-
-        r = range(0, agent_index) + range(agent_index+1, end)
-
-        random.shuffle(r)
+        agent_index = sampler.response_to_id.get(line_split[-1], -1)
 
         context = '\t'.join(line_split[:-1]).strip()
 
         op_utt_file.write(each_line.strip() + '\n')
         op_label_file.write('1\n')
 
-        for i in range(neg_examples):
-            op_utt_file.write(context + '\t' + agent_index_to_resp_map[r[i]] + '\n')
+        for each_neg in sampler.sample(agent_index, neg_examples):
+            op_utt_file.write(context + '\t' + sampler.responses[each_neg] + '\n')
             op_label_file.write('0\n')
 
+    input_file.close()
     op_utt_file.close()
     op_label_file.close()
 
-training_filename = '/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/base_data/train/jpmc_demo_train_raw_formatted.txt_tokenized_4_context_seq.txt'
-valid_data = '/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/base_data/test/jpmc_demo_test_raw_transformed.txt_tokenized_4_context_seq.txt'
+
+def main():
+    training_filename, input_filename = sys.argv[1], sys.argv[2]
+    create_negative_sampled_data(training_filename, input_filename)
 
 
-create_negative_sampled_data(training_filename, valid_data)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
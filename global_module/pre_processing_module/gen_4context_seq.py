@@ -1,28 +1,98 @@
-def generate_4context_seq():
-    input_file = '/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/base_data/test/jpmc_demo_test_raw_transformed.txt_tokenized'
-    conv_file = open(input_file, 'r')
-    end_str = '======================='
-
-    seq_file = open(input_file + '_4_context_seq.txt', 'w')
-
-    conv_list = []
-    total_4context_seq = 0
-
-    for line in conv_file:
-        line = line.strip()
-        if(line.startswith(end_str)):
-            conv_len = len(conv_list)
-            print(conv_len)
-            total_4context_seq += (conv_len - 5) / 2 + 1
-            seq_file.write(conv_list[0] + "\t" + conv_list[1] + "\t" + conv_list[2] + "\n")
-            for i in range(0, conv_len, 2):
-                if(i+4 < conv_len):
-                    seq_file.write(conv_list[i] + "\t" + conv_list[i+1] + "\t" + conv_list[i+2] + "\t" + conv_list[i+3] + "\t" + conv_list[i+4] + "\n")
-            conv_list = []
-        else:
-            conv_list.append(line)
-    print(total_4context_seq)
-    seq_file.close()
-    conv_file.close()
-
-generate_4context_seq()
\ No newline at end of file
+import multiprocessing
+import sys
+
+from global_module.settings_module import set_params
+
+END_MARKER = '====='
+
+
+class ContextWindowGenerator:
+    def __init__(self, config=None):
+        """
+        Builds (NUM_CONTEXT contexts, response) windows from conversation files in which conversations are
+        separated by a line starting with '====='. Window size, stride and minimum turn count come from ParamsClass.
+        """
+        self.config = config if config is not None else set_params.get_params('TR')
+        self.window_size = self.config.NUM_CONTEXT + 1
+        self.stride = self.config.window_stride
+        self.min_turns = self.config.window_min_turns
+
+    def iter_conversations(self, filename):
+        """
+        Streams conversations as lists of utterances; a trailing conversation without end marker is ignored.
+        """
+        conv_file = open(filename, 'r')
+        conv_list = []
+        for line in conv_file:
+            line = line.strip()
+            if line.startswith(END_MARKER):
+                yield conv_list
+                conv_list = []
+            else:
+                conv_list.append(line)
+        conv_file.close()
+
+    def iter_windows(self, conv_list):
+        """
+        Yields the leading partial windows (min_turns, min_turns + stride, ... utterances) followed by every
+        full window of window_size utterances, advancing by stride.
+        """
+        conv_len = len(conv_list)
+        for end in range(self.min_turns, min(self.window_size, conv_len + 1), self.stride):
+            yield conv_list[:end]
+        for start in range(0, conv_len - self.window_size + 1, self.stride):
+            yield conv_list[start:start + self.window_size]
+
+    def iter_window_lines(self, filename):
+        for conv_list in self.iter_conversations(filename):
+            for window in self.iter_windows(conv_list):
+                yield '\t'.join(window)
+
+    def iter_encoded(self, filename, dict_obj):
+        """
+        Feeds windows straight into the id encoding of DataReader, without an intermediate text file.
+        :return: generator of DataReader.encode_line tuples
+        """
+        from global_module.implementation_module.reader import DataReader
+        reader = DataReader(self.config)
+        for window_line in self.iter_window_lines(filename):
+            yield reader.encode_line(window_line, dict_obj)
+
+    def output_filename(self, input_filename):
+        return input_filename + '_' + str(self.config.NUM_CONTEXT) + '_context_seq.txt'
+
+    def generate_file(self, input_filename):
+        seq_file = open(self.output_filename(input_filename), 'w')
+        total_seq = 0
+        for window_line in self.iter_window_lines(input_filename):
+            seq_file.write(window_line + '\n')
+            total_seq += 1
+        seq_file.close()
+        print('%s: %d context sequences' % (input_filename, total_seq))
+        return total_seq
+
+    def generate_files(self, input_filenames, num_workers=None):
+        """
+        Processes many conversation files in parallel, one output file per input file.
+        """
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            counts = pool.map(generate_file_worker, [(self.config, each_file) for each_file in input_filenames])
+        finally:
+            pool.close()
+            pool.join()
+        print('Total context sequences: %d' % sum(counts))
+        return counts
+
+
+def generate_file_worker(args):
+    config, input_filename = args
+    return ContextWindowGenerator(config).generate_file(input_filename)
+
+
+def main():
+    ContextWindowGenerator().generate_files(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
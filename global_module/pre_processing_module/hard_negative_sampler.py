@@ -0,0 +1,215 @@
+import math
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+
+from global_module.pre_processing_module.negative_sampler import NegativeSampler
+
+
+class BM25Index:
+    def __init__(self, k1=1.2, b=0.75, max_df=0.05):
+        """
+        Inverted index over token-id documents scored with BM25.
+        :param max_df: query terms occurring in more than this fraction of the documents are ignored (stop words)
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+        self.num_docs = 0
+        self.postings = {}
+
+    def build(self, documents):
+        """
+        :param documents: list of token-id sequences, document i gets id i
+        """
+        self.num_docs = len(documents)
+        doc_len = np.array([len(each_doc) for each_doc in documents], dtype=np.float32)
+        avg_len = max(float(doc_len.mean()), 1.0) if self.num_docs else 1.0
+
+        doc_ids = {}
+        term_freqs = {}
+        for doc_id, each_doc in enumerate(documents):
+            for token, term_freq in Counter(each_doc).iteritems():
+                doc_ids.setdefault(token, []).append(doc_id)
+                term_freqs.setdefault(token, []).append(term_freq)
+
+        max_postings = max(1, int(self.max_df * self.num_docs))
+        for token in doc_ids:
+            if len(doc_ids[token]) > max_postings:
+                continue
+            ids = np.array(doc_ids[token], dtype=np.int32)
+            term_freq = np.array(term_freqs[token], dtype=np.float32)
+            idf = math.log(1.0 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * doc_len[ids] / avg_len)
+            self.postings[token] = (ids, idf * term_freq * (self.k1 + 1.0) / (term_freq + norm))
+
+        print('BM25 index: %d documents, %d indexed terms' % (self.num_docs, len(self.postings)))
+        return self
+
+    def query(self, tokens, top_n, exclude_id=-1):
+        """
+        :return: ids of the top_n documents by BM25 score (best first), documents without a matching term are left out
+        """
+        matched = [self.postings[token] for token in set(tokens) if token in self.postings]
+        if not matched:
+            return []
+        ids, inverse = np.unique(np.concatenate([each_ids for each_ids, _ in matched]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([each_weights for _, each_weights in matched]))
+        scores[ids == exclude_id] = 0.0
+
+        if len(scores) > top_n:
+            top = np.argpartition(-scores, top_n)[:top_n]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='mergesort')]
+        return [int(ids[each]) for each in top if scores[each] > 0.0]
+
+
+_worker_index = None
+
+
+def init_mining_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def mine_chunk(args):
+    queries, top_n, retired = args
+    results = []
+    for row_idx, tokens, positive_id in queries:
+        row_retired = retired.get(row_idx, ())
+        row_candidates = _worker_index.query(tokens, top_n + len(row_retired), positive_id)
+        results.append((row_idx, [each for each in row_candidates if each not in row_retired][:top_n]))
+    return results
+
+
+class HardNegativeSampler(NegativeSampler):
+    def __init__(self, seed=1234, power=0.0, hard_ratio=0.5, pool_size=10):
+        """
+        Mixes lexically similar but wrong responses, retrieved with BM25 over token ids, into the random negatives.
+        :param hard_ratio: share of the negatives of a row taken from its mined candidates
+        :param pool_size: hard negatives are drawn from the best pool_size candidates of the current ranking
+        """
+        NegativeSampler.__init__(self, seed, power)
+        self.hard_ratio = hard_ratio
+        self.pool_size = pool_size
+        self.candidates = {}
+        self.retired = {}
+        self.rescoring = False
+        self.index = None
+        self.queries = []
+        self.top_n = 0
+
+    def mine(self, response_tokens, queries, top_n, num_workers=None, chunk_size=1000, k1=1.2, b=0.75):
+        """
+        Builds the BM25 index and retrieves the top_n responses for every query over a process pool.
+        :param response_tokens: token ids of every interned response, aligned with self.responses
+        :param queries: list of (row index, context token ids, id of the positive response)
+        """
+        self.index = BM25Index(k1, b).build(response_tokens)
+        self.queries = queries
+        self.top_n = top_n
+        self.run_queries(num_workers, chunk_size)
+        print('Mined hard negatives for %d rows' % len(self.candidates))
+        return self
+
+    def refresh(self, num_workers=None, chunk_size=1000):
+        """
+        Re-mines every query over a process pool, skipping the candidates a row has already drawn its hard negatives
+        from. Retired candidates stay at the end of the list, so a row whose neighbours run out keeps them.
+        """
+        for row_idx, row_candidates in self.candidates.iteritems():
+            self.retired.setdefault(row_idx, set()).update(row_candidates[:self.pool_size])
+        previous = self.candidates
+        self.candidates = {}
+        self.run_queries(num_workers, chunk_size)
+
+        num_new = 0
+        for row_idx, row_candidates in self.candidates.iteritems():
+            num_new += len(row_candidates)
+            fresh = set(row_candidates)
+            row_candidates.extend(each for each in previous.get(row_idx, []) if each not in fresh)
+        print('Refreshed hard negatives: %d new candidates for %d rows' % (num_new, len(self.candidates)))
+
+    def run_queries(self, num_workers, chunk_size):
+        chunks = []
+        for start in range(0, len(self.queries), chunk_size):
+            chunk_queries = self.queries[start:start + chunk_size]
+            chunk_retired = dict((row_idx, self.retired[row_idx]) for row_idx, _, _ in chunk_queries if row_idx in self.retired)
+            chunks.append((chunk_queries, self.top_n, chunk_retired))
+
+        pool = multiprocessing.Pool(num_workers, initializer=init_mining_worker, initargs=(self.index,))
+        try:
+            for each_result in pool.imap(mine_chunk, chunks):
+                for row_idx, row_candidates in each_result:
+                    self.candidates[row_idx] = row_candidates
+        finally:
+            pool.close()
+            pool.join()
+
+    def rerank(self, index_arr, scores):
+        """
+        Reorders the candidates of every row by model score, given the scores of a rescoring pass over index_arr
+        (the positive row followed by all its candidates, rows without candidates contribute the positive only).
+        """
+        position = 0
+        for each_idx in index_arr:
+            row_candidates = self.candidates.get(each_idx)
+            if row_candidates is None:
+                continue
+            if position + 1 + len(row_candidates) > len(scores):
+                break
+            row_scores = scores[position + 1:position + 1 + len(row_candidates)]
+            self.candidates[each_idx] = [row_candidates[each] for each in np.argsort(-np.asarray(row_scores), kind='mergesort')]
+            position += 1 + len(row_candidates)
+
+    def sample_for_row(self, row_idx, positive_id, num_samples):
+        row_candidates = self.candidates.get(row_idx, [])
+        if self.rescoring:
+            return row_candidates
+
+        num_samples = min(num_samples, len(self.responses) - 1)
+        hard_pool = row_candidates[:self.pool_size]
+        sampled = self.rng.sample(hard_pool, min(int(round(num_samples * self.hard_ratio)), len(hard_pool)))
+        while len(sampled) < num_samples:
+            idx = self.draw()
+            if idx != positive_id and idx not in sampled:
+                sampled.append(idx)
+        return sampled
+
+
+def text_mining_input(sampler, data_filename, label_filename, encode):
+    """
+    :param encode: function mapping an utterance to its token ids
+    :return: (response token ids, queries) for HardNegativeSampler.mine from a text data file
+    """
+    response_tokens = [encode(each_response) for each_response in sampler.responses]
+    queries = []
+    data_file = open(data_filename, 'r')
+    label_file = open(label_filename, 'r')
+    for row_idx, (each_line, each_label) in enumerate(zip(data_file, label_file)):
+        if each_label.strip() != '1':
+            continue
+        line_split = each_line.strip().split('\t')
+        tokens = [token for each_utt in line_split[:-1] for token in encode(each_utt) if token > 0]
+        queries.append((row_idx, tokens, sampler.response_to_id.get(line_split[-1].strip(), -1)))
+    data_file.close()
+    label_file.close()
+    return response_tokens, queries
+
+
+def interned_mining_input(sampler, dataset):
+    """
+    :return: (response token ids, queries) for HardNegativeSampler.mine from an InternedDataset
+    """
+    def utterance_tokens(utt_id):
+        return dataset.utt_tokens[dataset.utt_offsets[utt_id]:dataset.utt_offsets[utt_id + 1]].tolist()
+
+    response_tokens = [utterance_tokens(each_ref) for each_ref in sampler.responses]
+    queries = []
+    for row_idx in np.flatnonzero(dataset.labels == 1):
+        tokens = [token for each_ref in dataset.ctx_refs[row_idx][:dataset.num_ctx[row_idx]]
+                  for token in utterance_tokens(each_ref) if token > 0]
+        queries.append((int(row_idx), tokens, sampler.response_to_id.get(int(dataset.resp_refs[row_idx]), -1)))
+    return response_tokens, queries
@@ -0,0 +1,132 @@
+# Utterance-interned dataset format
+# Every distinct utterance of a split is encoded once and stored as a ragged token-id array:
+#   utt_tokens  - token ids of all unique utterances, concatenated
+#   utt_offsets - utterance u spans utt_tokens[utt_offsets[u]:utt_offsets[u + 1]], u = 0 is the empty utterance
+#   ctx_refs    - [rows, NUM_CONTEXT] utterance ids of the contexts, 0 for missing contexts
+#   num_ctx     - [rows] number of real contexts
+#   resp_refs   - [rows] utterance id of the response
+#   labels      - [rows]
+# Rows sharing a context (a positive and its negatives) repeat only NUM_CONTEXT + 3 integers.
+
+import os
+
+import numpy as np
+
+from global_module.settings_module import artifact_cache, set_dict, set_dir, set_params
+
+# bumped whenever the layout changes, so files of an older layout are rebuilt
+INTERNED_FORMAT = 2
+
+
+class InternedDataset:
+    def __init__(self, utt_tokens, utt_offsets, ctx_refs, num_ctx, resp_refs, labels):
+        self.utt_tokens = utt_tokens
+        self.utt_offsets = utt_offsets
+        self.ctx_refs = ctx_refs
+        self.num_ctx = num_ctx
+        self.resp_refs = resp_refs
+        self.labels = labels
+
+        self.num_rows = len(labels)
+        self.num_utterances = len(utt_offsets) - 1
+        self.padded_tables = {}
+
+    def save(self, path):
+        np.savez(path, utt_tokens=self.utt_tokens, utt_offsets=self.utt_offsets, ctx_refs=self.ctx_refs,
+                 num_ctx=self.num_ctx, resp_refs=self.resp_refs, labels=self.labels)
+
+    @staticmethod
+    def load(path):
+        arrays = np.load(path)
+        dataset = InternedDataset(arrays['utt_tokens'], arrays['utt_offsets'], arrays['ctx_refs'],
+                                  arrays['num_ctx'], arrays['resp_refs'], arrays['labels'])
+        arrays.close()
+        print('Loaded %s: %d rows, %d unique utterances' % (path, dataset.num_rows, dataset.num_utterances))
+        return dataset
+
+    def padded_table(self, max_len):
+        """
+        :return: ([utterances, max_len] zero-padded token ids, [utterances] lengths clipped to max_len), built once per length
+        """
+        if max_len not in self.padded_tables:
+            lengths = np.minimum(np.diff(self.utt_offsets), max_len).astype(np.int32)
+            table = np.zeros((self.num_utterances, max_len), dtype=np.int32)
+            positions = np.arange(max_len)
+            mask = positions[None, :] < lengths[:, None]
+            table[mask] = self.utt_tokens[(self.utt_offsets[:-1, None] + positions[None, :])[mask]]
+            self.padded_tables[max_len] = (table, lengths)
+        return self.padded_tables[max_len]
+
+
+class BuildInternedData:
+    def __init__(self, config=None):
+        self.config = config if config is not None else set_params.get_params('TR')
+
+    def build(self, data_filename, label_filename, word_dict):
+        """
+        Encodes a tab-separated (contexts..., response) file with its label file into an InternedDataset.
+        """
+        from global_module.implementation_module.reader import DataReader
+        reader = DataReader(self.config)
+        num_context = self.config.NUM_CONTEXT
+
+        utt_to_id = {'': 0}
+        utt_tokens = []
+        # utterance 0 is the empty utterance (padding): a zero-length row before the first real one
+        utt_offsets = [0, 0]
+        ctx_refs = []
+        num_ctx = []
+        resp_refs = []
+        labels = []
+
+        def intern(utterance):
+            utt_id = utt_to_id.get(utterance)
+            if utt_id is None:
+                utt_id = len(utt_offsets) - 1
+                utt_to_id[utterance] = utt_id
+                _, index_string = reader.get_index_string(utterance, word_dict)
+                utt_tokens.extend(int(each_id) for each_id in index_string.split())
+                utt_offsets.append(len(utt_tokens))
+            return utt_id
+
+        data_file = open(data_filename, 'r')
+        label_file = open(label_filename, 'r')
+        for each_line, each_label in zip(data_file, label_file):
+            line_split = [each_utt.strip() for each_utt in each_line.strip().split('\t')]
+            curr_ctx_refs = [intern(each_utt) for each_utt in line_split[:-1]]
+            num_ctx.append(len(curr_ctx_refs))
+            ctx_refs.append(curr_ctx_refs + [0] * (num_context - len(curr_ctx_refs)))
+            resp_refs.append(intern(line_split[-1]))
+            labels.append(int(each_label.strip()))
+        data_file.close()
+        label_file.close()
+
+        dataset = InternedDataset(np.array(utt_tokens, dtype=np.int32),
+                                  np.array(utt_offsets, dtype=np.int64),
+                                  np.array(ctx_refs, dtype=np.int32).reshape(-1, num_context),
+                                  np.array(num_ctx, dtype=np.int32),
+                                  np.array(resp_refs, dtype=np.int32),
+                                  np.array(labels, dtype=np.int32))
+        print('%s: %d rows, %d unique utterances out of %d' % (data_filename, dataset.num_rows, dataset.num_utterances - 1,
+                                                               int(dataset.num_ctx.sum()) + dataset.num_rows))
+        return dataset
+
+    def util(self, modes=('TR', 'VA', 'TE')):
+        """
+        (Re)builds the interned file of every mode whose text, labels, vocab or settings changed.
+        """
+        vocab_digest = artifact_cache.file_digest(set_dir.Directory('TR').glove_present_training_word_vocab)
+        word_dict = None
+        for each_mode in modes:
+            dir_obj = set_dir.Directory(each_mode)
+            if os.path.exists(dir_obj.data_filename) and os.path.exists(dir_obj.label_filename):
+                fingerprint = self.config.fingerprint('interned', artifact_cache.file_digest(dir_obj.data_filename),
+                                                      artifact_cache.file_digest(dir_obj.label_filename), vocab_digest,
+                                                      INTERNED_FORMAT)
+                if artifact_cache.is_fresh(dir_obj.interned_data_path, fingerprint):
+                    print('%s is up to date (%s), skipping' % (dir_obj.interned_data_path, fingerprint))
+                    continue
+                if word_dict is None:
+                    word_dict = set_dict.Dictionary().word_dict
+                self.build(dir_obj.data_filename, dir_obj.label_filename, word_dict).save(dir_obj.interned_data_path)
+                artifact_cache.mark(dir_obj.interned_data_path, fingerprint)
@@ -0,0 +1,126 @@
+import random
+
+
+class NegativeSampler:
+    def __init__(self, seed=1234, power=0.0):
+        """
+        Draws negative responses from an interned table of unique responses.
+        Every draw is O(1) (uniform or alias-table lookup), so sampling k negatives costs O(k) instead of
+        shuffling the whole response pool for every line.
+        :param seed: base seed, reseed(epoch_num) derives a reproducible stream per epoch
+        :param power: 0.0 samples uniformly over unique responses, 1.0 by response frequency, 0.75 in between
+        """
+        self.seed = seed
+        self.power = power
+        self.rng = random.Random(seed)
+
+        self.response_to_id = {}
+        self.responses = []
+        self.counts = []
+        self.encoded_responses = {}
+
+        self.alias_prob = None
+        self.alias_idx = None
+
+    def intern(self, response):
+        response_id = self.response_to_id.get(response)
+        if response_id is None:
+            response_id = len(self.responses)
+            self.response_to_id[response] = response_id
+            self.responses.append(response)
+            self.counts.append(0)
+        self.counts[response_id] += 1
+        return response_id
+
+    def build(self, data_filename, label_filename=None):
+        """
+        Interns the response column (last tab-separated field) of a data file.
+        When a label file is given, only responses of positive rows enter the pool.
+        """
+        data_file = open(data_filename, 'r')
+        label_file = open(label_filename, 'r') if label_filename is not None else None
+
+        for each_line in data_file:
+            curr_label = label_file.readline().strip() if label_file is not None else '1'
+            if curr_label == '1':
+                self.intern(each_line.rstrip('\n').split('\t')[-1].strip())
+
+        data_file.close()
+        if label_file is not None:
+            label_file.close()
+
+        if self.power > 0.0:
+            self.build_alias_table()
+
+        print('Negative sampler: %d unique responses' % len(self.responses))
+        return self
+
+    def build_from_refs(self, resp_refs, labels):
+        """
+        Interns the response utterance ids of the positive rows of an InternedDataset;
+        responses[id] then holds an utterance id instead of a string.
+        """
+        for resp_ref, label in zip(resp_refs, labels):
+            if label == 1:
+                self.intern(int(resp_ref))
+
+        if self.power > 0.0:
+            self.build_alias_table()
+
+        print('Negative sampler: %d unique responses' % len(self.responses))
+        return self
+
+    def build_alias_table(self):
+        """
+        Vose's alias method over count ** power.
+        """
+        num_items = len(self.counts)
+        weights = [each_count ** self.power for each_count in self.counts]
+        total = float(sum(weights))
+        scaled = [each_weight * num_items / total for each_weight in weights]
+
+        self.alias_prob = [0.0] * num_items
+        self.alias_idx = [0] * num_items
+        small = [idx for idx, value in enumerate(scaled) if value < 1.0]
+        large = [idx for idx, value in enumerate(scaled) if value >= 1.0]
+
+        while small and large:
+            curr_small = small.pop()
+            curr_large = large.pop()
+            self.alias_prob[curr_small] = scaled[curr_small]
+            self.alias_idx[curr_small] = curr_large
+            scaled[curr_large] = scaled[curr_large] + scaled[curr_small] - 1.0
+            if scaled[curr_large] < 1.0:
+                small.append(curr_large)
+            else:
+                large.append(curr_large)
+
+        for idx in small + large:
+            self.alias_prob[idx] = 1.0
+
+    def reseed(self, epoch_num):
+        self.rng.seed(self.seed + epoch_num)
+
+    def draw(self):
+        idx = self.rng.randrange(len(self.responses))
+        if self.alias_prob is not None and self.rng.random() >= self.alias_prob[idx]:
+            idx = self.alias_idx[idx]
+        return idx
+
+    def sample(self, positive_id, num_samples):
+        """
+        :return: num_samples distinct response ids, all different from positive_id
+        """
+        num_samples = min(num_samples, len(self.responses) - 1)
+        sampled = []
+        while len(sampled) < num_samples:
+            idx = self.draw()
+            if idx != positive_id and idx not in sampled:
+                sampled.append(idx)
+        return sampled
+
+    def sample_for_row(self, row_idx, positive_id, num_samples):
+        """
+        Hook for samplers that pick negatives per training row; the base sampler ignores the row.
+        """
+        return self.sample(positive_id, num_samples)
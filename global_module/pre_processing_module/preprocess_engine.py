@@ -0,0 +1,215 @@
+# Sharded, streaming preprocessing of the raw training file
+# Replaces SampleTrainingData.util() followed by BuildWordVocab.generate_vocab():
+#   raw_tokenized_train.txt -> tokenized_train.txt (rare words rewritten to UNK)
+#                           -> tokenized_training (#<num> suffixes stripped)
+#                           -> word_vocab.pkl (ids from 2, in order of first occurrence)
+# Every worker streams its byte range of the raw file to count tokens, waits for the merged counts and
+# then streams the range again to write its shard files. Only counts and vocabularies go through the pipes,
+# no process holds the lines of a shard.
+
+import cPickle
+import multiprocessing
+import os
+import re
+import shutil
+import time
+from collections import Counter
+
+from global_module.settings_module import artifact_cache, set_dir, set_params
+
+HASH_NUM = re.compile(r'#[0-9]+')
+
+
+def strip_hash_num(text):
+    if '#' in text:
+        return HASH_NUM.sub('', text)
+    return text
+
+
+def shard_offsets(filename, num_shards):
+    """
+    Splits a file into num_shards byte ranges that start and end on line boundaries.
+    :return: list of (start, end) offsets
+    """
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    data_file = open(filename, 'rb')
+    for shard_num in range(1, num_shards):
+        data_file.seek(max(file_size * shard_num // num_shards, boundaries[-1]))
+        data_file.readline()
+        boundaries.append(min(data_file.tell(), file_size))
+    data_file.close()
+    boundaries.append(file_size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(num_shards) if boundaries[i] < boundaries[i + 1]]
+
+
+def read_shard(filename, start, end):
+    data_file = open(filename, 'rb')
+    data_file.seek(start)
+    position = start
+    while position < end:
+        line = data_file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+    data_file.close()
+
+
+def shard_worker(raw_filename, start, end, shard_prefix, conn):
+    # pass 1: count
+    num_lines = 0
+    word_count = Counter()
+    for line in read_shard(raw_filename, start, end):
+        num_lines += 1
+        for utterance in line.strip().split('\t'):
+            word_count.update(strip_hash_num(utterance.strip()).split(' '))
+    conn.send((num_lines, word_count))
+
+    # pass 2: UNK rewrite, cleaned output and first occurrence of every token
+    kept_words = conn.recv()
+    training_file = open(shard_prefix + '.train', 'w')
+    tokenized_file = open(shard_prefix + '.tokenized', 'w')
+    first_seen = []
+    seen = set()
+    max_sequence_length = 0
+
+    for line in read_shard(raw_filename, start, end):
+        line = line.strip()
+        rewritten_utterances = []
+        cleaned_utterances = []
+        curr_seq_length = 0
+        for utterance in line.split('\t'):
+            rewritten = [token if token.split('#')[0] in kept_words else 'UNK' for token in utterance.split(' ')]
+            cleaned = strip_hash_num(' '.join(rewritten).strip()).split(' ')
+            rewritten_utterances.append(' '.join(rewritten))
+            cleaned_utterances.append(' '.join(cleaned))
+            curr_seq_length += len([token for token in cleaned if token])
+            for token in cleaned:
+                if token not in seen:
+                    seen.add(token)
+                    first_seen.append(token)
+        training_file.write('\t'.join(rewritten_utterances) + '\n')
+        tokenized_file.write('\t'.join(cleaned_utterances) + '\n')
+        max_sequence_length = max(max_sequence_length, curr_seq_length)
+
+    training_file.close()
+    tokenized_file.close()
+    conn.send((first_seen, max_sequence_length))
+    conn.close()
+
+
+def receive(process, conn, shard_prefix):
+    """
+    :return: next message of a shard worker; raises when the worker died before sending it
+    """
+    try:
+        return conn.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('Preprocessing worker of %s exited with code %s' % (shard_prefix, process.exitcode))
+
+
+class PreprocessEngine:
+    def __init__(self):
+        self.dir_obj = set_dir.Directory('TR')
+        self.config = set_params.get_params('TR')
+
+    def get_kept_words(self, word_count, threshold):
+        """
+        Words that survive the UNK rewrite: frequent enough and, unless unknown words are allowed, present in glove.
+        """
+        kept_words = set(word for word, count in word_count.iteritems() if count > threshold)
+        if not self.config.use_unknown_word and not self.config.use_random_initializer:
+            glove_dict = cPickle.load(open(self.dir_obj.glove_path, 'rb'))
+            kept_words = set(word for word in kept_words if word in glove_dict)
+        return kept_words
+
+    def merge_shard_files(self, shard_prefixes, suffix, output_filename):
+        output_file = open(output_filename, 'wb')
+        for shard_prefix in shard_prefixes:
+            shard_file = open(shard_prefix + suffix, 'rb')
+            shutil.copyfileobj(shard_file, output_file)
+            shard_file.close()
+            os.remove(shard_prefix + suffix)
+        output_file.close()
+
+    def run(self, raw_training_file, training_file, tokenized_file, word_vocab_file, threshold, num_workers=None):
+        start_time = time.time()
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        print('\nPreprocessing %s with %d workers .... ' % (raw_training_file, num_workers))
+
+        workers = []
+        for shard_num, (start, end) in enumerate(shard_offsets(raw_training_file, num_workers)):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            shard_prefix = training_file + '.shard-%03d' % shard_num
+            process = multiprocessing.Process(target=shard_worker, args=(raw_training_file, start, end, shard_prefix, child_conn))
+            process.start()
+            # the parent keeps only its end, so a dead worker shows up as EOF instead of a blocked recv()
+            child_conn.close()
+            workers.append((process, parent_conn, shard_prefix))
+
+        try:
+            num_lines = 0
+            word_count = Counter()
+            for process, conn, shard_prefix in workers:
+                shard_lines, shard_count = receive(process, conn, shard_prefix)
+                num_lines += shard_lines
+                word_count.update(shard_count)
+
+            kept_words = self.get_kept_words(word_count, threshold)
+            for _, conn, _ in workers:
+                conn.send(kept_words)
+
+            word_dict = {}
+            word_counter = 2
+            max_sequence_length = 0
+            for process, conn, shard_prefix in workers:
+                first_seen, shard_max_length = receive(process, conn, shard_prefix)
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError('Preprocessing worker of %s exited with code %s' % (shard_prefix, process.exitcode))
+                max_sequence_length = max(max_sequence_length, shard_max_length)
+                for token in first_seen:
+                    if token not in word_dict:
+                        word_dict[token] = word_counter
+                        word_counter += 1
+        except Exception:
+            for process, _, _ in workers:
+                if process.is_alive():
+                    process.terminate()
+            raise
+
+        shard_prefixes = [shard_prefix for _, _, shard_prefix in workers]
+        self.merge_shard_files(shard_prefixes, '.train', training_file)
+        self.merge_shard_files(shard_prefixes, '.tokenized', tokenized_file)
+
+        word_vocab = open(word_vocab_file, 'wb')
+        cPickle.dump(word_dict, word_vocab, protocol=cPickle.HIGHEST_PROTOCOL)
+        word_vocab.close()
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        rare_words_count = len([word for word, count in word_count.iteritems() if count <= threshold])
+        print('Preprocessing Completed \n ========================== \n Lines: %d (%.0f lines/sec) \n Total unique words: %d \n '
+              'Rare words: %d \n Unique tokens: excluding padding and unkown words %d \n Max. sequence length: %d\n ==========================\n'
+              % (num_lines, num_lines / elapsed, len(word_count), rare_words_count, word_counter - 2, max_sequence_length))
+        return word_dict
+
+    def util(self):
+        """
+        Skips the run when its outputs were built from the same raw file and settings.
+        :return: word dict, None when the existing outputs were reused
+        """
+        outputs = [self.dir_obj.data_filename, self.dir_obj.data_path + '/tokenized_training', self.dir_obj.word_vocab_dict]
+        fingerprint = self.config.fingerprint('preprocess', artifact_cache.file_digest(self.dir_obj.raw_train_path),
+                                              artifact_cache.file_signature(self.dir_obj.glove_path))
+        if artifact_cache.is_fresh(outputs, fingerprint):
+            print('Preprocessed files are up to date (%s), skipping' % fingerprint)
+            return None
+        word_dict = self.run(self.dir_obj.raw_train_path, outputs[0], outputs[1], outputs[2],
+                             self.config.sampling_threshold,
+                             self.config.num_preprocess_workers)
+        artifact_cache.mark(outputs, fingerprint)
+        return word_dict
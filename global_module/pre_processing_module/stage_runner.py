@@ -0,0 +1,191 @@
+# Incremental runner for the preprocessing DAG
+# Every stage declares the files it reads and writes. A stage is up to date when the content hashes of its
+# inputs and its settings fingerprint match the ones recorded in the state file after its last successful run,
+# and its outputs are still there unchanged. Stages whose inputs come from other stages run after them;
+# stale stages without dependencies between them run in parallel processes.
+
+import json
+import multiprocessing
+import os
+import time
+
+from global_module.settings_module import artifact_cache
+
+
+class Stage:
+    def __init__(self, name, fn, inputs=(), outputs=(), settings=None, external=()):
+        """
+        :param fn: callable without arguments doing the work, run in a forked process when parallel
+        :param inputs: files hashed by content
+        :param outputs: files written by fn
+        :param settings: fingerprint of the settings the outputs depend on
+        :param external: large static inputs (glove) identified by size and mtime only
+        """
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.settings = settings
+        self.external = list(external)
+
+
+def run_stage_process(fn):
+    fn()
+
+
+class StageRunner:
+    def __init__(self, state_path, parallel=True, dry_run=False, memory_tracker=None):
+        """
+        :param state_path: JSON file keeping the input hashes of every stage between runs
+        :param dry_run: only print which stages would rebuild
+        """
+        self.state_path = state_path
+        self.parallel = parallel
+        self.dry_run = dry_run
+        self.memory_tracker = memory_tracker
+        self.stages = []
+        self.state = {'stages': {}, 'digests': {}}
+        if os.path.exists(state_path):
+            state_file = open(state_path, 'r')
+            self.state = json.load(state_file)
+            state_file.close()
+
+    def add(self, stage):
+        if stage.name in [each_stage.name for each_stage in self.stages]:
+            raise ValueError('Duplicate stage %s' % stage.name)
+        self.stages.append(stage)
+
+    def save_state(self):
+        state_file = open(self.state_path + '.tmp', 'w')
+        json.dump(self.state, state_file, indent=1, sort_keys=True)
+        state_file.close()
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def digest(self, path):
+        """
+        Content hash of a file, recomputed only when its size or mtime changed since it was last hashed.
+        """
+        signature = artifact_cache.file_signature(path)
+        if signature is None:
+            return None
+        cached = self.state['digests'].get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        content_digest = artifact_cache.file_digest(path)
+        self.state['digests'][path] = [signature, content_digest]
+        return content_digest
+
+    def stage_key(self, stage):
+        return artifact_cache.combine(stage.settings,
+                                      [(path, self.digest(path)) for path in stage.inputs],
+                                      [(path, artifact_cache.file_signature(path)) for path in stage.external])
+
+    def dependencies(self):
+        """
+        :return: dict of stage name -> names of the stages producing its inputs
+        """
+        producers = {}
+        for each_stage in self.stages:
+            for path in each_stage.outputs:
+                producers[path] = each_stage.name
+        return dict((each_stage.name, set(producers[path] for path in each_stage.inputs
+                                          if path in producers and producers[path] != each_stage.name))
+                    for each_stage in self.stages)
+
+    def levels(self):
+        """
+        :return: stages grouped in topological levels; the stages of a level do not depend on each other
+        """
+        dependencies = self.dependencies()
+        done = set()
+        levels = []
+        remaining = list(self.stages)
+        while remaining:
+            level = [each_stage for each_stage in remaining if dependencies[each_stage.name] <= done]
+            if not level:
+                raise ValueError('Cyclic stage dependencies among %s' % ', '.join(each_stage.name for each_stage in remaining))
+            levels.append(level)
+            done.update(each_stage.name for each_stage in level)
+            remaining = [each_stage for each_stage in remaining if each_stage.name not in done]
+        return levels
+
+    def stale_reason(self, stage, rebuilt):
+        """
+        :param rebuilt: names of the stages going to be rebuilt in a dry run; after a real rebuild the input
+                        hashes decide, so a rebuilt stage with unchanged outputs does not cascade
+        :return: why the stage has to run, None if it is up to date
+        """
+        upstream = sorted(self.dependencies()[stage.name] & rebuilt)
+        if upstream and self.dry_run:
+            return 'upstream %s rebuilt' % ', '.join(upstream)
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            raise IOError('Stage %s is missing its inputs: %s' % (stage.name, ', '.join(missing)))
+        record = self.state['stages'].get(stage.name)
+        if record is None:
+            return 'never run'
+        if record['key'] != self.stage_key(stage):
+            return 'inputs or settings changed'
+        for path in stage.outputs:
+            if record['outputs'].get(path) != artifact_cache.file_signature(path):
+                return 'output %s missing or modified' % os.path.basename(path)
+        return None
+
+    def record(self, stage):
+        self.state['stages'][stage.name] = {'key': self.stage_key(stage),
+                                            'outputs': dict((path, artifact_cache.file_signature(path)) for path in stage.outputs),
+                                            'finished': time.time()}
+
+    def run_level(self, stages):
+        """
+        :return: names of the stages that failed in parallel processes
+        """
+        if len(stages) == 1 or not self.parallel:
+            for each_stage in stages:
+                print('Running stage %s' % each_stage.name)
+                if self.memory_tracker is not None:
+                    with self.memory_tracker.stage(each_stage.name):
+                        each_stage.fn()
+                else:
+                    each_stage.fn()
+            return []
+
+        print('Running stages %s in parallel' % ', '.join(each_stage.name for each_stage in stages))
+        processes = []
+        for each_stage in stages:
+            process = multiprocessing.Process(target=run_stage_process, args=(each_stage.fn,))
+            process.start()
+            processes.append((each_stage, process))
+        failed = []
+        for each_stage, process in processes:
+            process.join()
+            if process.exitcode != 0:
+                failed.append(each_stage.name)
+        return failed
+
+    def run(self):
+        """
+        Runs every stale stage level by level; the state is saved after each level so a crash keeps finished stages.
+        :return: names of the stages that ran (or would run in a dry run)
+        """
+        rebuilt = set()
+        for level in self.levels():
+            stale = []
+            for each_stage in level:
+                reason = self.stale_reason(each_stage, rebuilt)
+                print('%-20s %s' % (each_stage.name, 'up to date' if reason is None else 'rebuild: ' + reason))
+                if reason is not None:
+                    stale.append(each_stage)
+            rebuilt.update(each_stage.name for each_stage in stale)
+            if self.dry_run or not stale:
+                continue
+            failed = self.run_level(stale)
+            for each_stage in stale:
+                if each_stage.name not in failed:
+                    self.record(each_stage)
+            self.save_state()
+            if failed:
+                raise RuntimeError('Stages failed: %s' % ', '.join(failed))
+        if not self.dry_run:
+            self.save_state()
+        return rebuilt
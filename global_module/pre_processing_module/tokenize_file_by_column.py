@@ -1,19 +1,145 @@
 # -*- coding: utf-8 -*-
+import cPickle
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
 import nltk
 
+from global_module.settings_module import set_dir, set_params
+
+
+def tokenize_utterance(utterance):
+    return str(' '.join(nltk.word_tokenize(utterance))).strip()
+
+
+class UtteranceCache:
+    def __init__(self, max_size):
+        """
+        Bounded LRU memo of tokenized utterances, keyed by the md5 digest of the raw utterance.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def key(self, utterance):
+        return hashlib.md5(utterance).digest()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, path):
+        if path is not None and os.path.exists(path):
+            cache_file = open(path, 'rb')
+            self.entries = cPickle.load(cache_file)
+            cache_file.close()
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            print('Loaded %d cached utterances from %s' % (len(self.entries), path))
+
+    def save(self, path):
+        if path is not None:
+            cache_file = open(path, 'wb')
+            cPickle.dump(self.entries, cache_file, protocol=cPickle.HIGHEST_PROTOCOL)
+            cache_file.close()
+
+
+class ParallelTokenizer:
+    def __init__(self, num_workers=None, cache_size=None, cache_path=None, chunk_lines=20000):
+        """
+        Tokenizes one column of a tab-separated file. Each distinct utterance is tokenized once (per cache lifetime),
+        misses of a chunk of lines are tokenized over a process pool, and output keeps the input line order.
+        :param cache_path: pickle file the memo is loaded from and saved to between runs, None keeps it in memory
+        """
+        config = set_params.get_params('TR')
+        self.pool_size = num_workers or config.num_preprocess_workers or multiprocessing.cpu_count()
+        self.cache = UtteranceCache(cache_size if cache_size is not None else config.tokenizer_cache_size)
+        self.cache_path = cache_path
+        self.chunk_lines = chunk_lines
+        self.hits = 0
+        self.misses = 0
+
+    def tokenize_chunk(self, pool, utterances):
+        keys = [self.cache.key(each_utt) for each_utt in utterances]
+        resolved = {}
+        missing = OrderedDict()
+        for key, each_utt in zip(keys, utterances):
+            if key in resolved or key in missing:
+                continue
+            cached = self.cache.get(key)
+            if cached is not None:
+                resolved[key] = cached
+            else:
+                missing[key] = each_utt
+
+        tokenized = []
+        if missing:
+            tokenized = pool.map(tokenize_utterance, missing.values(), chunksize=max(1, len(missing) // (4 * self.pool_size)))
+        for key, each_tokenized in zip(missing.keys(), tokenized):
+            resolved[key] = each_tokenized
+            self.cache.put(key, each_tokenized)
+
+        self.misses += len(missing)
+        self.hits += len(utterances) - len(missing)
+        return [resolved[key] for key in keys]
+
+    def write_chunk(self, pool, op_file, chunk, column_num):
+        line_splits = [line.strip().split('\t') for line in chunk]
+        tokenized = self.tokenize_chunk(pool, [line_split[column_num] for line_split in line_splits])
+        output = []
+        for line_split, tokenized_string in zip(line_splits, tokenized):
+            initial_string = '\t'.join(line_split[0:column_num]).strip()
+            last_string = '\t'.join(line_split[column_num + 1:]).strip()
+            final_string = initial_string + '\t' + tokenized_string + '\t' + last_string
+            output.append(final_string.strip() + '\n')
+        op_file.write(''.join(output))
+
+    def tokenize_by_column(self, filename, column_num=0):
+        start_time = time.time()
+        self.cache.load(self.cache_path)
+        pool = multiprocessing.Pool(self.pool_size)
+
+        lines = open(filename, 'r')
+        op_file = open(filename + '_tokenized', 'w')
+        chunk = []
+        try:
+            for line in lines:
+                chunk.append(line)
+                if len(chunk) == self.chunk_lines:
+                    self.write_chunk(pool, op_file, chunk, column_num)
+                    chunk = []
+            if chunk:
+                self.write_chunk(pool, op_file, chunk, column_num)
+        finally:
+            pool.close()
+            pool.join()
+            lines.close()
+            op_file.close()
+
+        self.cache.save(self.cache_path)
+        total = self.hits + self.misses
+        print('Tokenized %d lines in %.1f sec: %d unique utterances tokenized, cache hit rate %.2f%%'
+              % (total, time.time() - start_time, self.misses, 100.0 * self.hits / max(total, 1)))
+
+
 def tokenize_by_column(filename, column_num=0):
-    lines = open(filename, 'r')
-    op_file = open(filename + '_tokenized', 'w')
+    ParallelTokenizer(cache_path=set_dir.Directory('TR').tokenizer_cache).tokenize_by_column(filename, column_num)
+
 
-    for line in lines:
-        line_split = line.strip().split('\t')
-        print (line)
-        initial_string = '\t'.join(line_split[0:column_num]).strip()
-        tokenized_string = str(' '.join(nltk.word_tokenize(line_split[column_num]))).strip()
-        last_string = '\t'.join(line_split[column_num+1:]).strip()
-        final_string = initial_string + '\t' + str(tokenized_string) + '\t' + last_string
-        op_file.write(final_string.strip() + '\n')
+def main():
+    tokenize_by_column(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0)
 
-    op_file.close()
 
-tokenize_by_column('/home/aykumar/aykumar_home/self/sequential_match/global_module/utility_dir/folder1/data/base_data/test/jpmc_demo_test_raw_transformed.txt', 0)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Append-only vocabulary update for fresh training data
+# Existing words keep their ids, new words get the next free ids and new rows appended to word_embedding.csv,
+# so tokenized caches and checkpoints built on the old vocabulary stay valid.
+
+import cPickle
+import csv
+
+from global_module.pre_processing_module.build_word_vocab import BuildWordVocab
+from global_module.settings_module import set_dir
+
+
+class UpdateWordVocab(BuildWordVocab):
+
+    def count_embedding_rows(self, word_embedding_file):
+        embedding_file = open(word_embedding_file, 'r')
+        num_rows = 0
+        for _ in embedding_file:
+            num_rows += 1
+        embedding_file.close()
+        return num_rows
+
+    def update_glove_vectors(self, word_vocab_file, glove_file):
+        """
+        Adds the words of word_vocab_file (vocab of the new data) that are missing from the current vocabulary.
+        :return: (old vocab size, new vocab size, list of appended vector strings)
+        """
+        dir_obj = set_dir.Directory('TR')
+        glove_vocab_dict = cPickle.load(open(glove_file, 'rb'))
+        word_vocab_dict = cPickle.load(open(word_vocab_file, 'rb'))
+        glove_present_training_word_vocab_dict = cPickle.load(open(dir_obj.glove_present_training_word_vocab, 'rb'))
+
+        old_vocab_size = self.count_embedding_rows(dir_obj.word_embedding)
+        length_word_vector = len(glove_vocab_dict.get('the').split(' '))
+
+        next_id = old_vocab_size
+        new_vectors = []
+        for key in sorted(word_vocab_dict, key=word_vocab_dict.get):
+            key = self.normalize_key(key, glove_vocab_dict)
+            if not glove_present_training_word_vocab_dict.has_key(key):
+                word_vector = self.get_word_vector(key, glove_vocab_dict, length_word_vector)
+                if word_vector is not None:
+                    glove_present_training_word_vocab_dict[key] = next_id
+                    new_vectors.append(word_vector)
+                    next_id += 1
+
+        word_vector_file = open(dir_obj.word_embedding, 'a')
+        writer = csv.writer(word_vector_file)
+        for each_vector in new_vectors:
+            writer.writerow([each_vector])
+        word_vector_file.close()
+
+        glove_present_training_word_vocab = open(dir_obj.glove_present_training_word_vocab, 'wb')
+        cPickle.dump(glove_present_training_word_vocab_dict, glove_present_training_word_vocab, protocol=cPickle.HIGHEST_PROTOCOL)
+        glove_present_training_word_vocab.close()
+
+        print('Vocab update: %d existing ids kept, %d words appended, vocab size %d -> %d'
+              % (old_vocab_size, len(new_vectors), old_vocab_size, next_id))
+        return old_vocab_size, next_id, new_vectors
+
+    def util(self):
+        return self.update_glove_vectors(set_dir.Directory('TR').word_vocab_dict, self.gloveDict)
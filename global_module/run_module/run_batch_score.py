@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.implementation_module import SMN, DataReader, ScoreWriter
+from global_module.pre_processing_module.preprocess_engine import read_shard, shard_offsets
+from global_module.settings_module import Dictionary, Directory, artifact_cache, get_params
+
+
+def shard_path(output_path, shard_num):
+    return output_path + '.shard-%03d' % shard_num
+
+
+def score_shard(data_filename, start, end, output_path, shard_num, num_threads):
+    """
+    Utility function run in a worker process: loads the model once and scores the lines of one byte range.
+    The shard is marked done only after all of its scores are written.
+    """
+    dict_obj = Dictionary('TE')
+    dir_obj = Directory('TE')
+    params = get_params('TE')
+    params.num_classes = len(dict_obj.label_dict)
+    params.vocab_size = len(dict_obj.glove_present_word_csv)
+    if params.embedding_compression is not None:
+        dir_obj.use_compressed_model()
+    reader = DataReader(params)
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+    with tf.Graph().as_default(), tf.Session(config=session_config) as session:
+        with tf.variable_scope('classifier', reuse=None):
+            model_obj = SMN(params, dir_obj)
+        artifact_cache.check_checkpoint(dir_obj.test_model, params.model_fingerprint())
+        tf.train.Saver().restore(session, dir_obj.test_model)
+
+        score_writer = ScoreWriter(shard_path(output_path, shard_num), 'binary', params.score_flush_rows)
+        lines = []
+        for each_line in read_shard(data_filename, start, end):
+            lines.append(each_line)
+            if len(lines) == params.batch_size:
+                batch = reader.encode_batch(lines, dict_obj)
+                score_writer.write(session.run(model_obj.positive_score, feed_dict=model_obj.get_feed_dict(batch)))
+                lines = []
+        if lines:
+            # the tail batch is scored as well, the placeholders take any batch size
+            batch = reader.encode_batch(lines, dict_obj)
+            score_writer.write(session.run(model_obj.positive_score, feed_dict=model_obj.get_feed_dict(batch)))
+        score_writer.close()
+
+    open(shard_path(output_path, shard_num) + '.done', 'w').close()
+    print('Shard %d: %d scores' % (shard_num, score_writer.count))
+
+
+def merge_shards(output_path, num_shards):
+    """
+    Utility function to concatenate the shard scores in file order
+    :return: number of merged scores
+    """
+    output_file = open(output_path, 'wb')
+    for shard_num in range(num_shards):
+        shard_file = open(shard_path(output_path, shard_num), 'rb')
+        shutil.copyfileobj(shard_file, output_file)
+        shard_file.close()
+    output_file.close()
+
+    count = os.path.getsize(output_path) // np.dtype(np.float32).itemsize
+    sidecar_file = open(output_path + '.json', 'w')
+    json.dump({'format': 'scores', 'dtype': '<f4', 'count': count, 'rows_scored': count, 'top_k': None}, sidecar_file)
+    sidecar_file.close()
+
+    for shard_num in range(num_shards):
+        for suffix in ('', '.json', '.done'):
+            os.remove(shard_path(output_path, shard_num) + suffix)
+    return count
+
+
+def batch_score(data_filename, output_path, num_shards=None, only_shard=None, num_threads=None):
+    """
+    Utility function to score a data file with one worker process per byte-offset shard.
+    Shards already marked done are skipped, so rerunning after a failure only repeats the failed shards.
+    :param only_shard: score this shard only, without merging
+    :return: number of merged scores, None if not every shard is done
+    """
+    num_shards = num_shards or multiprocessing.cpu_count()
+    num_threads = num_threads or max(1, multiprocessing.cpu_count() // num_shards)
+    # offsets are recomputed from the file, a restart has to use the same number of shards
+    offsets = shard_offsets(data_filename, num_shards)
+    start_time = time.time()
+
+    workers = []
+    for shard_num, (start, end) in enumerate(offsets):
+        if only_shard is not None and shard_num != only_shard:
+            continue
+        if only_shard is not None and os.path.exists(shard_path(output_path, shard_num) + '.done'):
+            os.remove(shard_path(output_path, shard_num) + '.done')
+        elif os.path.exists(shard_path(output_path, shard_num) + '.done'):
+            print('Shard %d already done, skipping.' % shard_num)
+            continue
+        process = multiprocessing.Process(target=score_shard, args=(data_filename, start, end, output_path, shard_num, num_threads))
+        process.start()
+        workers.append((shard_num, process))
+
+    failed = []
+    for shard_num, process in workers:
+        process.join()
+        if process.exitcode != 0:
+            failed.append(shard_num)
+
+    if failed:
+        print('Failed shards: %s, rerun them with --shard <num> or rerun the whole job.' % ', '.join(map(str, failed)))
+        return None
+    if only_shard is not None or not all(os.path.exists(shard_path(output_path, shard_num) + '.done') for shard_num in range(len(offsets))):
+        return None
+
+    count = merge_shards(output_path, len(offsets))
+    print('Scored %d pairs with %d shards in %.1f sec' % (count, len(offsets), time.time() - start_time))
+    return count
+
+
+def main():
+    """
+    Starting module for sharded batch scoring
+    """
+    dir_obj = Directory('TE')
+    parser = argparse.ArgumentParser(description='Score a data file with one process per shard.')
+    parser.add_argument('--data', default=dir_obj.data_filename)
+    parser.add_argument('--output', default=dir_obj.test_score_path)
+    parser.add_argument('--shards', type=int, default=None, help='number of shards, defaults to the number of cores')
+    parser.add_argument('--shard', type=int, default=None, help='(re)score this shard only')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads per worker')
+    args = parser.parse_args()
+
+    batch_score(args.data, args.output, args.shards, args.shard, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+from collections import OrderedDict
+
+import tensorflow as tf
+
+from global_module.implementation_module.distillation import student_params
+from global_module.implementation_module.embedding_compression import checkpoint_mb, compress, reconstruction_report, \
+    write_compressed_checkpoint
+from global_module.implementation_module.grow_embedding import EMBEDDING_NAME
+from global_module.run_module.run_distill_report import count_rows, measure, print_comparison
+from global_module.settings_module import Dictionary, Directory, artifact_cache, get_params
+
+
+def main():
+    """
+    Starting module for embedding compression: fits the compressed word embedding of the test model, writes the
+    inference checkpoint used with embedding_compression set and reports the reconstruction error and the
+    accuracy, latency and memory of the dense and the compressed model on the test split
+    """
+    parser = argparse.ArgumentParser(description='Compress the word embedding of the test model for inference.')
+    parser.add_argument('--method', choices=['pq', 'low_rank'], default=None,
+                        help='defaults to the embedding_compression setting, else pq')
+    parser.add_argument('--repeats', type=int, default=20, help='timed repetitions of every inference call')
+    parser.add_argument('--skip-eval', action='store_true', help='only fit and write the compressed checkpoint')
+    parser.add_argument('--output', default=Directory('TE').output_path + '/compression_report.json')
+    args = parser.parse_args()
+
+    dict_obj = Dictionary('TE')
+    params = get_params('TE')
+    params = params.replace(embedding_compression=args.method or params.embedding_compression or 'pq')
+    dense_dir, compressed_dir = Directory('TE'), Directory('TE')
+    if params.distillation:
+        params = student_params(params)
+        dense_dir.use_student_model()
+        compressed_dir.use_student_model()
+    compressed_dir.use_compressed_model()
+    dense_params = params.replace(embedding_compression=None)
+    for each_params in (params, dense_params):
+        each_params.num_classes = len(dict_obj.label_dict)
+        each_params.vocab_size = len(dict_obj.glove_present_word_csv)
+
+    artifact_cache.check_checkpoint(dense_dir.test_model, dense_params.model_fingerprint())
+    word_emb_matrix = tf.train.NewCheckpointReader(dense_dir.test_model).get_tensor(EMBEDDING_NAME)
+    print('Fitting %s compression of the %d x %d word embedding' % ((params.embedding_compression,) + word_emb_matrix.shape))
+    compressed = compress(word_emb_matrix, params)
+    write_compressed_checkpoint(dense_dir.test_model, compressed_dir.test_model, compressed, params.model_fingerprint())
+
+    reports = OrderedDict()
+    reports['settings'] = params.settings(['embedding_compression', 'pq_subspaces', 'pq_centroids', 'low_rank_dim'])
+    reports['reconstruction'] = reconstruction_report(word_emb_matrix, compressed)
+    reports['checkpoint'] = {'dense_mb': checkpoint_mb(dense_dir.test_model), 'compressed_mb': checkpoint_mb(compressed_dir.test_model)}
+    print('relative error %.4f, mean cosine %.4f, embedding %.1f MB -> %.1f MB'
+          % tuple(reports['reconstruction'][key] for key in ('relative_error', 'mean_cosine', 'dense_mb', 'compressed_mb')))
+    print('checkpoint %.1f MB -> %.1f MB' % (reports['checkpoint']['dense_mb'], reports['checkpoint']['compressed_mb']))
+
+    if not args.skip_eval:
+        num_rows = count_rows(dense_dir.data_filename)
+        reports['dense'] = measure(dense_params, dense_dir, dict_obj, num_rows, args.repeats)
+        reports['compressed'] = measure(params, compressed_dir, dict_obj, num_rows, args.repeats)
+        print_comparison(reports, params.recall_k, ('dense', 'compressed'))
+
+    report_file = open(args.output, 'w')
+    report_file.write(json.dumps(reports, indent=2) + '\n')
+    report_file.close()
+    print('Report written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.benchmark_module.run_benchmark import latency_stats
+from global_module.evaluation_module import ranking_metrics
+from global_module.implementation_module import SMN, MemoryTracker
+from global_module.implementation_module.distillation import iter_split_logits, student_params
+from global_module.settings_module import Dictionary, Directory, artifact_cache, get_params
+
+
+def count_rows(filename):
+    data_file = open(filename, 'r')
+    count = 0
+    for _ in data_file:
+        count += 1
+    data_file.close()
+    return count
+
+
+def context_starts(ctx_arr, prev_ctx):
+    """
+    :return: True for every row whose context differs from the previous row, i.e. the first row of a candidate group
+    """
+    ctx_rows = ctx_arr.reshape(len(ctx_arr), -1)
+    starts = np.ones(len(ctx_rows), dtype=bool)
+    starts[1:] = np.any(ctx_rows[1:] != ctx_rows[:-1], axis=1)
+    if prev_ctx is not None:
+        starts[0] = np.any(ctx_rows[0] != prev_ctx)
+    return starts, ctx_rows[-1]
+
+
+def measure(params, dir_obj, dict_obj, num_rows, repeats):
+    """
+    Utility function to load one model, score the test split with it and time its single-row and batch inference
+    :return: report dict of the model
+    """
+    memory_tracker = MemoryTracker(True)
+    report = OrderedDict()
+    with tf.Graph().as_default(), tf.Session() as session:
+        with memory_tracker.stage('load'):
+            with tf.variable_scope('classifier', reuse=None):
+                model_obj = SMN(params, dir_obj)
+            artifact_cache.check_checkpoint(dir_obj.test_model, params.model_fingerprint())
+            tf.train.Saver().restore(session, dir_obj.test_model)
+
+        report['parameters'] = int(sum(np.prod(each_var.get_shape().as_list()) for each_var in tf.global_variables()))
+        report['checkpoint_mb'] = sum(os.path.getsize(path) for path in glob.glob(dir_obj.test_model + '.*')) / 2.0 ** 20
+
+        scores, labels, starts = [], [], []
+        prev_ctx = None
+        first_batch = None
+        with memory_tracker.stage('score'):
+            for logits, batch in iter_split_logits(session, model_obj, dir_obj, dict_obj, num_rows):
+                if first_batch is None:
+                    first_batch = batch
+                # log-odds rank the candidates like the positive probability
+                scores.append(logits[:, 1] - logits[:, 0])
+                labels.append(batch[5])
+                batch_starts, prev_ctx = context_starts(batch[0], prev_ctx)
+                starts.append(batch_starts)
+
+        offsets = np.append(np.flatnonzero(np.concatenate(starts)), num_rows)
+        report.update(ranking_metrics(np.concatenate(scores), np.concatenate(labels), offsets, params.recall_k))
+
+        single_feed = model_obj.get_feed_dict([each_arr[:1] for each_arr in first_batch])
+        batch_feed = model_obj.get_feed_dict(first_batch)
+        report['latency_single'] = latency_stats(lambda: session.run(model_obj.logits, feed_dict=single_feed), repeats)
+        report['latency_batch'] = latency_stats(lambda: session.run(model_obj.logits, feed_dict=batch_feed), repeats)
+        report['latency_batch']['batch_size'] = len(first_batch[0])
+
+    load_record = memory_tracker.records['load']
+    report['load_rss_mb'] = (load_record['rss_after'] - load_record['rss_before']) / 2.0 ** 20
+    report['score_peak_rss_mb'] = memory_tracker.records['score']['peak'] / 2.0 ** 20
+    report['score_seconds'] = memory_tracker.records['score']['seconds']
+    return report
+
+
+def print_comparison(reports, recall_k, names=('teacher', 'student')):
+    rows = [('parameters', '%d'), ('checkpoint_mb', '%.1f'), ('load_rss_mb', '%.1f'), ('score_peak_rss_mb', '%.1f'),
+            ('score_seconds', '%.1f'), ('mrr', '%.4f')] + [('r%d' % k, '%.4f') for k in recall_k]
+    first, second = names
+    print('%-22s %14s %14s' % ('', first, second))
+    for key, value_format in rows:
+        print('%-22s %14s %14s' % (key, value_format % reports[first][key], value_format % reports[second][key]))
+    for key in ('latency_single', 'latency_batch'):
+        print('%-22s %14s %14s' % (key + ' p50 ms', '%.2f' % reports[first][key]['p50_ms'], '%.2f' % reports[second][key]['p50_ms']))
+
+
+def main():
+    """
+    Starting module for the distillation report: latency, memory and ranking metrics of teacher and student
+    on the test split
+    """
+    parser = argparse.ArgumentParser(description='Compare the teacher (test model) with the distilled student.')
+    parser.add_argument('--repeats', type=int, default=20, help='timed repetitions of every inference call')
+    parser.add_argument('--output', default=Directory('TE').output_path + '/distill_report.json')
+    args = parser.parse_args()
+
+    dict_obj = Dictionary('TE')
+    teacher_params = get_params('TE').replace(embedding_compression=None)
+    teacher_params.num_classes = len(dict_obj.label_dict)
+    teacher_params.vocab_size = len(dict_obj.glove_present_word_csv)
+    teacher_dir, student_dir = Directory('TE'), Directory('TE')
+    student_dir.use_student_model()
+    num_rows = count_rows(teacher_dir.data_filename)
+
+    reports = OrderedDict()
+    reports['teacher'] = measure(teacher_params, teacher_dir, dict_obj, num_rows, args.repeats)
+    reports['student'] = measure(student_params(teacher_params), student_dir, dict_obj, num_rows, args.repeats)
+    reports['student_settings'] = teacher_params.distill_student
+
+    print_comparison(reports, teacher_params.recall_k)
+    report_file = open(args.output, 'w')
+    report_file.write(json.dumps(reports, indent=2) + '\n')
+    report_file.close()
+    print('Report written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
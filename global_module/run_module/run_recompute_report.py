@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from global_module.implementation_module import SMN, peak_bytes_from_run_metadata
+from global_module.settings_module import Directory, get_params
+
+SCOPE_CONFIGS = [[], ['match_network'], ['cnn_network'], ['match_network', 'cnn_network']]
+
+
+def synthetic_feed(model_obj, params, rng):
+    """
+    Utility function to build a random batch matching the model placeholders
+    """
+    batch_size = params.batch_size
+    batch = (rng.randint(2, params.vocab_size, size=(batch_size, params.NUM_CONTEXT, params.MAX_CTX_UTT_LENGTH)),
+             np.full((batch_size, params.NUM_CONTEXT), params.MAX_CTX_UTT_LENGTH, dtype=np.int32),
+             np.full(batch_size, params.NUM_CONTEXT, dtype=np.int32),
+             rng.randint(2, params.vocab_size, size=(batch_size, params.MAX_RESP_UTT_LENGTH)),
+             np.full(batch_size, params.MAX_RESP_UTT_LENGTH, dtype=np.int32),
+             rng.randint(0, 2, size=batch_size))
+    return model_obj.get_feed_dict(batch)
+
+
+def measure(recompute_scopes, batch_size, num_steps):
+    """
+    Utility function to time train steps and trace the memory peak for one recompute configuration
+    :return: (peak bytes, mean step seconds)
+    """
+    params = get_params('TR').replace(batch_size=batch_size, recompute_scopes=recompute_scopes)
+    params.num_classes = 2
+    params.vocab_size = 1000
+    rng = np.random.RandomState(1234)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        with tf.variable_scope('classifier', initializer=tf.contrib.layers.xavier_initializer()):
+            model_obj = SMN(params, Directory('TR'))
+        session.run(tf.global_variables_initializer())
+        session.run(tf.local_variables_initializer())
+        model_obj.assign_lr(session, params.learning_rate)
+
+        feed_dict = synthetic_feed(model_obj, params, rng)
+        session.run(model_obj.train_op, feed_dict=feed_dict)
+
+        run_metadata = tf.RunMetadata()
+        session.run(model_obj.train_op, feed_dict=feed_dict,
+                    options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                    run_metadata=run_metadata)
+
+        start_time = time.time()
+        for _ in range(num_steps):
+            session.run(model_obj.train_op, feed_dict=feed_dict)
+        step_time = (time.time() - start_time) / num_steps
+
+    return peak_bytes_from_run_metadata(run_metadata), step_time
+
+
+def main():
+    """
+    Starting module for the recompute trade-off report: run_recompute_report.py [batch_size] [num_steps]
+    """
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    num_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    print('Recompute trade-off, batch size %d, %d steps' % (batch_size, num_steps))
+    print('%-32s %14s %14s' % ('recompute_scopes', 'peak MB', 'step ms'))
+
+    baseline = None
+    for each_config in SCOPE_CONFIGS:
+        peak_bytes, step_time = measure(each_config, batch_size, num_steps)
+        if baseline is None:
+            baseline = (peak_bytes, step_time)
+        print('%-32s %8.1f (%3.0f%%) %8.1f (%3.0f%%)' % (','.join(each_config) or 'none',
+                                                       peak_bytes / 2.0 ** 20, 100.0 * peak_bytes / max(baseline[0], 1),
+                                                       step_time * 1000, 100.0 * step_time / baseline[1]))
+
+
+if __name__ == '__main__':
+    main()
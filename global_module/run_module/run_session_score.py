@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+from global_module.implementation_module import bank_fingerprint, create_session_scorer
+from global_module.settings_module import Dictionary, Directory, get_params
+
+
+def main():
+    """
+    Starting module for session scoring: reads '<session id>\\t<utterance>' turns from stdin and prints the
+    best candidates for the next response of that session after every turn
+    """
+    parser = argparse.ArgumentParser(description='Score a candidate bank against live conversations, one turn at a time.')
+    parser.add_argument('--candidates', required=True, help='one candidate response per line')
+    parser.add_argument('--top-k', type=int, default=5)
+    args = parser.parse_args()
+
+    dict_obj = Dictionary('TE')
+    dir_obj = Directory('TE')
+    params = get_params('TE')
+    params.num_classes = len(dict_obj.label_dict)
+    params.vocab_size = len(dict_obj.glove_present_word_csv)
+    if params.embedding_compression is not None:
+        dir_obj.use_compressed_model()
+
+    candidates_file = open(args.candidates, 'r')
+    candidates = [each_line.strip() for each_line in candidates_file if each_line.strip()]
+    candidates_file.close()
+
+    scorer = create_session_scorer(params, dir_obj, dict_obj)
+    scorer.load_candidates(candidates, dir_obj.response_bank_path, bank_fingerprint(params, dir_obj, candidates))
+
+    for each_line in sys.stdin:
+        session_id, _, utterance = each_line.rstrip('\n').partition('\t')
+        start_time = time.time()
+        scores = scorer.add_turn(session_id, utterance)
+        print('%s\t%.1f ms' % (session_id, (time.time() - start_time) * 1000.0))
+        for candidate, score in scorer.top_k(scores, args.top_k):
+            print('\t%.4f\t%s' % (score, candidate))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from global_module.implementation_module import Train
-from global_module.pre_processing_module import BuildWordVocab, GenerateLabel, SampleTrainingData
-from global_module.settings_module import Dictionary
+import os
+
+import numpy as np
+
+from global_module.implementation_module import MemoryTracker, Train, grow_word_embedding
+from global_module.pre_processing_module import BuildInternedData, BuildWordVocab, GenerateLabel, PreprocessEngine, Stage, StageRunner, \
+    UpdateWordVocab
+from global_module.pre_processing_module.intern_dataset import INTERNED_FORMAT
+from global_module.settings_module import Dictionary, Directory, artifact_cache, get_params
 
 
 # def load_dictionary():
@@ -15,26 +21,88 @@ from global_module.settings_module import Dictionary
 #     return set_dict.Dictionary()
 
 
-def call_train(dict_obj):
+def call_train(dict_obj, memory_tracker=None):
     """
     Utility function to execute main training module
     :param dict_obj: dictionary object
+    :param memory_tracker: MemoryTracker of the preceding stages
     :return: None
     """
-    Train().run_train(dict_obj)
+    Train(memory_tracker).run_train(dict_obj)
     return
 
 
+def update_vocab():
+    """
+    Utility function to extend the existing vocab with the words of new training data
+    and grow the embedding of the saved model accordingly
+    :return: None
+    """
+    old_fingerprint = get_params('TR').model_fingerprint()
+    _, _, new_vectors = UpdateWordVocab().util()
+    dir_obj = Directory('TR')
+    # the vocab was extended in place, a later full rebuild must not reuse it
+    artifact_cache.invalidate([dir_obj.word_embedding, dir_obj.glove_present_training_word_vocab])
+    checkpoint_path = dir_obj.model_path + dir_obj.model_name
+    if new_vectors and os.path.exists(checkpoint_path + '.index'):
+        new_rows = np.array([each_vector.split(' ') for each_vector in new_vectors], dtype=np.float32)
+        grow_word_embedding(checkpoint_path, new_rows)
+        # appending keeps the ids of the old words, so the grown checkpoint matches the extended vocab
+        if artifact_cache.read_fingerprint(checkpoint_path) == old_fingerprint:
+            artifact_cache.mark(checkpoint_path, get_params('TR').model_fingerprint())
+
+
+def build_pipeline(params, memory_tracker=None):
+    """
+    Utility function to declare the preprocessing stages with the files they read and write
+    :return: StageRunner
+    """
+    dir_obj = Directory('TR')
+    runner = StageRunner(dir_obj.pipeline_state_path, params.pipeline_parallel, params.pipeline_dry_run, memory_tracker)
+    runner.add(Stage('preprocess', lambda: PreprocessEngine().util(),
+                     inputs=[dir_obj.raw_train_path],
+                     outputs=[dir_obj.data_filename, dir_obj.data_path + '/tokenized_training', dir_obj.word_vocab_dict],
+                     settings=params.fingerprint('preprocess'), external=[dir_obj.glove_path]))
+    if params.incremental_vocab:
+        runner.add(Stage('vocab_update', update_vocab,
+                         inputs=[dir_obj.word_vocab_dict],
+                         outputs=[dir_obj.word_embedding, dir_obj.glove_present_training_word_vocab],
+                         settings=params.fingerprint('vocab'), external=[dir_obj.glove_path]))
+    else:
+        runner.add(Stage('vocab_build', lambda: BuildWordVocab().util(generate_vocab=False),
+                         inputs=[dir_obj.word_vocab_dict],
+                         outputs=[dir_obj.word_embedding, dir_obj.glove_present_training_word_vocab],
+                         settings=params.fingerprint('vocab'), external=[dir_obj.glove_path]))
+    runner.add(Stage('label_map', lambda: GenerateLabel().util(),
+                     inputs=[dir_obj.label_filename], outputs=[dir_obj.label_map_dict]))
+    if params.use_interned_data:
+        mode_dirs = [Directory(each_mode) for each_mode in ('TR', 'VA', 'TE')]
+        mode_dirs = [each_dir for each_dir in mode_dirs
+                     if each_dir.mode == 'TR' or os.path.exists(each_dir.data_filename)]
+        runner.add(Stage('interned_data', lambda: BuildInternedData().util([each_dir.mode for each_dir in mode_dirs]),
+                         inputs=[dir_obj.glove_present_training_word_vocab] +
+                                [path for each_dir in mode_dirs for path in (each_dir.data_filename, each_dir.label_filename)],
+                         outputs=[each_dir.interned_data_path for each_dir in mode_dirs],
+                         settings=params.fingerprint('interned', INTERNED_FORMAT)))
+    return runner
+
+
 def train_util():
     """
-    Utility function to execute the training pipeline
+    Utility function to execute the training pipeline; up-to-date preprocessing stages are skipped
     :return: None
     """
-    SampleTrainingData().util()
-    BuildWordVocab().util()
-    GenerateLabel().util()
-    dict_obj = Dictionary()
-    call_train(dict_obj)
+    params = get_params('TR')
+    memory_tracker = MemoryTracker(params.memory_tracking, params.memory_budget_mb)
+    try:
+        build_pipeline(params, memory_tracker).run()
+        if params.pipeline_dry_run:
+            return None
+        with memory_tracker.stage('dictionary_load'):
+            dict_obj = Dictionary()
+        call_train(dict_obj, memory_tracker)
+    finally:
+        memory_tracker.write_summary(Directory('TR').memory_summary_path)
     return None
 
 
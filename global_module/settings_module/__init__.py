@@ -1,3 +1,3 @@
 from set_dir import Directory
 from set_dict import Dictionary
-from set_params import ParamsClass
\ No newline at end of file
+from set_params import ParamsClass, get_params
@@ -0,0 +1,108 @@
+# Fingerprint sidecars for derived artifacts
+# <artifact>.fingerprint holds the fingerprint of the settings and input files an artifact was built from.
+# A missing or different sidecar marks the artifact stale; builders rebuild it and mark it again,
+# a matching sidecar lets them reuse the artifact instead of regenerating it.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+SIDECAR_SUFFIX = '.fingerprint'
+
+
+def file_digest(path, block_size=2 ** 20):
+    """
+    :return: md5 of the file content, None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.md5()
+    input_file = open(path, 'rb')
+    for block in iter(lambda: input_file.read(block_size), b''):
+        digest.update(block)
+    input_file.close()
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    """
+    Cheap identity (size, mtime) for large external inputs such as the glove pickle, None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return '%d:%.3f' % (stat.st_size, stat.st_mtime)
+
+
+def combine(*parts):
+    """
+    :return: stable hex fingerprint of JSON-serializable parts (settings fingerprints, digests)
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def read_fingerprint(path):
+    sidecar = path + SIDECAR_SUFFIX
+    if not os.path.exists(sidecar):
+        return None
+    sidecar_file = open(sidecar, 'r')
+    fingerprint = sidecar_file.read().strip()
+    sidecar_file.close()
+    return fingerprint
+
+
+def is_fresh(paths, fingerprint):
+    """
+    :param paths: artifact path or list of paths built together
+    :return: True if every artifact exists and was built with this fingerprint
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    return all(os.path.exists(path) and read_fingerprint(path) == fingerprint for path in paths)
+
+
+def mark(paths, fingerprint):
+    if isinstance(paths, basestring):
+        paths = [paths]
+    for path in paths:
+        sidecar_file = open(path + SIDECAR_SUFFIX, 'w')
+        sidecar_file.write(fingerprint + '\n')
+        sidecar_file.close()
+
+
+def invalidate(paths):
+    if isinstance(paths, basestring):
+        paths = [paths]
+    for path in paths:
+        if os.path.exists(path + SIDECAR_SUFFIX):
+            os.remove(path + SIDECAR_SUFFIX)
+
+
+def load_word_embedding(csv_path):
+    """
+    Loads word_embedding.csv through a .npy copy keyed by the csv content, parsing the csv only when it changed.
+    :return: [vocab_size, EMB_DIM] float32 matrix
+    """
+    npy_path = os.path.splitext(csv_path)[0] + '.npy'
+    fingerprint = combine(file_digest(csv_path))
+    if is_fresh(npy_path, fingerprint):
+        return np.load(npy_path)
+    word_emb_matrix = np.float32(np.genfromtxt(csv_path, delimiter=' '))
+    np.save(npy_path, word_emb_matrix)
+    mark(npy_path, fingerprint)
+    return word_emb_matrix
+
+
+def check_checkpoint(checkpoint_path, fingerprint):
+    """
+    Refuses to restore a checkpoint trained with different model settings or vocab; checkpoints saved before
+    fingerprints were recorded are restored with a warning.
+    """
+    stored = read_fingerprint(checkpoint_path)
+    if stored is None:
+        print('Warning: %s has no settings fingerprint, model settings are not verified' % checkpoint_path)
+    elif stored != fingerprint:
+        raise ValueError('%s was trained with different model settings or vocab (fingerprint %s, current %s)'
+                         % (checkpoint_path, stored, fingerprint))
@@ -1,10 +1,6 @@
-import numpy as np
-import set_dir
-import pickle
 import pickle
 
-import numpy as np
-
+import artifact_cache
 import set_dir
 
 
@@ -18,5 +14,5 @@ class Dictionary():
         # gloveDict = rel_dir.glove_path
         self.word_dict = pickle.load(open(self.rel_dir.glove_present_training_word_vocab, 'rb'))
         wordEmb = self.rel_dir.word_embedding
-        self.glove_present_word_csv = np.float32(np.genfromtxt(wordEmb, delimiter=' '))
+        self.glove_present_word_csv = artifact_cache.load_word_embedding(wordEmb)
         self.label_dict = pickle.load(open(self.rel_dir.label_map_dict, 'rb'))
@@ -10,7 +10,8 @@ class Directory():
         self.mode = mode
 
         self.root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        self.utility_dir = self.root_path + '/utility_dir'
+        # SMN_UTILITY_DIR / SMN_GLOVE_PATH relocate data, vocab and models, e.g. for the synthetic benchmark
+        self.utility_dir = os.environ.get('SMN_UTILITY_DIR', self.root_path + '/utility_dir')
         self.curr_utility_dir = self.utility_dir + '/folder1'
         self.preprocessing_dir = self.root_path + '/pre_processing'
 
@@ -25,20 +26,27 @@ class Directory():
         self.makedir(self.model_path)
         self.makedir(self.output_path)
 
-        self.glove_path = '/home/aykumar/aykumar_home/glove_dir' + '/glove_dict.pkl'
+        self.glove_path = os.environ.get('SMN_GLOVE_PATH', '/home/aykumar/aykumar_home/glove_dir' + '/glove_dict.pkl')
 
         '''Directory to dataset'''
         self.raw_train_path = self.data_path + '/raw_tokenized_train.txt'
+        self.tokenizer_cache = self.data_path + '/tokenizer_cache.pkl'
 
         self.data_filename = self.data_path + '/tokenized_train.txt'
         self.label_filename = self.data_path + '/label_train.txt'
+        self.interned_data_path = self.data_path + '/interned_train.npz'
+        self.teacher_score_path = self.data_path + '/teacher_scores_train.f32'  # teacher log-odds per row, for distillation
 
         if (mode == 'VA'):
             self.data_filename = self.data_path + '/tokenized_valid.txt'
             self.label_filename = self.data_path + '/label_valid.txt'
+            self.interned_data_path = self.data_path + '/interned_valid.npz'
+            self.teacher_score_path = self.data_path + '/teacher_scores_valid.f32'
         elif (mode == 'TE'):
             self.data_filename = self.data_path + '/tokenized_test.txt'
             self.label_filename = self.data_path + '/label_test.txt'
+            self.interned_data_path = self.data_path + '/interned_test.npz'
+            self.teacher_score_path = self.data_path + '/teacher_scores_test.f32'
             self.gold_data = self.data_path + '/gold_test.txt'
 
         '''Directory to utility dataset'''
@@ -52,7 +60,10 @@ class Directory():
         ''' ********** ********* ******** ********* ********* ********* ******** ************* '''''
 
         self.test_cost_path = self.output_path + '/test_cost.txt'  # test cost output
+        self.test_score_path = self.output_path + '/test_scores.f32'  # raw float32 scores, described by test_scores.f32.json
+        self.test_top_k_path = self.output_path + '/test_top_k.bin'  # (group, row, score) records of the top-k candidates
         self.test_pred_path = self.output_path + '/test_pred.txt'
+        self.memory_summary_path = self.output_path + '/memory_summary.txt'
         self.test_seq_op_path = self.output_path + '/test_seq_op.txt'
 
 
@@ -62,10 +73,31 @@ class Directory():
         self.word_vocab_dict = self.vocab_path + '/word_vocab.pkl'
         self.glove_present_training_word_vocab = self.vocab_path + '/glove_present_training_word_vocab.pkl'
         self.label_map_dict = self.vocab_path + '/label_map.pkl'
+        self.pipeline_state_path = self.vocab_path + '/pipeline_state.json'  # input hashes of the preprocessing stages
 
         ''' ****************** Directory for test model ********************** '''''
         self.test_model_name = '/cnn_classifier.ckpt'
         self.test_model = self.model_path + self.test_model_name
+        self.response_bank_path = self.model_path + '/response_bank.npz'  # candidate bank encoded by the test model
+        self.student_model_path = self.model_path + '/student'  # distilled student checkpoints
+
+    def use_student_model(self):
+        """
+        Points the model paths at the distilled student instead of the production (teacher) model.
+        """
+        self.model_path = self.student_model_path
+        self.test_model = self.model_path + self.test_model_name
+        self.response_bank_path = self.model_path + '/response_bank.npz'
+        self.makedir(self.model_path)
+
+    def use_compressed_model(self):
+        """
+        Points the model paths at the inference checkpoint with the compressed word embedding of the current model.
+        """
+        self.model_path = self.model_path + '/compressed'
+        self.test_model = self.model_path + self.test_model_name
+        self.response_bank_path = self.model_path + '/response_bank.npz'
+        self.makedir(self.model_path)
 
     def makedir(self, dirname):
         if not os.path.exists(dirname):
@@ -1,6 +1,40 @@
-class ParamsClass():
+import copy
+import json
+import os
+
+import artifact_cache
+
+# set by the pipeline from the data after the config is created, everything else is frozen
+RUNTIME_ATTRS = ('indices', 'num_instances', 'num_classes', 'vocab_size')
+
+# settings each derived artifact depends on; their fingerprint keys the artifact cache
+ARTIFACT_KEYS = {
+    'preprocess': ['sampling_threshold', 'use_unknown_word', 'use_random_initializer'],
+    'vocab': ['all_lowercase', 'use_unknown_word', 'use_random_initializer'],
+    'interned': ['all_lowercase', 'NUM_CONTEXT'],
+    'model': ['EMB_DIM', 'NUM_CONTEXT', 'MAX_CTX_UTT_LENGTH', 'MAX_RESP_UTT_LENGTH', 'RNN_HIDDEN_DIM', 'rnn',
+              'USE_SAME_CELL', 'num_filters', 'filter_width', 'conv_padding', 'pool_width', 'pool_stride',
+              'pool_padding', 'pool_option', 'all_lowercase'],
+}
+ARTIFACT_KEYS['compressed_model'] = ARTIFACT_KEYS['model'] + ['embedding_compression', 'pq_subspaces', 'pq_centroids',
+                                                              'pq_iterations', 'low_rank_dim']
+
+_params_cache = {}
+
+
+def get_params(mode='TR'):
+    """
+    :return: the config of a mode, created once per process with file and env overrides applied
+    """
+    if mode not in _params_cache:
+        _params_cache[mode] = ParamsClass(mode)
+    return _params_cache[mode]
+
+
+class ParamsClass(object):
     def __init__(self, mode='TR'):
         """
+        Frozen once created: change settings through SMN_PARAMS_FILE / SMN_PARAM_<name> or replace().
         :param mode: 'TR' for train, 'TE' for test, 'VA' for valid
         """
         self.mode = mode
@@ -23,32 +57,112 @@ class ParamsClass():
         self.log = False
         self.log_step = 9
 
+        ''' VALIDATION POLICY '''
+        self.valid_subsample_size = None  # None evaluates the full validation split every epoch
+        self.valid_subsample_seed = 1234
+        self.valid_full_every = 1  # full validation pass every K epochs (and on the last epoch)
+        self.early_stop_patience = None  # full passes without improvement before stopping, None disables
+        self.valid_time_budget = None  # seconds per subsampled validation pass; full passes are never cut
+
         if (mode == 'TE'):
             self.enable_shuffle = False
 
         self.REG_CONSTANT = 0.01
+        self.REG_EMB_CONSTANT = 0.0  # L2 on the embedding rows looked up by each batch
+        self.apply_l2_reg = False  # add the L2 penalties to the training objective
         self.MAX_SEQ_LEN = 60
         self.EMB_DIM = 300
         self.NUM_CONTEXT = 4
+        self.window_stride = 2  # utterances between consecutive context windows of a conversation
+        self.window_min_turns = 3  # shortest leading window (contexts + response) taken from a conversation
         self.MAX_CTX_UTT_LENGTH = 40
         self.MAX_RESP_UTT_LENGTH = 60
         self.RNN_HIDDEN_DIM = 50
 
         self.rnn = 'lstm'
         self.USE_SAME_CELL = False
-        self.train_op = 'sgd'
+        # encode every distinct context utterance of a batch once; with enable_shuffle, whole dialogs are shuffled.
+        # Training with it needs keep_prob = 1.0 (one dropout mask per utterance would be shared by its windows)
+        self.shared_ctx_encoding = False
+        # encode, match and convolve only the num_ctx real contexts of a row, the padded slots stay zero
+        self.ragged_contexts = False
+        # 'pointwise': rows with fixed negatives, 'in_batch': positive rows only, scored against every response of the batch
+        self.train_mode = 'pointwise'
+        self.train_op = 'sgd'  # sgd, adam, lazy_adam, adagrad, adadelta
 
         self.batch_size = 2
+        self.grad_accum_steps = 1  # micro-batches summed per optimizer update (effective batch = batch_size * steps)
+        self.lr_warmup_steps = 0  # optimizer updates over which the learning rate ramps up linearly
+        self.num_candidates = 6  # rows per context group (1 positive + negatives), None disables ranking metrics
+        self.recall_k = [1, 2, 5]
         self.vocab_size = 30
         self.is_word_trainable = True
 
         self.use_unknown_word = True
         self.use_random_initializer = False
+        self.incremental_vocab = False  # append new words to the existing vocab and grow the checkpoint embedding
 
         self.indices = None
         self.num_instances = None
         self.num_classes = None
         self.sampling_threshold = 2
+        self.num_preprocess_workers = None  # processes for PreprocessEngine / ParallelTokenizer, None uses every core
+        self.tokenizer_cache_size = 1000000  # distinct utterances kept in the tokenizer memo
+        self.use_interned_data = False  # read batches from the utterance-interned .npz files instead of the text files
+        self.pipeline_parallel = True  # run independent stale preprocessing stages in parallel processes
+        self.pipeline_dry_run = False  # only print which preprocessing stages would rebuild, then stop
+
+        ''' MEMORY ACCOUNTING '''
+        self.memory_tracking = False  # RSS / heap deltas per pipeline stage (heap: tracemalloc, VmData on 2.7), summary table at the end of a run
+        self.memory_budget_mb = None  # fail fast once RSS exceeds this many MB, also without memory_tracking; None disables
+        self.memory_trace_tf = False  # trace the first train step of every epoch for the TF allocator peak
+
+        ''' SCORE OUTPUT (test) '''
+        self.score_output = 'binary'  # 'binary': raw float32 with a .json sidecar, 'text': one score per line in test_cost.txt
+        self.score_flush_rows = 65536  # rows buffered before a write
+        self.score_top_k = None  # keep only the k best candidates of every context group, None keeps every score
+
+        ''' DISTILLATION '''
+        # train a compact student (distill_student overrides) against the soft scores of the test model (the teacher)
+        self.distillation = False
+        self.distill_student = {'EMB_DIM': 100, 'RNN_HIDDEN_DIM': 50, 'num_filters': 32, 'filter_width': [3]}
+        self.distill_alpha = 0.5  # weight of the soft-target loss, the hard labels get 1 - distill_alpha
+        self.distill_temperature = 2.0
+
+        ''' SESSION SCORING (serving) '''
+        # cached turn features of live conversations, least recently active evicted first; one turn takes
+        # candidates x (word + hidden feature dim) x 4 bytes, so the store is bounded in MB rather than conversations
+        self.session_cache_mb = 4096
+        self.session_cache_size = None  # optional extra cap on the number of conversations
+
+        ''' EMBEDDING COMPRESSION (inference) '''
+        # None, 'pq' or 'low_rank': test and serving (TE) graphs restore the compressed checkpoint written by
+        # run_compress_embedding and decode only the looked-up rows; training and validation use the dense matrix
+        self.embedding_compression = None
+        self.pq_subspaces = 50  # must divide EMB_DIM
+        self.pq_centroids = 256  # per subspace, codes are stored as uint8
+        self.pq_iterations = 20  # k-means iterations per subspace
+        self.low_rank_dim = 64
+
+        ''' ON-THE-FLY NEGATIVE SAMPLING (training, pointwise mode) '''
+        self.negative_sampling = False  # draw fresh negatives per epoch from the positive rows of the training file
+        self.num_negatives = 5
+        self.neg_sampling_seed = 1234
+        self.neg_sampling_power = 0.0  # 0.0 uniform over unique responses, 1.0 proportional to response frequency
+        self.hard_negative_mining = False  # mix BM25-retrieved, lexically similar responses into the sampled negatives
+        self.hard_negative_ratio = 0.5  # share of num_negatives taken from the mined candidates of a row
+        self.hard_negative_candidates = 20  # responses retrieved per context by BM25
+        self.hard_negative_pool = 10  # hard negatives are drawn from the best candidates of the current ranking
+        # every hard_negative_refresh epochs (0: never) the candidates are re-mined over a process pool; the pool a row
+        # has already been trained on is retired, so the next lexical neighbours become its hard negatives
+        self.hard_negative_refresh = 5
+        self.hard_negative_rescore = False  # after each refresh, also re-rank the candidates with the current model
+        self.bm25_k1 = 1.2
+        self.bm25_b = 0.75
+
+        # scopes whose activations are recomputed on backprop instead of stored: 'match_network', 'cnn_network'
+        # (both together recompute matching and convolution of a context as one unit)
+        self.recompute_scopes = []
 
         ''' PARAMS FOR CONV BLOCK '''
         self.num_filters = 128
@@ -60,3 +174,76 @@ class ParamsClass():
         self.pool_stride = [3]
         self.pool_padding = 'VALID'
         self.pool_option = 'MAX'
+
+        self.apply_overrides()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen') and name not in RUNTIME_ATTRS:
+            raise AttributeError('ParamsClass is frozen, use replace(%s=...) for a modified copy' % name)
+        object.__setattr__(self, name, value)
+
+    def set_checked(self, name, value):
+        if name.startswith('_') or name not in self.__dict__:
+            raise AttributeError('Unknown setting %s' % name)
+        object.__setattr__(self, name, value)
+
+    def apply_overrides(self):
+        """
+        Overrides from the JSON file named by SMN_PARAMS_FILE ({"name": value} for every mode, {"TR": {...}} for one),
+        then from SMN_PARAM_<name> environment variables (JSON values, plain strings otherwise).
+        """
+        params_file = os.environ.get('SMN_PARAMS_FILE')
+        if params_file:
+            overrides = json.load(open(params_file, 'r'))
+            for name, value in overrides.items():
+                if name not in ('TR', 'VA', 'TE'):
+                    self.set_checked(str(name), value)
+            for name, value in overrides.get(self.mode, {}).items():
+                self.set_checked(str(name), value)
+
+        for env_name, raw_value in os.environ.items():
+            if not env_name.startswith('SMN_PARAM_'):
+                continue
+            try:
+                value = json.loads(raw_value)
+            except ValueError:
+                value = raw_value
+            self.set_checked(env_name[len('SMN_PARAM_'):], value)
+
+    def replace(self, **overrides):
+        """
+        :return: frozen copy with the given settings changed
+        """
+        params = copy.copy(self)
+        for name, value in overrides.items():
+            params.set_checked(name, value)
+        return params
+
+    def settings(self, keys=None):
+        """
+        :return: dict of the given (default: all non-runtime) settings
+        """
+        if keys is None:
+            keys = [name for name in self.__dict__ if not name.startswith('_') and name not in RUNTIME_ATTRS + ('mode',)]
+        return dict((name, getattr(self, name)) for name in keys)
+
+    def fingerprint(self, keys=None, *inputs):
+        """
+        Stable content fingerprint of the given settings (an ARTIFACT_KEYS name or a list of names)
+        combined with extra inputs such as file digests.
+        """
+        if isinstance(keys, basestring):
+            keys = ARTIFACT_KEYS[keys]
+        return artifact_cache.combine(self.settings(keys), *inputs)
+
+    def model_fingerprint(self):
+        """
+        :return: fingerprint of the checkpoint this config restores (the compressed one in test / serving mode):
+                 model settings and the content of the training vocab, whose ids index the embedding rows
+        """
+        from set_dir import Directory
+        vocab_digest = artifact_cache.file_digest(Directory('TR').glove_present_training_word_vocab)
+        if self.mode == 'TE' and self.embedding_compression is not None:
+            return self.fingerprint('compressed_model', vocab_digest)
+        return self.fingerprint('model', vocab_digest)